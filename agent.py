@@ -1,10 +1,19 @@
 from connections.consts import (
-    NEGOTIATOR_IP,
-    NEGOTIATOR_PORT,
     LEADER_CHANGE_COOLDOWN,
+    CONNECTION_ENGINE,
+    ALIVE,
+    DEAD,
 )
 from connections.manager import ConnectionManager
+from connections.async_manager import AsyncConnectionManager
+from connections.negotiator import join_lobby
+from connections.election import LeaderPolicy
 from game.game import Game
+import game.engine as engine
+from game.handoff import SnapshotSlot
+from game.lag import PositionHistory, view_lag
+from game.prediction import Predictor
+from scheduler import FixedTimestep
 from schema import (
     KeyInput,
     MouseInput,
@@ -12,16 +21,20 @@ from schema import (
     InputState,
     GameState,
     Player,
-    ConnectRequest,
-    ConnectResponse,
     Machine,
-    wire_decode,
 )
 from threading import Thread, Lock
+import copy
 import time
 import random
 import socket
-from game.consts import SCREEN_WIDTH, SCREEN_HEIGHT, FPS
+from game.consts import (
+    SCREEN_WIDTH,
+    SCREEN_HEIGHT,
+    NUM_PLAYERS,
+    CLIENT_PREDICTION,
+    LAG_COMPENSATION,
+)
 import sys
 import arcade
 import game.ai as cpu
@@ -34,12 +47,20 @@ class Agent:
     The actual program that each player will run to participate in the game
     """
 
-    def __init__(self, name: str, ai: Union[cpu.AI, None] = None, test: bool = False):
+    def __init__(
+        self,
+        name: str,
+        ai: Union[cpu.AI, None] = None,
+        test: bool = False,
+        predict: bool = CLIENT_PREDICTION,
+    ):
         self.alive = True
+        # The newest game state, see SnapshotSlot
+        self.snapshot = SnapshotSlot()
 
         # Function to pass the connection manager to let it update gamestate
         def update_game_state(game_state: GameState):
-            self.game_state = game_state
+            self.snapshot.publish(game_state)
 
         self.ai = ai
         if not test:
@@ -51,7 +72,17 @@ class Agent:
         self.mouse_input: MouseInput = MouseInput(Vec2(0, 0), False, False)
         if not test:
             self.fout = open(f"output/{name}.txt", "w")
-            self.conman = ConnectionManager(self.identity, update_game_state, am_leader)
+            manager_class = (
+                AsyncConnectionManager
+                if CONNECTION_ENGINE == "asyncio"
+                else ConnectionManager
+            )
+            self.conman = manager_class(
+                self.identity,
+                update_game_state,
+                am_leader,
+                expected_peers=self.expected_peers(),
+            )
             self.conman.initialize()
             self.game = Game(
                 self.identity.name,
@@ -62,73 +93,86 @@ class Agent:
             self.game.activate()
         else:
             self.conman = ConnectionManager(self.identity, update_game_state, am_leader)
+        # Decides who leads next, from the scores and everyone's ping
+        self.leader_policy = LeaderPolicy()
         # A ticker to limit leader change updates
         self.ticks_since_leader_change = 0
+        # Keeps ticks at FPS no matter how long each one takes
+        self.timestep = FixedTimestep()
         # Note that because the rendering must happen on the main thread, this spins up
-        # another thread which will be doing the updates
-        self.game_state = GameState(
-            (self.identity.name, 0) if am_leader else ("", -1),
-            [
-                Player(
-                    name,
-                    Vec2(
-                        random.randint(0, SCREEN_WIDTH),
-                        random.randint(0, SCREEN_HEIGHT),
-                    ),
-                    Vec2(0, 0),
-                )
-                for name in (
-                    list(self.conman.input_sockets.keys()) + [self.identity.name]
-                )
-            ],
-            [],
+        # another thread which will be doing the updates. A state that already
+        # arrived from the leader wins over our own starting one
+        self.snapshot.publish_if(
+            None,
+            GameState(
+                (self.identity.name, 0) if am_leader else ("", -1),
+                [
+                    Player(
+                        name,
+                        Vec2(
+                            random.randint(0, SCREEN_WIDTH),
+                            random.randint(0, SCREEN_HEIGHT),
+                        ),
+                        Vec2(0, 0),
+                    )
+                    for name in self.player_names()
+                ],
+                [],
+            ),
         )
         # Makes sure we don't double create projectiles
         self.input_lock = Lock()
+        # With prediction we send our input every tick, numbered so the leader can
+        # tell us which ones it has applied
+        self.predict = predict
+        self.input_seq = 0
+        self.predictor = Predictor(self.identity.name)
+        # Where everyone was lately, so hits can be judged from the caster's view
+        self.history = PositionHistory() if LAG_COMPENSATION else None
+        # Keeps the leader's tick running from one state to the next
+        self.simulation = engine.Simulation(
+            self.history,
+            lambda name: view_lag(self.conman.rtt_to(name), name == self.identity.name),
+        )
         if not test:
-            self.game.setup_for_players(
-                [name for name in self.conman.input_sockets] + [self.identity.name]
-            )
+            self.game.setup_for_players(self.player_names())
             self.agent_loop_thread = Thread(target=self.agent_loop)
             self.agent_loop_thread.start()
 
     def run(self):
         self.game.run()
 
+    @property
+    def game_state(self) -> GameState:
+        return self.snapshot.get()
+
+    @game_state.setter
+    def game_state(self, game_state: GameState):
+        self.snapshot.publish(game_state)
+
+    def expected_peers(self) -> int:
+        """
+        Everyone else in the lobby, including the server if there is one
+        """
+        return NUM_PLAYERS - (1 if self.identity.server == "" else 0)
+
+    def player_names(self) -> list[str]:
+        """
+        Everyone who is actually playing, which excludes a dedicated server
+        """
+        return [
+            name
+            for name in self.conman.peer_names() + [self.identity.name]
+            if name != self.identity.server
+        ]
+
     def negotiate(
         self, name: str, test_sock: Union[socket.socket, mock_socket, None] = None
     ) -> tuple[Machine, bool]:
         """
         Connect to the negotiator to get a machine id to play the game
         """
-        while self.alive:
-            sock = (
-                test_sock
-                if test_sock != None
-                else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            )
-            try:
-                sock.connect((NEGOTIATOR_IP, NEGOTIATOR_PORT))
-                sock.send(ConnectRequest(name).encode())
-                data = sock.recv(1024)
-                if not data or len(data) <= 0:
-                    raise Exception("Negotiator did not respond")
-                resp = wire_decode(data)
-                if type(resp) != ConnectResponse:
-                    raise Exception("Negotiator did not understand")
-                if not resp.success:
-                    raise Exception("Negotiator rejected connection")
-                mach_data = sock.recv(2048)
-                if not mach_data or len(mach_data) <= 0:
-                    raise Exception("Negotiator did not send machine data")
-                mach = wire_decode(mach_data)
-                if type(mach) != Machine:
-                    raise Exception("Negotiator did not send machine data")
-                return (mach, resp.is_leader)
-            except Exception as e:
-                pass
-            time.sleep(random.uniform(0.5, 1.0))
-        raise Exception("Can't negotiate")
+        return join_lobby(name, "player", test_sock, lambda: self.alive)
 
     def on_update_key(self, key_input: KeyInput):
         """
@@ -136,10 +180,8 @@ class Agent:
         """
         with self.input_lock:
             self.key_input = key_input
-            input_state = InputState(self.key_input, self.mouse_input)
-            self.conman.broadcast_input(
-                input_state,
-            )
+            if not self.predict:
+                self.conman.broadcast_input(self.next_input())
 
     def on_update_mouse(self, mouse_input: MouseInput):
         """
@@ -147,55 +189,105 @@ class Agent:
         """
         with self.input_lock:
             self.mouse_input = mouse_input
-            input_state = InputState(self.key_input, self.mouse_input)
-            self.conman.broadcast_input(
-                input_state,
-            )
+            if not self.predict:
+                self.conman.broadcast_input(self.next_input())
+
+    def next_input(self) -> InputState:
+        """
+        Our current input, numbered as the next one we send
+        NOTE: Assumes the input lock is already held
+        """
+        self.input_seq += 1
+        return InputState(self.key_input, self.mouse_input, self.input_seq)
 
     def agent_loop(self):
-        AGENT_SLEEP = 1.0 / FPS
-        was_leader_last_tick = False
+        self.was_leader_last_tick = False
+        self.timestep.run(self.agent_tick, lambda: self.alive)
+
+    def agent_tick(self):
+        """
+        One tick. Works from its own reference to the newest state and publishes
+        a new one when it's done, so nothing is held while simulating or sending
+        and states from the leader can land at any time
+        """
+        if self.predict:
+            with self.input_lock:
+                input_state = self.next_input()
+                self.conman.broadcast_input(input_state, limit=False)
+        base = self.snapshot.get()
+        leader = self.conman.leader
+        self.fout.write(f"{time.time()},{leader[1] if leader else -1}\n")
+        # Takes over if the leader died
+        self.conman.check_leader(base)
+        is_leader_this_tick = self.conman.is_leader()
+        game_state = base
+        # Whether we're showing a state we simulated ourselves as the leader
+        live = False
+        if is_leader_this_tick:
+            if not self.was_leader_last_tick:
+                self.ticks_since_leader_change = 0
+                if self.history != None:
+                    # Whatever we remember is from before someone else led
+                    self.history.ticks.clear()
 
-        while self.alive:
-            with self.conman.leader_lock:
-                self.fout.write(
-                    f"{time.time()},{self.conman.leader[1] if self.conman.leader else -1}\n"
+            game_state = self.simulation.step(
+                self.conman.stamp_leader(base),
+                self.conman.input_map,
+                david=self.identity.name,
+            )
+
+            if self.ticks_since_leader_change >= LEADER_CHANGE_COOLDOWN:
+                # Handing leadership to someone we've given up on would stall
+                # the game until everyone noticed they were gone
+                candidates = copy.copy(game_state)
+                candidates.players = [
+                    player
+                    for player in game_state.players
+                    if player.id == self.identity.name
+                    or self.conman.health_map.get(player.id, ALIVE) != DEAD
+                ]
+                chosen = self.leader_policy.choose(
+                    candidates,
+                    self.conman.rtt_matrix(),
+                    current=game_state.next_leader[0],
                 )
-                is_leader_this_tick = self.conman.is_leader()
-                if is_leader_this_tick:
-                    if not was_leader_last_tick:
-                        self.ticks_since_leader_change = 0
-
-                    Game.update_game_state(
-                        self.game_state,
-                        self.conman.input_map,
-                        david=self.identity.name,
+                if chosen != game_state.next_leader[0]:
+                    game_state.next_leader = (
+                        chosen,
+                        game_state.next_leader[1] + 1,  # Increment logical value by 1
                     )
 
-                    if self.ticks_since_leader_change >= LEADER_CHANGE_COOLDOWN:
-                        worst = self.game_state.get_worst()
-                        if worst != self.game_state.next_leader[0]:
-                            self.game_state.next_leader = (
-                                worst,
-                                self.game_state.next_leader[1]
-                                + 1,  # Increment logical value by 1
-                            )
-
-                    self.ticks_since_leader_change += 1
+            self.ticks_since_leader_change += 1
 
-                    self.conman.broadcast_game_state(self.game_state)
-                elif self.conman.should_backup_broadcast():
-                    self.conman.broadcast_game_state(self.game_state)
+            if self.snapshot.publish_if(base, game_state):
+                self.conman.broadcast_game_state(game_state)
+                live = True
+            else:
+                # A newer leader's state landed while we were simulating
+                game_state = self.snapshot.get()
+        elif self.conman.should_backup_broadcast():
+            game_state = self.conman.stamp_leader(base)
+            if self.snapshot.publish_if(base, game_state):
+                self.conman.broadcast_game_state(game_state)
+            else:
+                game_state = self.snapshot.get()
+        elif self.predict:
+            # Show our own movement now rather than after a round trip
+            game_state = copy.copy(base)
+            game_state.players = list(base.players)
+            self.predictor.step(game_state, input_state)
+            if not self.snapshot.publish_if(base, game_state):
+                game_state = self.snapshot.get()
 
-            self.game.take_game_state(self.game_state)
+        # The leader's own states are the game itself, nothing to wait for
+        self.game.take_game_state(game_state, live=live)
 
-            if self.ai != None and random.randint(0, 6) == 0:
-                next_input = self.ai.get_move(self.game_state)
-                self.on_update_key(next_input.key_input)
-                self.on_update_mouse(next_input.mouse_input)
+        if self.ai != None and random.randint(0, 6) == 0:
+            next_input = self.ai.get_move(game_state)
+            self.on_update_key(next_input.key_input)
+            self.on_update_mouse(next_input.mouse_input)
 
-            was_leader_last_tick = is_leader_this_tick
-            time.sleep(AGENT_SLEEP)
+        self.was_leader_last_tick = is_leader_this_tick
 
     def kill(self):
         self.conman.kill()
@@ -0,0 +1,224 @@
+import argparse
+import json
+import random
+import time
+from typing import Union
+import codec
+import game.ai as cpu
+import game.consts as consts
+import game.engine as engine
+from game.arrays import ArrayState
+from schema import GameState, GameStateDelta, InputState, Player, Spell, Vec2
+from utils import print_info, print_success, print_error
+
+# The lobbies we measure, as (players, spells)
+LOBBIES = [(2, 0), (2, 100), (8, 100), (16, 500), (64, 0), (64, 500)]
+QUICK_LOBBIES = [(2, 0), (8, 100)]
+BASELINE_PATH = "results/benchmark_baseline.json"
+# Anything this much slower than the baseline gets flagged
+REGRESSION_THRESHOLD = 0.1
+
+
+def make_spell(id: int, creator: str) -> Spell:
+    return Spell(
+        id,
+        Vec2(
+            random.uniform(0, consts.SCREEN_WIDTH),
+            random.uniform(0, consts.SCREEN_HEIGHT),
+        ),
+        Vec2(random.uniform(-2, 2), random.uniform(-2, 2)),
+        creator,
+    )
+
+
+def make_lobby(
+    num_players: int, num_spells: int, seed: int = 0
+) -> tuple[GameState, list[cpu.AI]]:
+    """
+    A synthetic game with bots for every player, and no windows or sockets
+    """
+    random.seed(seed)
+    names = [f"P{px}" for px in range(num_players)]
+    players = [
+        Player(
+            name,
+            Vec2(
+                random.randint(0, consts.SCREEN_WIDTH),
+                random.randint(0, consts.SCREEN_HEIGHT),
+            ),
+            Vec2(0, 0),
+        )
+        for name in names
+    ]
+    spells = [make_spell(sx + 1, random.choice(names)) for sx in range(num_spells)]
+    state = GameState((names[0], 0), players, spells, num_spells)
+    return (state, [cpu.RandomAI(name) for name in names])
+
+
+def missing_spells(state: GameState, num_spells: int) -> list[Spell]:
+    """
+    New spells to replace the ones that left the arena, so every tick sees the
+    same load
+    """
+    return [
+        make_spell(state.spell_count + sx + 1, random.choice(state.players).id)
+        for sx in range(num_spells - len(state.spells))
+    ]
+
+
+def top_up_spells(state: GameState, num_spells: int):
+    spells = missing_spells(state, num_spells)
+    state.spells += spells
+    state.spell_count += len(spells)
+
+
+def bench_ticks(
+    state: GameState, bots: list[cpu.AI], num_spells: int, ticks: int
+) -> float:
+    """
+    Runs the leader's tick and returns how many it manages per second. Only the
+    tick itself is timed, not the bots, refilling spells or building the state
+    the bots look at
+    """
+    input_map: dict[str, InputState] = {}
+    sim = engine.Simulation(shared=False)
+    sim.reset(state)
+    spent = 0.0
+    for _ in range(ticks):
+        view = sim.game_state()
+        for bot in bots:
+            input_map[bot.player_id] = bot.get_move(view)
+        sim.add_spells(missing_spells(view, num_spells))
+        start = time.perf_counter()
+        sim.advance(input_map, view.players[0].id)
+        spent += time.perf_counter() - start
+    return ticks / spent if spent > 0 else float("inf")
+
+
+def bench_snapshot(state: GameState, reps: int) -> float:
+    """
+    Microseconds to get a state that is safe to send while the tick carries on:
+    a copy for the scalar backend, built from the arrays for the numpy one
+    """
+    if consts.SIM_BACKEND == "numpy":
+        arrays = ArrayState(state)
+        snapshot = arrays.to_game_state
+    else:
+        snapshot = state.copy
+    start = time.perf_counter()
+    for _ in range(reps):
+        snapshot()
+    return (time.perf_counter() - start) / reps * 1e6
+
+
+def bench_codec(state: GameState, name: str, reps: int) -> dict[str, float]:
+    """
+    Times encoding and decoding one snapshot, in microseconds
+    """
+    wire = codec.get_codec(name)
+    start = time.perf_counter()
+    for _ in range(reps):
+        data = wire.encode(state)
+    encode_us = (time.perf_counter() - start) / reps * 1e6
+    start = time.perf_counter()
+    for _ in range(reps):
+        codec.decode(data)
+    decode_us = (time.perf_counter() - start) / reps * 1e6
+    return {
+        f"{name}_encode_us": encode_us,
+        f"{name}_decode_us": decode_us,
+        f"{name}_bytes": len(data),
+    }
+
+
+def bench_lobby(
+    num_players: int, num_spells: int, ticks: int, reps: int
+) -> dict[str, float]:
+    (state, bots) = make_lobby(num_players, num_spells)
+    results = {"ticks_per_sec": bench_ticks(state, bots, num_spells, ticks)}
+    # Measure the codecs on a state that has been played for a while
+    top_up_spells(state, num_spells)
+    results["snapshot_us"] = bench_snapshot(state, reps)
+    before = state.copy()
+    engine.update_game_state(state, {}, state.players[0].id)
+    for name in codec.CODECS:
+        results.update(bench_codec(state, name, reps))
+        results[f"{name}_delta_bytes"] = len(
+            codec.get_codec(name).encode(GameStateDelta.between(before, state))
+        )
+    return results
+
+
+def run(lobbies: list[tuple[int, int]], ticks: int, reps: int) -> dict[str, dict]:
+    results = {}
+    for num_players, num_spells in lobbies:
+        key = f"players={num_players},spells={num_spells}"
+        results[key] = bench_lobby(num_players, num_spells, ticks, reps)
+        print_info(f"{key} {format_result(results[key])}")
+    return results
+
+
+def format_result(result: dict[str, float]) -> str:
+    return ", ".join(f"{metric}={value:.1f}" for metric, value in result.items())
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict]) -> list[str]:
+    """
+    Returns a description of every timing that got noticeably worse
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric, value in result.items():
+            old = baseline[key].get(metric)
+            if old == None or old == 0 or metric.endswith("bytes"):
+                continue
+            # Ticks per second should go up, times should go down
+            change = (old - value) / old
+            if not metric.endswith("per_sec"):
+                change = -change
+            if change > REGRESSION_THRESHOLD:
+                regressions.append(f"{key} {metric}: {old:.1f} -> {value:.1f}")
+    return regressions
+
+
+def load_baseline(path: str = BASELINE_PATH) -> Union[dict[str, dict], None]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless performance benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Only small lobbies")
+    parser.add_argument("--ticks", type=int, default=300)
+    parser.add_argument("--reps", type=int, default=200)
+    parser.add_argument("--backend", choices=["scalar", "numpy"])
+    parser.add_argument("--save", action="store_true", help="Save as the baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    if args.backend != None:
+        consts.SIM_BACKEND = args.backend
+    results = run(QUICK_LOBBIES if args.quick else LOBBIES, args.ticks, args.reps)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print_success(f"Saved baseline to {args.baseline}")
+        return
+    baseline = load_baseline(args.baseline)
+    if baseline == None:
+        print_info(f"No baseline at {args.baseline}, run with --save to make one")
+        return
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print_error(f"SLOWER: {regression}")
+    if len(regressions) == 0:
+        print_success("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Wire codecs for the messages that get sent many times a second. The text format
+defined in schema.py is easy to debug but slow to build and parse, so the hot
+messages (GameState, its deltas and the Players and Spells inside them) can be sent
+using an optional fixed-layout binary format. Every other message always uses text.
+
+A binary message looks like:
+    MARKER (1 byte) | kind (1 byte) | body length (4 bytes) | body
+and the body of a GameState starts with a string table holding every player id
+it references, so ids are only sent once per message.
+"""
+
+import struct
+import errors
+from schema import (
+    GameState,
+    GameStateDelta,
+    Player,
+    Spell,
+    Vec2,
+    Wireable,
+    wire_decode,
+)
+
+# No text message can start with a null byte, so this tells the formats apart
+MARKER = b"\x00"
+
+HEADER = struct.Struct("!ccI")
+STR_LEN = struct.Struct("!H")
+# next_leader index, next_leader clock, spell_count, seq, #strings, #players, #spells
+GAME_HEADER = struct.Struct("!HiIIHHH")
+# seq, base seq, next_leader index, next_leader clock, spell_count, #strings,
+# #players, #spells, #removed spells
+DELTA_HEADER = struct.Struct("!IIHiIHHHH")
+REMOVED = struct.Struct("!i")
+# id index, pos, vel, flags, time_till_respawn, facing, score, input_seq
+PLAYER = struct.Struct("!HddddBdBiI")
+# id, creator index, pos, vel
+SPELL = struct.Struct("!iHdddd")
+
+ALIVE_FLAG = 1
+CASTING_FLAG = 2
+DAVID_FLAG = 4
+
+
+class StringTable:
+    """
+    Collects the strings used by a message so each is only encoded once
+    """
+
+    def __init__(self):
+        self.strings: list[str] = []
+        self.index: dict[str, int] = {}
+
+    def add(self, s: str) -> int:
+        if s not in self.index:
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.index[s]
+
+    def encode(self) -> bytes:
+        parts = []
+        for s in self.strings:
+            raw = s.encode()
+            parts.append(STR_LEN.pack(len(raw)))
+            parts.append(raw)
+        return b"".join(parts)
+
+    @staticmethod
+    def decode(body: bytes, offset: int, count: int) -> tuple[list[str], int]:
+        strings = []
+        for _ in range(count):
+            (length,) = STR_LEN.unpack_from(body, offset)
+            offset += STR_LEN.size
+            strings.append(body[offset : offset + length].decode())
+            offset += length
+        return strings, offset
+
+
+def pack_player(player: Player, table: StringTable) -> bytes:
+    flags = (
+        (ALIVE_FLAG if player.is_alive else 0)
+        | (CASTING_FLAG if player.is_casting else 0)
+        | (DAVID_FLAG if player.is_david else 0)
+    )
+    return PLAYER.pack(
+        table.add(player.id),
+        player.pos.x,
+        player.pos.y,
+        player.vel.x,
+        player.vel.y,
+        flags,
+        player.time_till_respawn,
+        player.facing,
+        player.score,
+        player.input_seq,
+    )
+
+
+def unpack_player(body: bytes, offset: int, strings: list[str]) -> Player:
+    (
+        idx,
+        px,
+        py,
+        vx,
+        vy,
+        flags,
+        respawn,
+        facing,
+        score,
+        input_seq,
+    ) = PLAYER.unpack_from(body, offset)
+    return Player(
+        strings[idx],
+        Vec2(px, py),
+        Vec2(vx, vy),
+        bool(flags & ALIVE_FLAG),
+        respawn,
+        facing,
+        bool(flags & CASTING_FLAG),
+        bool(flags & DAVID_FLAG),
+        score,
+        input_seq,
+    )
+
+
+def pack_spell(spell: Spell, table: StringTable) -> bytes:
+    return SPELL.pack(
+        spell.id,
+        table.add(spell.creator),
+        spell.pos.x,
+        spell.pos.y,
+        spell.vel.x,
+        spell.vel.y,
+    )
+
+
+def unpack_spell(body: bytes, offset: int, strings: list[str]) -> Spell:
+    (id, idx, px, py, vx, vy) = SPELL.unpack_from(body, offset)
+    return Spell(id, Vec2(px, py), Vec2(vx, vy), strings[idx])
+
+
+class TextCodec:
+    """
+    The original human readable format from schema.py
+    """
+
+    name = "text"
+
+    def encode(self, msg: Wireable) -> bytes:
+        return msg.encode()
+
+    def decode(self, s: bytes) -> Wireable:
+        return wire_decode(s)
+
+
+class BinaryCodec:
+    """
+    Struct-packed encoding for GameState, GameStateDelta, Player and Spell.
+    Anything else falls back to the text format so the codec can be used for
+    every message on a connection.
+    """
+
+    name = "binary"
+
+    def encode(self, msg: Wireable) -> bytes:
+        table = StringTable()
+        if type(msg) == GameState:
+            leader_idx = table.add(msg.next_leader[0])
+            players = b"".join(pack_player(player, table) for player in msg.players)
+            spells = b"".join(pack_spell(spell, table) for spell in msg.spells)
+            body = (
+                GAME_HEADER.pack(
+                    leader_idx,
+                    msg.next_leader[1],
+                    msg.spell_count,
+                    msg.seq,
+                    len(table.strings),
+                    len(msg.players),
+                    len(msg.spells),
+                )
+                + table.encode()
+                + players
+                + spells
+            )
+        elif type(msg) == GameStateDelta:
+            leader_idx = table.add(msg.next_leader[0])
+            players = b"".join(pack_player(player, table) for player in msg.players)
+            spells = b"".join(pack_spell(spell, table) for spell in msg.spells)
+            removed = b"".join(REMOVED.pack(id) for id in msg.removed_spells)
+            body = (
+                DELTA_HEADER.pack(
+                    msg.seq,
+                    msg.base_seq,
+                    leader_idx,
+                    msg.next_leader[1],
+                    msg.spell_count,
+                    len(table.strings),
+                    len(msg.players),
+                    len(msg.spells),
+                    len(msg.removed_spells),
+                )
+                + table.encode()
+                + players
+                + spells
+                + removed
+            )
+        elif type(msg) == Player:
+            entity = pack_player(msg, table)
+            body = STR_LEN.pack(len(table.strings)) + table.encode() + entity
+        elif type(msg) == Spell:
+            entity = pack_spell(msg, table)
+            body = STR_LEN.pack(len(table.strings)) + table.encode() + entity
+        else:
+            return msg.encode()
+        return HEADER.pack(MARKER, msg.unique_char().encode(), len(body)) + body
+
+    def decode(self, s: bytes) -> Wireable:
+        if not s.startswith(MARKER):
+            return wire_decode(s)
+        try:
+            (_, kind, length) = HEADER.unpack_from(s, 0)
+            body = s[HEADER.size : HEADER.size + length]
+            if len(body) != length:
+                raise errors.InvalidMessage(f"Truncated binary message {s[:16]!r}")
+            kind = kind.decode()
+            if kind == GameState.unique_char():
+                return self.decode_game_state(body)
+            if kind == GameStateDelta.unique_char():
+                return self.decode_delta(body)
+            if kind == Player.unique_char():
+                (count,) = STR_LEN.unpack_from(body, 0)
+                strings, offset = StringTable.decode(body, STR_LEN.size, count)
+                return unpack_player(body, offset, strings)
+            if kind == Spell.unique_char():
+                (count,) = STR_LEN.unpack_from(body, 0)
+                strings, offset = StringTable.decode(body, STR_LEN.size, count)
+                return unpack_spell(body, offset, strings)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise errors.InvalidMessage(f"Malformed binary message {e.args}")
+        raise errors.InvalidMessage(f"Unknown binary message {s[:16]!r}")
+
+    def decode_game_state(self, body: bytes) -> GameState:
+        (
+            leader_idx,
+            leader_clock,
+            spell_count,
+            seq,
+            num_strings,
+            num_players,
+            num_spells,
+        ) = GAME_HEADER.unpack_from(body, 0)
+        strings, offset = StringTable.decode(body, GAME_HEADER.size, num_strings)
+        players, spells, offset = self.decode_entities(
+            body, offset, strings, num_players, num_spells
+        )
+        return GameState(
+            (strings[leader_idx], leader_clock), players, spells, spell_count, seq
+        )
+
+    def decode_delta(self, body: bytes) -> GameStateDelta:
+        (
+            seq,
+            base_seq,
+            leader_idx,
+            leader_clock,
+            spell_count,
+            num_strings,
+            num_players,
+            num_spells,
+            num_removed,
+        ) = DELTA_HEADER.unpack_from(body, 0)
+        strings, offset = StringTable.decode(body, DELTA_HEADER.size, num_strings)
+        players, spells, offset = self.decode_entities(
+            body, offset, strings, num_players, num_spells
+        )
+        removed = []
+        for _ in range(num_removed):
+            removed.append(REMOVED.unpack_from(body, offset)[0])
+            offset += REMOVED.size
+        return GameStateDelta(
+            seq,
+            base_seq,
+            (strings[leader_idx], leader_clock),
+            players,
+            spells,
+            removed,
+            spell_count,
+        )
+
+    def decode_entities(
+        self,
+        body: bytes,
+        offset: int,
+        strings: list[str],
+        num_players: int,
+        num_spells: int,
+    ) -> tuple[list[Player], list[Spell], int]:
+        players = []
+        for _ in range(num_players):
+            players.append(unpack_player(body, offset, strings))
+            offset += PLAYER.size
+        spells = []
+        for _ in range(num_spells):
+            spells.append(unpack_spell(body, offset, strings))
+            offset += SPELL.size
+        return players, spells, offset
+
+
+CODECS = {
+    TextCodec.name: TextCodec(),
+    BinaryCodec.name: BinaryCodec(),
+}
+
+
+def get_codec(name: str):
+    """
+    Looks up a codec by the name used in CommsRequests
+    """
+    if name not in CODECS:
+        raise errors.UnknownComms(f"codec {name}")
+    return CODECS[name]
+
+
+def decode(s: bytes) -> Wireable:
+    """
+    Decodes a message in either format. Receivers never need to know which codec
+    the sender chose since binary messages are marked.
+    """
+    return CODECS[BinaryCodec.name].decode(s)
@@ -0,0 +1,335 @@
+import sys
+
+sys.path.append("..")
+
+import asyncio
+import threading
+import time
+from threading import Thread
+from typing import Union
+from utils import print_error, print_success
+from schema import CommsRequest, CommsResponse, wire_decode
+from connections.consts import (
+    WATCHER_IP,
+    WATCHER_PORT,
+    MAX_WRITE_BUFFER,
+    RECONNECT_GIVE_UP,
+    CONNECT_ATTEMPT_TIMEOUT,
+    CONNECT_DEADLINE,
+    READY_TIMEOUT,
+    DEAD,
+)
+from connections.framing import (
+    FrameReader,
+    frame,
+    read_frame,
+    tag_channel,
+    untag_channel,
+)
+from connections.manager import ConnectionManager, backoff_delay, wait_for_either
+import errors
+
+
+class AsyncConnectionManager(ConnectionManager):
+    """
+    A ConnectionManager that runs every connection on a single asyncio event loop
+    thread, instead of a blocking thread per peer. Sending only queues bytes on the
+    loop, so a peer that is slow to read can never stall a broadcast to everyone else.
+    The public API is the same, and messages are handled by the same code.
+    NOTE: Only speaks multiplexed "peer" connections over the "tcp" transport
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.transport != "tcp":
+            raise errors.UnsupportedTransport(self.transport)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.server: Union[asyncio.AbstractServer, None] = None
+        self.watcher_writer: Union[asyncio.StreamWriter, None] = None
+        # Dialling the watcher and our peers while we start up
+        self.watcher_task: Union[asyncio.Future, None] = None
+        self.peers_task: Union[asyncio.Future, None] = None
+        # The writers for our peers live in peer_sockets so the base class helpers
+        # (peer_names, peers_on, ...) keep working
+        self.peer_sockets: dict[str, asyncio.StreamWriter] = {}
+
+    def initialize(self):
+        """
+        Starts the event loop and blocks until we are connected to everyone
+        """
+        started = time.monotonic()
+        self.loop_thread.start()
+        dialled = threading.Event()
+        asyncio.run_coroutine_threadsafe(self.start(dialled), self.loop).result()
+        wait_for_either(dialled, self.mesh_ready, started + CONNECT_DEADLINE)
+        self.wait_for_mesh(max(0.0, READY_TIMEOUT - (time.monotonic() - started)))
+        self.start_health_checks()
+
+    async def start(self, dialled: threading.Event):
+        """
+        Starts listening and dialling on the loop. Returns once we're listening,
+        and sets dialled once every peer has been dialled
+        """
+        # First set up our connection listener
+        await self.serve()
+        # Then dial all our peers at once, and the watcher on the side since
+        # nobody needs it to play
+        watch_req = CommsRequest(
+            self.identity.name, [self.identity.host_ip, self.identity.port], "watcher"
+        )
+        peer_req = CommsRequest(
+            self.identity.name,
+            [self.identity.host_ip, self.identity.port],
+            "peer",
+            self.wire_codec,
+        )
+        deadline = time.monotonic() + CONNECT_DEADLINE
+        self.watcher_task = asyncio.ensure_future(
+            self.dial_all([([WATCHER_IP, WATCHER_PORT], watch_req)], deadline)
+        )
+        targets = [(peer, peer_req) for peer in self.identity.connections]
+        self.peers_task = asyncio.ensure_future(self.dial_all(targets, deadline))
+        self.peers_task.add_done_callback(lambda _: dialled.set())
+
+    async def dial_all(
+        self, targets: list[tuple[list[str | int], CommsRequest]], deadline: float
+    ):
+        """
+        The asyncio equivalent of ConnectionManager.connect_all, remembering who
+        answered
+        """
+        names = await asyncio.gather(
+            *[self.open_connection(info, req, deadline) for (info, req) in targets]
+        )
+        self.report_links(targets, names)
+
+    async def serve(self):
+        """
+        Starts listening for connections from our peers
+        """
+        self.server = await asyncio.start_server(
+            self.on_connection,
+            self.identity.host_ip,
+            self.identity.port,
+            reuse_address=True,
+        )
+
+    async def open_connection(
+        self,
+        info: list[str | int],
+        req: CommsRequest,
+        deadline: Union[float, None] = None,
+    ) -> Union[str, None]:
+        """
+        The asyncio equivalent of ConnectionManager.connect
+        """
+        attempt = 0
+        while self.alive and (deadline == None or time.monotonic() < deadline):
+            try:
+                name = await asyncio.wait_for(
+                    self.dial_async(info, req), CONNECT_ATTEMPT_TIMEOUT
+                )
+                if name != None:
+                    return name
+            except (OSError, asyncio.TimeoutError):
+                # Connection refused, they probably aren't listening yet
+                pass
+            delay = backoff_delay(attempt)
+            if deadline != None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            await asyncio.sleep(delay)
+            attempt += 1
+        return None
+
+    async def dial_async(
+        self, info: list[str | int], req: CommsRequest
+    ) -> Union[str, None]:
+        """
+        The asyncio equivalent of ConnectionManager.dial
+        """
+        stream, writer = await asyncio.open_connection(info[0], info[1])
+        writer.write(frame(req.encode()))
+        frames = FrameReader()
+        try:
+            resp = wire_decode(await read_frame(stream, frames))
+        except (errors.CommsDied, errors.InvalidMessage):
+            print_error(f"ERROR: No response from {info}")
+            writer.close()
+            return None
+        if type(resp) != CommsResponse or resp.accepted == False:
+            print_error(f"ERROR: Invalid response from {info}")
+            writer.close()
+            return None
+        self.register_stream(stream, writer, frames, req, resp.name)
+        # Remember the connection info in case we need to reconnect later
+        self.reconnect_map[resp.name] = info
+        return resp.name
+
+    def start_reconnect(self, name: str):
+        """
+        Safe to call from any thread, the redialling happens on the loop
+        """
+        if self.should_redial(name):
+            asyncio.run_coroutine_threadsafe(self.reconnect_async(name), self.loop)
+
+    async def reconnect_async(self, name: str):
+        """
+        The asyncio equivalent of ConnectionManager.reconnect
+        """
+        req = CommsRequest(
+            self.identity.name,
+            [self.identity.host_ip, self.identity.port],
+            "peer",
+            self.wire_codec,
+        )
+        deadline = time.monotonic() + RECONNECT_GIVE_UP
+        attempt = 0
+        try:
+            while self.alive and time.monotonic() < deadline:
+                await asyncio.sleep(backoff_delay(attempt))
+                attempt += 1
+                if self.health_map.get(name) != DEAD:
+                    return
+                try:
+                    if await self.dial_async(self.reconnect_map[name], req):
+                        print_success(f"Reconnected to {name}")
+                        return
+                except OSError:
+                    continue
+            print_error(f"ERROR: Gave up reconnecting to {name}")
+        finally:
+            with self.health_lock:
+                self.reconnecting.discard(name)
+
+    async def on_connection(
+        self, stream: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """
+        The asyncio equivalent of ConnectionManager.listen, called once per
+        incoming connection
+        """
+        frames = FrameReader()
+        try:
+            req = wire_decode(await read_frame(stream, frames))
+        except (errors.CommsDied, errors.InvalidMessage) as e:
+            print_error(f"ERROR: Can't get comms req {e.args}")
+            writer.close()
+            return
+        if type(req) != CommsRequest or req.comms_type != "peer":
+            writer.write(frame(CommsResponse(self.identity.name, False).encode()))
+            writer.close()
+            return
+        writer.write(frame(CommsResponse(self.identity.name, True).encode()))
+        self.register_stream(stream, writer, frames, req, req.name)
+
+    def register_stream(
+        self,
+        stream: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        frames: FrameReader,
+        req: CommsRequest,
+        to: str,
+    ):
+        """
+        The asyncio equivalent of ConnectionManager.register_connection
+        """
+        self.reconnect_map[to] = req.info
+        if req.comms_type == "watcher":
+            self.watcher_writer = writer
+            return
+        self.peer_codecs[to] = req.codec
+        old = self.peer_sockets.get(to)
+        self.peer_sockets[to] = writer
+        self.loop.create_task(self.consume_stream(to, stream, frames, writer))
+        if old != None:
+            # They reconnected, the old stream's reader will notice and quit
+            self.revive(to)
+            old.close()
+        self.check_ready()
+
+    async def consume_stream(
+        self,
+        name: str,
+        stream: asyncio.StreamReader,
+        frames: FrameReader,
+        writer: asyncio.StreamWriter,
+    ):
+        """
+        The asyncio equivalent of ConnectionManager.consume_peer
+        """
+        while self.alive:
+            try:
+                channel, msg = untag_channel(await read_frame(stream, frames))
+                self.dispatch(name, channel, msg)
+            except errors.InvalidMessage:
+                continue
+            except errors.CommsDied:
+                # Unless they already reconnected on a new stream
+                if self.peer_sockets.get(name) is writer:
+                    self.mark_dead(name)
+                break
+            except Exception as e:
+                print_error(f"ERROR: consume_stream died for unknown reason {e.args}")
+                break
+        writer.close()
+
+    def send_to(
+        self,
+        name: str,
+        channel: str,
+        payload: bytes,
+        reliable: bool = True,
+        coalesce: bool = False,
+    ):
+        """
+        Safe to call from any thread, the write itself happens on the loop. Writes
+        never block, so there is no need for the per-peer queues
+        """
+        self.loop.call_soon_threadsafe(
+            self.write, name, channel, payload, reliable, coalesce
+        )
+
+    def write(
+        self,
+        name: str,
+        channel: str,
+        payload: bytes,
+        reliable: bool = True,
+        coalesce: bool = False,
+    ):
+        writer = self.peer_sockets.get(name)
+        if writer == None or writer.is_closing():
+            return
+        if (
+            coalesce
+            and not reliable
+            and writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER
+        ):
+            # They aren't keeping up, and the next state supersedes this one
+            # anyway. Handoffs and acks must still arrive
+            return
+        writer.write(frame(tag_channel(channel, payload)))
+
+    def send_watcher(self, payload: bytes):
+        self.loop.call_soon_threadsafe(self.write_watcher, payload)
+
+    def write_watcher(self, payload: bytes):
+        if self.watcher_writer != None and not self.watcher_writer.is_closing():
+            self.watcher_writer.write(frame(payload))
+
+    async def shutdown(self):
+        if self.server != None:
+            self.server.close()
+        for writer in list(self.peer_sockets.values()) + [self.watcher_writer]:
+            if writer != None:
+                writer.close()
+
+    def kill(self):
+        """
+        Kills the connection manager
+        """
+        self.alive = False
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
@@ -3,6 +3,21 @@ from connections.machine import Machine
 # How players will connect to the game, through a coordinating server
 NEGOTIATOR_IP = "127.0.0.1"
 NEGOTIATOR_PORT = 50051
+# The negotiator hands out listening ports starting here, wrapping around after
+# GAME_PORT_RANGE of them, and drops clients that don't send their request within
+# HANDSHAKE_TIMEOUT seconds of connecting
+FIRST_GAME_PORT = 50000
+GAME_PORT_RANGE = 10000
+HANDSHAKE_TIMEOUT = 5.0
+# The negotiator pings each client PROBE_COUNT times as it joins, giving up on an
+# answer after PROBE_TIMEOUT seconds. It starts a lobby as soon as enough players
+# are within MATCH_TARGET_RTT of each other, and looks at the queue again every
+# MATCH_INTERVAL seconds. Nobody waits longer than MAX_MATCH_WAIT for a lobby
+PROBE_COUNT = 3
+PROBE_TIMEOUT = 1.0
+MATCH_TARGET_RTT = 0.08
+MATCH_INTERVAL = 0.5
+MAX_MATCH_WAIT = 10.0
 
 # How we will monitor stats about the game, through a passive "watching" server
 WATCHER_IP = "127.0.0.1"
@@ -26,6 +41,77 @@ BLANK_MACHINE = Machine(
 # The minimum number of ticks that a machine must wait after becoming the leader before
 # issuing a new leader change
 LEADER_CHANGE_COOLDOWN = 60
+# The losing player leads as long as nobody is further than MAX_LEADER_RTT
+# (seconds) from them. Otherwise whoever has the best ping to them stands in, and
+# a stand-in is only replaced by one better by more than LEADER_HYSTERESIS. Pairs
+# with no measurement yet are assumed to be UNKNOWN_RTT apart
+MAX_LEADER_RTT = 0.15
+LEADER_HYSTERESIS = 0.02
+UNKNOWN_RTT = 0.1
+
+# The codec (see codec.py) that this machine asks its peers to use for game traffic.
+# Either "text" (the original, easy to debug format) or "binary"
+WIRE_CODEC = "text"
+
+# Whether the leader sends deltas against the last snapshot each peer acknowledged
+# instead of the full game state every tick
+USE_DELTAS = False
+# Even with deltas on, everyone gets a full game state this often (in ticks)
+KEYFRAME_INTERVAL = 30
+# How many snapshots are kept around to compute or apply deltas against
+SNAPSHOT_HISTORY = 60
+
+# Which ConnectionManager implementation agents use. "threads" runs a blocking thread
+# per connection, "asyncio" runs every connection on one event loop thread
+CONNECTION_ENGINE = "threads"
+# With the asyncio engine, plain game states (not handoffs or acks) aren't queued
+# for a peer that already has this many bytes waiting to be written, since the
+# next state supersedes them
+MAX_WRITE_BUFFER = 1 << 16
+
+# How input and game traffic travels between peers. "tcp" sends everything on the
+# peer sockets, "udp" sends game states as unreliable datagrams (dropping stale
+# ones) and inputs and leader handoffs as acked, retransmitted datagrams. Only
+# the "threads" engine speaks "udp"
+TRANSPORT = "tcp"
+
+# Whether messages to each peer go through an outbound queue drained by a writer
+# thread, so the leader's tick never waits on a slow peer's socket
+QUEUED_SENDS = True
+# At most this many messages wait in a peer's queue. Past that the oldest is
+# dropped and the peer is suspected
+MAX_QUEUE_DEPTH = 256
+
+# Whether lobbies are run by a dedicated headless server (server.py) instead of
+# handing authority between the players
+SERVER_MODE = False
+
+# How often (seconds) we ping each peer over the health channel, how long we wait
+# for the pong before counting it lost, and how many pings loss is measured over
+PING_INTERVAL = 0.25
+PING_TIMEOUT = 2.0
+HEALTH_WINDOW = 20
+# How many pings go by between sharing our round trip times with everyone
+PINGS_PER_REPORT = 4
+
+# A peer we hear nothing from (not even a ping) for SUSPECT_AFTER seconds is
+# suspected, and after DEAD_AFTER it's given up on. A dead leader is replaced
+SUSPECT_AFTER = 0.3
+DEAD_AFTER = 0.6
+# Lost peers are redialled after RECONNECT_BASE_DELAY seconds, doubling each
+# attempt up to RECONNECT_MAX_DELAY, until RECONNECT_GIVE_UP seconds have passed
+RECONNECT_BASE_DELAY = 0.1
+RECONNECT_MAX_DELAY = 2.0
+RECONNECT_GIVE_UP = 30.0
+# When starting up, each attempt to reach a machine gives up after
+# CONNECT_ATTEMPT_TIMEOUT seconds, and we stop dialling anyone who hasn't
+# answered after CONNECT_DEADLINE
+CONNECT_ATTEMPT_TIMEOUT = 1.0
+CONNECT_DEADLINE = 15.0
+# How long after we start dialling we wait for the whole lobby, before starting
+# with whoever made it. Waiting on dials is checked every DIAL_POLL_INTERVAL
+READY_TIMEOUT = 15.0
+DIAL_POLL_INTERVAL = 0.05
 
 ALIVE = 0
 SUS = 1
@@ -0,0 +1,90 @@
+import sys
+
+sys.path.append("..")
+
+from typing import Mapping, Union
+from connections.consts import LEADER_HYSTERESIS, MAX_LEADER_RTT, UNKNOWN_RTT
+from schema import GameState
+
+# How much worse a candidate gets for every second the slowest player would be
+# over MAX_LEADER_RTT from them, compared to a second more for the losing player
+OVER_BOUND_WEIGHT = 4.0
+
+
+def pair_rtt(matrix: Mapping[str, Mapping[str, float]], a: str, b: str) -> float:
+    """
+    The round trip time between two machines, averaging what each of them
+    measured. Pairs nobody has measured yet are assumed to be UNKNOWN_RTT
+    """
+    if a == b:
+        return 0.0
+    samples = [
+        matrix[x][y] for (x, y) in [(a, b), (b, a)] if x in matrix and y in matrix[x]
+    ]
+    if len(samples) == 0:
+        return UNKNOWN_RTT
+    return sum(samples) / len(samples)
+
+
+class LeaderPolicy:
+    """
+    Picks who leads next. The leader has no latency to its own game state, so
+    the losing player leads whenever they are within max_rtt of everyone else.
+    Only when they aren't does someone stand in for them: the player with the
+    best ping to them that doesn't leave anyone else with an unplayable round
+    trip to the leader. One stand-in only replaces another if it is clearly
+    better, so leadership doesn't flap back and forth on noisy measurements.
+    """
+
+    def __init__(
+        self, max_rtt: float = MAX_LEADER_RTT, hysteresis: float = LEADER_HYSTERESIS
+    ):
+        self.max_rtt = max_rtt
+        self.hysteresis = hysteresis
+
+    def cost(
+        self,
+        candidate: str,
+        worst: str,
+        players: list[str],
+        matrix: Mapping[str, Mapping[str, float]],
+    ) -> float:
+        """
+        How bad a leader the candidate would be, in seconds of round trip time
+        """
+        slowest = max(
+            [pair_rtt(matrix, candidate, player) for player in players], default=0.0
+        )
+        over = max(0.0, slowest - self.max_rtt)
+        return pair_rtt(matrix, candidate, worst) + over * OVER_BOUND_WEIGHT
+
+    def choose(
+        self,
+        game_state: GameState,
+        matrix: Mapping[str, Mapping[str, float]],
+        current: Union[str, None] = None,
+    ) -> str:
+        """
+        The next leader. Ties go to the losing player, then by name
+        """
+        worst = game_state.get_worst()
+        players = sorted(player.id for player in game_state.players)
+        if len(players) == 0 or worst not in players:
+            return worst
+        if all(pair_rtt(matrix, worst, player) <= self.max_rtt for player in players):
+            return worst
+        costs = {
+            player: self.cost(player, worst, players, matrix) for player in players
+        }
+        best = min(players, key=lambda player: (costs[player], player != worst, player))
+        # Hysteresis only ever keeps one stand-in over another, never over the
+        # losing player
+        if (
+            current in costs
+            and current != worst
+            and best != worst
+            and current != best
+            and costs[best] > costs[current] - self.hysteresis
+        ):
+            return current
+        return best
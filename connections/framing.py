@@ -0,0 +1,104 @@
+import sys
+
+sys.path.append("..")
+
+import asyncio
+import socket
+import struct
+from typing import Union
+import errors
+import tests.mocks.mock_socket as mock_socket
+
+# Every message on a stream socket is preceded by its length so that the reader
+# can tell where one message ends and the next begins, no matter how TCP decides
+# to split or coalesce the bytes
+HEADER = struct.Struct("!I")
+# Anything bigger than this means the stream is corrupt, not that a peer is chatty
+MAX_FRAME_SIZE = 1 << 24
+RECV_SIZE = 4096
+# A multiplexed peer socket carries several logical channels, and each message on
+# it starts with one byte saying which channel it belongs to
+CHANNELS = ["input", "game", "health"]
+
+
+def frame(payload: bytes) -> bytes:
+    """
+    Prefixes a message with its length so it can be sent on a stream
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+def tag_channel(channel: str, payload: bytes) -> bytes:
+    """
+    Marks a message with the channel it should be delivered to
+    """
+    return bytes([CHANNELS.index(channel)]) + payload
+
+
+def untag_channel(payload: bytes) -> tuple[str, bytes]:
+    """
+    Splits a multiplexed message into its channel and the message itself
+    """
+    if len(payload) == 0 or payload[0] >= len(CHANNELS):
+        raise errors.InvalidMessage(f"Unknown channel in {payload[:16]!r}")
+    return CHANNELS[payload[0]], payload[1:]
+
+
+def send_frame(sock: Union[socket.socket, mock_socket.socket], payload: bytes):
+    """
+    Sends a single message on a stream socket
+    """
+    sock.sendall(frame(payload))
+
+
+class FrameReader:
+    """
+    Buffers the bytes read from a stream socket and hands them back one whole
+    message at a time. A single recv can contain part of a message, many
+    messages, or both, so leftovers are kept around for the next call.
+    """
+
+    def __init__(self, sock: Union[socket.socket, mock_socket.socket, None] = None):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.ready: list[bytes] = []
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """
+        Adds raw bytes to the buffer and returns every message that is now complete
+        """
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, 0)
+            if length > MAX_FRAME_SIZE:
+                raise errors.CommsDied(f"Frame of {length} bytes is too large")
+            end = HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            messages.append(bytes(self.buffer[HEADER.size : end]))
+            del self.buffer[:end]
+        return messages
+
+    def recv(self) -> bytes:
+        """
+        Blocks until the next whole message has arrived and returns it
+        """
+        while len(self.ready) == 0:
+            data = self.sock.recv(RECV_SIZE)
+            if not data or len(data) <= 0:
+                raise errors.CommsDied("Stream closed")
+            self.ready = self.feed(data)
+        return self.ready.pop(0)
+
+
+async def read_frame(stream: asyncio.StreamReader, frames: FrameReader) -> bytes:
+    """
+    The asyncio equivalent of FrameReader.recv
+    """
+    while len(frames.ready) == 0:
+        data = await stream.read(RECV_SIZE)
+        if not data or len(data) <= 0:
+            raise errors.CommsDied("Stream closed")
+        frames.ready = frames.feed(data)
+    return frames.ready.pop(0)
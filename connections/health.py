@@ -0,0 +1,96 @@
+import sys
+
+sys.path.append("..")
+
+import time
+from collections import deque
+from threading import Lock
+from typing import Callable, Union
+from connections.consts import HEALTH_WINDOW, PING_TIMEOUT
+from schema import Ping
+
+
+class HealthTracker:
+    """
+    Keeps the round trip time, jitter and loss to one peer, from the pings we send
+    them and the pongs they echo back. The round trip time is smoothed the way TCP
+    does it (RFC 6298), and jitter is how far samples usually stray from it.
+    """
+
+    def __init__(
+        self,
+        window: int = HEALTH_WINDOW,
+        timeout: float = PING_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.timeout = timeout
+        self.clock = clock
+        self.lock = Lock()
+        self.next_seq = 0
+        # When each unanswered ping was sent, by seq
+        self.outstanding: dict[int, float] = {}
+        # Whether each of the last few pings was answered in time, oldest first
+        self.answered: deque[bool] = deque(maxlen=window)
+        self.srtt: Union[float, None] = None
+        self.jitter = 0.0
+        self.last_rtt: Union[float, None] = None
+        # When we last heard a pong from them
+        self.last_heard: Union[float, None] = None
+
+    def ping(self) -> Ping:
+        """
+        The next ping to send
+        """
+        with self.lock:
+            now = self.clock()
+            self.expire(now)
+            self.next_seq += 1
+            self.outstanding[self.next_seq] = now
+            return Ping(self.next_seq, now)
+
+    def pong(self, pong: Ping) -> Union[float, None]:
+        """
+        Takes an echoed ping, returning the round trip time, or None if it was
+        for a ping we already gave up on
+        """
+        with self.lock:
+            now = self.clock()
+            sent = self.outstanding.pop(pong.seq, None)
+            if sent == None:
+                return None
+            rtt = now - sent
+            if self.srtt == None:
+                self.srtt = rtt
+                self.jitter = rtt / 2
+            else:
+                self.jitter += (abs(self.srtt - rtt) - self.jitter) / 4
+                self.srtt += (rtt - self.srtt) / 8
+            self.last_rtt = rtt
+            self.last_heard = now
+            self.answered.append(True)
+            return rtt
+
+    def expire(self, now: float):
+        """
+        Counts pings that have gone unanswered for too long as lost
+        NOTE: Assumes the lock is already held
+        """
+        for seq, sent in list(self.outstanding.items()):
+            if now - sent > self.timeout:
+                del self.outstanding[seq]
+                self.answered.append(False)
+
+    def loss(self) -> float:
+        """
+        The fraction of recent pings that were never answered
+        """
+        with self.lock:
+            self.expire(self.clock())
+            if len(self.answered) == 0:
+                return 0.0
+            return self.answered.count(False) / len(self.answered)
+
+    def stats(self) -> dict[str, Union[float, None]]:
+        loss = self.loss()
+        with self.lock:
+            return {"rtt": self.srtt, "jitter": self.jitter, "loss": loss}
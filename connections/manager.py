@@ -2,18 +2,23 @@ import sys
 
 sys.path.append("..")
 
+import copy
 import time
 import socket
 from typing import Union, Callable
 from queue import Queue
+import threading
 from threading import Thread, Lock
 from utils import print_error, print_success
 from schema import (
     Ping,
+    RttReport,
     CommsRequest,
     CommsResponse,
     InputState,
     GameState,
+    GameStateDelta,
+    SnapshotAck,
     Machine,
     Wireable,
     ConnectRequest,
@@ -25,9 +30,39 @@ from connections.consts import (
     WATCHER_IP,
     WATCHER_PORT,
     TICKS_PER_WATCH,
+    WIRE_CODEC,
+    USE_DELTAS,
+    KEYFRAME_INTERVAL,
+    SNAPSHOT_HISTORY,
+    TRANSPORT,
+    QUEUED_SENDS,
+    PING_INTERVAL,
+    PINGS_PER_REPORT,
+    SUSPECT_AFTER,
+    DEAD_AFTER,
+    RECONNECT_BASE_DELAY,
+    RECONNECT_MAX_DELAY,
+    RECONNECT_GIVE_UP,
+    CONNECT_ATTEMPT_TIMEOUT,
+    CONNECT_DEADLINE,
+    READY_TIMEOUT,
+    DIAL_POLL_INTERVAL,
+    ALIVE,
+    SUS,
+    DEAD,
 )
 import random
 import errors
+import codec
+from connections.framing import (
+    FrameReader,
+    send_frame,
+    tag_channel,
+    untag_channel,
+)
+from connections.udp import UdpTransport
+from connections.send_queue import PeerSender
+from connections.health import HealthTracker
 import tests.mocks.mock_socket as mock_socket
 from game.consts import NUM_PLAYERS, FPS
 
@@ -35,6 +70,37 @@ SIMULATED_DROP = 0.05
 SIMULATED_LAG = 0.1
 
 
+def outranks(a: tuple[str, int], b: tuple[str, int]) -> bool:
+    """
+    Whether leader claim a beats claim b. The higher logical clock wins, and if two
+    machines claimed the same clock at once, the lower name does
+    """
+    return a[1] > b[1] or (a[1] == b[1] and a[0] < b[0])
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    How long to wait before a reconnection attempt: doubling each time up to a
+    cap, and then anywhere from half to all of that, so peers that lost each other
+    at the same moment don't all retry in lockstep
+    """
+    delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2**attempt)
+    return delay / 2 + random.random() * delay / 2
+
+
+def wait_for_either(
+    first: threading.Event, second: Union[threading.Event, None], deadline: float
+):
+    """
+    Blocks until either event is set, or until deadline (a time.monotonic() value)
+    """
+    while not first.is_set() and (second == None or not second.is_set()):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            return
+        first.wait(min(left, DIAL_POLL_INTERVAL))
+
+
 class ConnectionManager:
     """
     Handles the dirty work of opening sockets to the other machines.
@@ -47,46 +113,121 @@ class ConnectionManager:
         identity: Machine,
         update_game_state: Callable[[GameState], None],
         is_leader: bool,
+        wire_codec: str = WIRE_CODEC,
+        use_deltas: bool = USE_DELTAS,
+        transport: str = TRANSPORT,
+        queued_sends: bool = QUEUED_SENDS,
+        expected_peers: int = NUM_PLAYERS - 1,
+        on_partial_mesh: Union[Callable[[list[str]], None], None] = None,
     ):
         self.identity = identity
+        # How many peers initialize waits for, one more when there's a server. Set
+        # the moment they're all connected, and if that takes too long
+        # on_partial_mesh is told who did make it
+        self.expected_peers = expected_peers
+        self.mesh_ready = threading.Event()
+        self.on_partial_mesh = on_partial_mesh
         self.update_game_state = update_game_state
         self.alive = True
-        self.watcher_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # None until the watcher answers, it's fine to play without one
+        self.watcher_sock: Union[socket.socket, mock_socket.socket, None] = None
+        # Dials the watcher in the background while we start up
+        self.watcher_thread: Union[Thread, None] = None
         self.input_sockets: dict[str, Union[socket.socket, mock_socket.socket]] = {}
         self.input_map_lock = Lock()
         self.input_map: dict[str, InputState] = {self.identity.name: InputState()}
         self.game_sockets: dict[str, Union[socket.socket, mock_socket.socket]] = {}
+        # Guards the (leader, logical clock) pair. Only ever held to read and
+        # update it, never across a tick or a send
         self.leader_lock = Lock()
         self.leader: Union[tuple[str, int], None] = (
             (self.identity.name, 0) if is_leader else None
         )
         self.health_sockets: dict[str, Union[socket.socket, mock_socket.socket]] = {}
+        # Whether each peer is ALIVE, SUS (quiet for a while) or DEAD, and when we
+        # last heard anything at all from them
         self.health_map: dict[str, int] = {}
+        self.last_heard: dict[str, float] = {}
+        # When we stopped waiting for the mesh, None while still starting up
+        self.started_at: Union[float, None] = None
+        # Round trip time, jitter and loss to each peer, from the health channel
+        self.health_lock = Lock()
+        self.health: dict[str, HealthTracker] = {}
+        # The round trip times each peer last told us they measured
+        self.rtt_reports: dict[str, dict[str, float]] = {}
+        # Lost peers we are currently redialling
+        self.reconnecting: set[str] = set()
         # Maps machine name to place to go for reconnection
         self.reconnect_map: dict[str, list[str | int]] = {}
+        # Who answered at each address we dialled in initialize, None if nobody did
+        self.links: dict[str, Union[str, None]] = {}
         self.watcher_ticks: dict[str, int] = {"input": 0, "game": 0}
         self.last_inp_broadcast = time.time()  # Rate limit our broadcasts
         self.need_to_hear_from: Union[str, None] = None
+        # The codec we ask for when connecting, and the one agreed with each peer
+        self.wire_codec = wire_codec
+        self.peer_codecs: dict[str, str] = {}
+        # Delta compression. As the leader we remember the snapshots we sent and the
+        # last one each peer acknowledged, as a follower the ones each leader sent us
+        self.use_deltas = use_deltas
+        self.sent_snapshots: dict[int, GameState] = {}
+        self.acked_seqs: dict[str, int] = {}
+        self.received_snapshots: dict[str, dict[int, GameState]] = {}
+        # One multiplexed socket per peer carrying the input, game and health channels
+        self.peer_sockets: dict[str, Union[socket.socket, mock_socket.socket]] = {}
+        # Sockets can be written to from several threads, so each gets a lock
+        self.send_locks: dict[Union[socket.socket, mock_socket.socket], Lock] = {}
+        # With the "udp" transport, input and game traffic skip the stream sockets
+        self.transport = transport
+        self.udp: Union[UdpTransport, None] = None
+        # The newest snapshot seq each peer has sent us, to drop stale ones
+        self.latest_seqs: dict[str, int] = {}
+        # Outbound queues, so broadcasting never waits on a peer's socket
+        self.queued_sends = queued_sends
+        self.senders_lock = Lock()
+        self.senders: dict[str, PeerSender] = {}
 
     def register_connection(
-        self, conn: Union[socket.socket, mock_socket.socket], req: CommsRequest, to: str
+        self,
+        conn: Union[socket.socket, mock_socket.socket],
+        req: CommsRequest,
+        to: str,
+        reader: Union[FrameReader, None] = None,
     ):
         """
         Once we have established a connection, handle the logic of updating
-        the correct socket on this class to use it in the future
+        the correct socket on this class to use it in the future. The reader
+        used for the handshake is handed on so no buffered bytes are lost
         """
         self.reconnect_map[to] = req.info
-        if req.comms_type == "input":
+        if req.comms_type in ["peer", "input", "game"]:
+            self.peer_codecs[to] = req.codec
+        if req.comms_type == "peer":
+            old = self.peer_sockets.get(to)
+            self.peer_sockets[to] = conn
+            if old is not conn:
+                consume_thread = Thread(target=self.consume_peer, args=(to, reader))
+                consume_thread.start()
+            if old != None and old is not conn:
+                # They reconnected, the old socket's reader will notice and quit
+                self.revive(to)
+                try:
+                    old.close()
+                except Exception:
+                    pass
+        elif req.comms_type == "input":
             existed = to in self.input_sockets
             self.input_sockets[to] = conn
             if not existed:
-                consume_thread = Thread(target=self.consume_input, args=(to,))
+                consume_thread = Thread(target=self.consume_input, args=(to, reader))
                 consume_thread.start()
         elif req.comms_type == "game":
             existed = to in self.game_sockets
             self.game_sockets[to] = conn
             if not existed:
-                consume_thread = Thread(target=self.consume_game_state, args=(to,))
+                consume_thread = Thread(
+                    target=self.consume_game_state, args=(to, reader)
+                )
                 consume_thread.start()
         elif req.comms_type == "watcher":
             self.watcher_sock = conn
@@ -94,6 +235,42 @@ class ConnectionManager:
             self.health_sockets[to] = conn
         else:
             raise errors.UnknownComms(req.comms_type)
+        self.check_ready()
+
+    def ready_peers(self) -> list[str]:
+        """
+        The peers we have every channel to. Older peers open a socket per channel
+        and only count once all three are up
+        """
+        legacy = set(self.input_sockets) & set(self.game_sockets)
+        return sorted(set(self.peer_sockets) | (legacy & set(self.health_sockets)))
+
+    def check_ready(self):
+        if len(self.ready_peers()) >= self.expected_peers:
+            self.mesh_ready.set()
+
+    def wait_for_mesh(self, timeout: float = READY_TIMEOUT) -> bool:
+        """
+        Blocks until we're connected to every peer, returning True as soon as we
+        are. After timeout seconds we give up waiting and carry on with whoever
+        made it, letting on_partial_mesh know who that is, and return False
+        """
+        self.check_ready()
+        if self.mesh_ready.wait(timeout):
+            self.started_at = time.monotonic()
+            return True
+        ready = self.ready_peers()
+        print_error(
+            f"ERROR: Only {len(ready)} of {self.expected_peers} peers connected"
+        )
+        # Peers that only got some of their channels up aren't coming
+        for name in set(self.input_sockets) | set(self.game_sockets):
+            if name not in ready:
+                self.mark_dead(name)
+        self.started_at = time.monotonic()
+        if self.on_partial_mesh != None:
+            self.on_partial_mesh(ready)
+        return False
 
     def listen(self, isock: Union[mock_socket.socket, None] = None):
         """
@@ -113,8 +290,10 @@ class ConnectionManager:
             try:
                 conn, addr = sock.accept()
                 # FIRST: Receive the request from the other player
-                data = conn.recv(2048)
-                if not data or len(data) == 0:
+                reader = FrameReader(conn)
+                try:
+                    data = reader.recv()
+                except errors.CommsDied:
                     print_error("ERROR: Can't get comms req")
                     conn.close()
                     continue
@@ -122,13 +301,14 @@ class ConnectionManager:
                 if type(req) != CommsRequest:
                     # The first thing they send must be a comms request
                     resp = CommsResponse(self.identity.name, False)
-                    conn.send(resp.encode())
+                    send_frame(conn, resp.encode())
                     conn.close()
                     continue
-                # THEN: If all is good register the connection and send response
-                self.register_connection(conn, req, req.name)
+                # THEN: If all is good send the response and register the connection.
+                # Responding first makes sure nothing we broadcast can beat it there
                 resp = CommsResponse(self.identity.name, True)
-                conn.send(resp.encode())
+                send_frame(conn, resp.encode())
+                self.register_connection(conn, req, req.name, reader)
             except socket.timeout:
                 # Have the listen thread stop every 5 seconds to check that
                 # the connection manager is still alive
@@ -144,66 +324,257 @@ class ConnectionManager:
         info: list[str | int],
         req: CommsRequest,
         isock: Union[mock_socket.socket, None] = None,
-    ):
-        connected = False
-        while not connected and self.alive:
+        deadline: Union[float, None] = None,
+    ) -> Union[str, None]:
+        """
+        Keeps dialling a machine until it answers, backing off between attempts,
+        and returns its name. Gives up at deadline (a time.monotonic() value) and
+        returns None if it never answered
+        """
+        attempt = 0
+        while self.alive and (deadline == None or time.monotonic() < deadline):
             try:
-                # FIRST: Connect and send the request
-                if isock == None:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                else:
-                    sock = isock
-                sock.connect((info[0], info[1]))
-                sock.send(req.encode())
-                data = sock.recv(2048)
-                if not data or len(data) == 0:
-                    print_error(f"ERROR: No response from {info}")
-                    time.sleep(0.5 + random.random() * 2)
-                    continue
-                resp = wire_decode(data)
-                if type(resp) != CommsResponse or resp.accepted == False:
-                    print_error(f"ERROR: Invalid response from {info}")
-                    continue
-                # THEN: If all is good register the connection
-                self.register_connection(sock, req, resp.name)
-                connected = True
-                # Remember the connection info in case we need to reconnect later
-                self.reconnect_map[resp.name] = info
+                name = self.dial(info, req, isock)
+                if name != None:
+                    return name
             except errors.InvalidMessage as e:
                 print_error(f"ERROR: Unknown message {e.args}")
+            except (ConnectionRefusedError, socket.timeout):
+                # They probably aren't listening yet
+                pass
             except Exception as e:
-                if e.args[0] == 61:
-                    # Connection refused error
-                    time.sleep(0.5 + random.random() * 2)
-                    continue
                 print_error(f"ERROR: Connect thread died without connecting {e.args}")
-                break
+                return None
+            delay = backoff_delay(attempt)
+            if deadline != None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            attempt += 1
+        return None
 
-    def initialize(self):
+    def connect_all(
+        self,
+        targets: list[tuple[list[str | int], CommsRequest]],
+        timeout: float = CONNECT_DEADLINE,
+        until: Union[threading.Event, None] = None,
+    ) -> list[Union[str, None]]:
         """
-        Initializes all the sockets/listeners that will be needed
+        Dials every (info, req) at once, so one slow or missing machine doesn't
+        hold up the rest, and waits at most timeout seconds for all of them, or
+        until the until event is set. Returns who answered at each target, None
+        where nobody did (yet)
+        """
+        deadline = time.monotonic() + timeout
+        names: list[Union[str, None]] = [None] * len(targets)
+        dialled = threading.Event()
+        remaining = [len(targets)]
+        remaining_lock = Lock()
+
+        def dial_target(ix: int):
+            (info, req) = targets[ix]
+            try:
+                names[ix] = self.connect(info, req, deadline=deadline)
+            finally:
+                with remaining_lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        dialled.set()
+
+        if len(targets) == 0:
+            dialled.set()
+        for ix in range(len(targets)):
+            Thread(target=dial_target, args=(ix,), daemon=True).start()
+        wait_for_either(dialled, until, deadline)
+        return list(names)
+
+    def connect_watcher(self):
+        """
+        Dials the watcher and remembers whether it answered. It's fine to play
+        without one, so nothing waits on this
         """
-        # First connect to the watcher
-        watch_req = CommsRequest(
+        info: list[str | int] = [WATCHER_IP, WATCHER_PORT]
+        req = CommsRequest(
             self.identity.name, [self.identity.host_ip, self.identity.port], "watcher"
         )
-        self.connect([WATCHER_IP, WATCHER_PORT], watch_req)
-        # Then set up our connection listener
+        name = self.connect(info, req, deadline=time.monotonic() + CONNECT_DEADLINE)
+        self.report_links([(info, req)], [name])
+
+    def dial(
+        self,
+        info: list[str | int],
+        req: CommsRequest,
+        isock: Union[mock_socket.socket, None] = None,
+    ) -> Union[str, None]:
+        """
+        One attempt at connecting to a machine and registering the connection,
+        returning the name of whoever answered, or None if it didn't work. The
+        attempt gives up after CONNECT_ATTEMPT_TIMEOUT
+        """
+        # FIRST: Connect and send the request
+        if isock == None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            sock = isock
+        sock.settimeout(CONNECT_ATTEMPT_TIMEOUT)
+        try:
+            sock.connect((info[0], info[1]))
+            send_frame(sock, req.encode())
+            reader = FrameReader(sock)
+            data = reader.recv()
+        except (errors.CommsDied, socket.timeout):
+            print_error(f"ERROR: No response from {info}")
+            sock.close()
+            return None
+        except Exception:
+            sock.close()
+            raise
+        resp = wire_decode(data)
+        if type(resp) != CommsResponse or resp.accepted == False:
+            print_error(f"ERROR: Invalid response from {info}")
+            sock.close()
+            return None
+        # THEN: If all is good register the connection, blocking from now on
+        sock.settimeout(None)
+        self.register_connection(sock, req, resp.name, reader)
+        # Remember the connection info in case we need to reconnect later
+        self.reconnect_map[resp.name] = info
+        return resp.name
+
+    def start_reconnect(self, name: str):
+        """
+        Starts trying to get a lost peer back in the background. Only the side
+        with the lower name dials, so the two of us don't end up with two sockets
+        """
+        if self.should_redial(name):
+            reconnect_thread = Thread(target=self.reconnect, args=(name,), daemon=True)
+            reconnect_thread.start()
+
+    def should_redial(self, name: str) -> bool:
+        """
+        Whether it's on us to redial a lost peer, and nobody already is. If so,
+        they're marked as being redialled
+        """
+        if not self.alive or name not in self.reconnect_map:
+            return False
+        if self.identity.name > name:
+            return False
+        with self.health_lock:
+            if name in self.reconnecting:
+                return False
+            self.reconnecting.add(name)
+        return True
+
+    def reconnect(self, name: str):
+        """
+        Redials a lost peer, backing off exponentially between attempts, until it
+        is back or RECONNECT_GIVE_UP seconds have passed
+        """
+        req = CommsRequest(
+            self.identity.name,
+            [self.identity.host_ip, self.identity.port],
+            "peer",
+            self.wire_codec,
+        )
+        deadline = time.monotonic() + RECONNECT_GIVE_UP
+        attempt = 0
+        try:
+            while self.alive and time.monotonic() < deadline:
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                if self.health_map.get(name) != DEAD:
+                    # They came back some other way
+                    return
+                try:
+                    if self.dial(self.reconnect_map[name], req):
+                        print_success(f"Reconnected to {name}")
+                        return
+                except Exception:
+                    continue
+            print_error(f"ERROR: Gave up reconnecting to {name}")
+        finally:
+            with self.health_lock:
+                self.reconnecting.discard(name)
+
+    def revive(self, name: str):
+        """
+        Welcomes back a peer that reconnected. Deltas either way would be against
+        snapshots the other side may never have got, so everything starts over
+        from a full game state
+        """
+        self.health_map[name] = ALIVE
+        self.last_heard[name] = time.monotonic()
+        self.acked_seqs.pop(name, None)
+        self.received_snapshots.pop(name, None)
+        self.latest_seqs.pop(name, None)
+
+    def initialize(self):
+        """
+        Initializes all the sockets/listeners that will be needed
+        """
+        # First set up our connection listener, so peers dialling us get through
         listen_thread = Thread(target=self.listen)
         listen_thread.start()
-        # Next connect to our peers
-        for peer in self.identity.connections:
-            # We need 3 connections with each peer
-            for type in ["input", "game", "health"]:
-                req = CommsRequest(
-                    self.identity.name,
-                    [self.identity.host_ip, self.identity.port],
-                    type,
-                )
-                self.connect(peer, req)
-        # Finally, spin until we've heard from everyone
-        while len(self.input_sockets) < NUM_PLAYERS - 1:
-            time.sleep(0.5)
+        if self.transport == "udp":
+            self.start_udp()
+        # Then dial every peer at once, one socket carries every channel to a peer.
+        # The watcher is dialled on the side, since nobody needs it to play
+        started = time.monotonic()
+        self.watcher_thread = Thread(target=self.connect_watcher, daemon=True)
+        self.watcher_thread.start()
+        peer_req = CommsRequest(
+            self.identity.name,
+            [self.identity.host_ip, self.identity.port],
+            "peer",
+            self.wire_codec,
+        )
+        targets = [(peer, peer_req) for peer in self.identity.connections]
+        names = self.connect_all(targets, until=self.mesh_ready)
+        self.report_links(targets, names)
+        # Finally, wait until we've heard from everyone
+        self.wait_for_mesh(max(0.0, READY_TIMEOUT - (time.monotonic() - started)))
+        self.start_health_checks()
+
+    def report_links(
+        self,
+        targets: list[tuple[list[str | int], CommsRequest]],
+        names: list[Union[str, None]],
+    ):
+        """
+        Remembers and prints which of the machines we dialled answered
+        """
+        for (info, req), name in zip(targets, names):
+            address = f"{info[0]}:{info[1]}"
+            self.links[address] = name
+            if name != None:
+                print_success(f"Connected to {name} ({req.comms_type}) at {address}")
+            else:
+                print_error(f"ERROR: No {req.comms_type} link to {address}")
+
+    def start_health_checks(self):
+        ping_thread = Thread(target=self.ping_loop, daemon=True)
+        ping_thread.start()
+
+    def ping_loop(self):
+        """
+        A thread that pings every peer a few times a second, so we always know how
+        far away they are
+        """
+        pings = 0
+        while self.alive:
+            # Every so often, tell everyone what we measured too
+            report = (
+                RttReport(self.own_rtts()) if pings % PINGS_PER_REPORT == 0 else None
+            )
+            for name in self.peers_on("health"):
+                try:
+                    ping = self.tracker_for(name).ping()
+                    self.send_to(name, "health", ping.encode())
+                    if report != None:
+                        self.send_to(name, "health", report.encode())
+                except Exception as e:
+                    print_error(f"ERROR: Couldn't ping {name} {e.args}")
+            pings += 1
+            time.sleep(PING_INTERVAL)
 
     def log_event(self, event: Event):
         """
@@ -214,68 +585,457 @@ class ConnectionManager:
                 self.watcher_ticks["input"] + random.randint(0, 2)
             ) % TICKS_PER_WATCH
             if self.watcher_ticks["input"] <= 2:
-                self.watcher_sock.send(event.encode())
+                self.send_watcher(event.encode())
         if event.event_type == "game":
             self.watcher_ticks["game"] = (
                 self.watcher_ticks["game"] + random.randint(0, 2)
             ) % TICKS_PER_WATCH
             if self.watcher_ticks["game"] <= 2:
-                self.watcher_sock.send(event.encode())
+                self.send_watcher(event.encode())
+
+    def send_watcher(self, payload: bytes):
+        """
+        Sends a message to the watcher, if we have one
+        """
+        if self.watcher_sock == None:
+            return
+        send_frame(self.watcher_sock, payload)
 
-    def consume_input(self, name):
+    def consume_input(self, name, reader: Union[FrameReader, None] = None):
         """
         A thread that continuously watches for input updates from a connection
         """
         conn = self.input_sockets[name]
+        reader = reader if reader != None else FrameReader(conn)
         while self.alive:
             try:
-                msg = conn.recv(2048)
-                if not msg or len(msg) <= 0:
-                    raise errors.CommsDied(f"Died consuming input from {name}")
-                wired = wire_decode(msg)
-                if type(wired) != InputState:
-                    raise errors.InvalidMessage(msg.decode())
-                self.input_map[name] = wired
+                self.handle_input(name, reader.recv())
             except errors.InvalidMessage:
                 continue
             except errors.CommsDied:
+                self.mark_dead(name)
                 break
             except Exception as e:
                 print_error(f"ERROR: consume_input died for unknown reason {e.args}")
                 break
         conn.close()
 
-    def consume_game_state(self, name):
+    def consume_game_state(self, name, reader: Union[FrameReader, None] = None):
         """
         A thread that continuously watches for game updates
         """
         conn = self.game_sockets[name]
+        reader = reader if reader != None else FrameReader(conn)
         while self.alive:
             try:
-                msg = conn.recv(2048)
-                if not msg or len(msg) <= 0:
-                    raise errors.CommsDied(f"Died consuming state from {name}")
+                msg = reader.recv()
                 # if random.random() < SIMULATED_DROP:
                 #    continue
                 # time.sleep(random.random() * SIMULATED_LAG + SIMULATED_LAG / 2)
-                state = wire_decode(msg)
-                if type(state) != GameState:
-                    raise errors.InvalidMessage(msg.decode())
-                with self.leader_lock:
-                    if self.leader != None and state.next_leader[1] < self.leader[1]:
-                        continue
-                    if name == self.need_to_hear_from:
-                        self.need_to_hear_from = None
-                    self.update_game_state(state)
-                    self.leader = state.next_leader
+                self.handle_game_message(name, msg)
             except errors.InvalidMessage:
                 continue
             except errors.CommsDied:
+                self.mark_dead(name)
                 break
             except Exception as e:
                 continue
         conn.close()
 
+    def consume_peer(self, name, reader: Union[FrameReader, None] = None):
+        """
+        A thread that reads everything a peer sends on its multiplexed socket and
+        hands each message to the handler for its channel
+        """
+        conn = self.peer_sockets[name]
+        reader = reader if reader != None else FrameReader(conn)
+        while self.alive:
+            try:
+                channel, msg = untag_channel(reader.recv())
+                self.dispatch(name, channel, msg)
+            except errors.InvalidMessage:
+                continue
+            except errors.CommsDied:
+                # Unless they already reconnected on a new socket
+                if self.peer_sockets.get(name) is conn:
+                    self.mark_dead(name)
+                break
+            except Exception as e:
+                print_error(f"ERROR: consume_peer died for unknown reason {e.args}")
+                break
+        conn.close()
+
+    def dispatch(self, name: str, channel: str, msg: bytes):
+        """
+        Hands a message from a peer to the handler for the channel it arrived on
+        """
+        # Anything at all counts as a heartbeat
+        self.last_heard[name] = time.monotonic()
+        if channel == "input":
+            self.handle_input(name, msg)
+        elif channel == "game":
+            self.handle_game_message(name, msg)
+        elif channel == "health":
+            self.handle_health(name, msg)
+
+    def handle_input(self, name: str, msg: bytes):
+        """
+        Takes an input update from a peer. Retransmitted datagrams can arrive
+        after newer inputs, so anything numbered at or below the input we already
+        have is stale. Unnumbered (seq 0) inputs are always taken
+        """
+        wired = codec.decode(msg)
+        if type(wired) != InputState:
+            raise errors.InvalidMessage(str(msg))
+        with self.input_map_lock:
+            current = self.input_map.get(name)
+            if current != None and wired.seq != 0 and wired.seq <= current.seq:
+                return
+            self.input_map[name] = wired
+
+    def handle_game_message(self, name: str, msg: bytes):
+        """
+        Takes a game state (or delta, or ack of one we sent) from a peer
+        """
+        wired = codec.decode(msg)
+        if type(wired) == SnapshotAck:
+            self.handle_ack(name, wired)
+            return
+        if type(wired) == GameStateDelta:
+            state = self.resolve_delta(name, wired)
+            if state == None:
+                return
+        elif type(wired) == GameState:
+            state = wired
+        else:
+            raise errors.InvalidMessage(str(msg))
+        if self.use_deltas:
+            self.remember_received(name, state)
+        with self.leader_lock:
+            if self.leader != None and outranks(self.leader, state.next_leader):
+                return
+            if state.seq < self.latest_seqs.get(name, -1):
+                # Datagrams can arrive out of order, and a newer state already did
+                return
+            self.latest_seqs[name] = state.seq
+            if name == self.need_to_hear_from:
+                self.need_to_hear_from = None
+            self.update_game_state(state)
+            self.leader = state.next_leader
+
+    def handle_health(self, name: str, msg: bytes):
+        """
+        Takes a health check from a peer. Pings are echoed straight back as pongs,
+        and pongs time the round trip of a ping we sent
+        """
+        wired = wire_decode(msg)
+        if type(wired) == RttReport:
+            with self.health_lock:
+                self.rtt_reports[name] = wired.rtts
+            return
+        if type(wired) != Ping:
+            raise errors.InvalidMessage(str(msg))
+        if wired.pong:
+            self.tracker_for(name).pong(wired)
+        else:
+            pong = Ping(wired.seq, wired.sent, True)
+            self.send_to(name, "health", pong.encode())
+
+    def update_health(self):
+        """
+        Suspects peers we haven't heard from in SUSPECT_AFTER seconds, and gives
+        up on them after DEAD_AFTER. Hearing from a suspect clears it, but the
+        dead stay dead
+        """
+        now = time.monotonic()
+        for name in self.peer_names():
+            if self.health_map.get(name) == DEAD:
+                continue
+            # The clock starts when we first look, not when the game started
+            quiet = now - self.last_heard.setdefault(name, now)
+            if quiet > DEAD_AFTER:
+                self.mark_dead(name)
+            elif quiet > SUSPECT_AFTER:
+                self.health_map[name] = SUS
+            else:
+                self.health_map[name] = ALIVE
+
+    def suspect(self, name: str):
+        """
+        Marks a peer we can't keep up with as SUS. Hearing from them clears it
+        """
+        if self.health_map.get(name) != DEAD:
+            self.health_map[name] = SUS
+
+    def mark_dead(self, name: str):
+        """
+        Stops sending to a peer and forgets what they were pressing, so their
+        player stands still instead of running in a straight line forever. Then
+        tries to get them back
+        """
+        if self.alive and self.health_map.get(name) != DEAD:
+            print_error(f"Lost contact with {name}")
+        self.health_map[name] = DEAD
+        with self.input_map_lock:
+            if name in self.input_map:
+                self.input_map[name] = InputState()
+        self.start_reconnect(name)
+
+    def check_leader(self, game_state: GameState) -> bool:
+        """
+        If the leader has died, takes over leadership for whoever should lead
+        next, returning whether it did. Every survivor works out the same leader
+        from the same snapshot, and bumps the logical clock past the dead one's,
+        so the new leader's states win over anything still in flight. The
+        snapshot itself is left alone, see stamp_leader.
+        Nobody having claimed the game DEAD_AFTER seconds after starting up
+        counts too: the negotiator's leader never made it into the mesh
+        """
+        self.update_health()
+        with self.leader_lock:
+            leader = self.leader
+            if leader == None:
+                if (
+                    self.started_at == None
+                    or time.monotonic() - self.started_at <= DEAD_AFTER
+                ):
+                    return False
+            elif leader[0] == self.identity.name:
+                return False
+            elif self.health_map.get(leader[0]) != DEAD:
+                return False
+            survivors = [
+                player
+                for player in game_state.players
+                if (leader == None or player.id != leader[0])
+                and (
+                    player.id == self.identity.name
+                    or self.health_map.get(player.id, ALIVE) != DEAD
+                )
+            ]
+            if len(survivors) == 0:
+                return False
+            chosen = min(survivors, key=lambda player: (player.score, player.id)).id
+            clock = max(leader[1] if leader != None else 0, game_state.next_leader[1])
+            self.leader = (chosen, clock + 1)
+            # Keep telling everyone until the new leader picks it up, in case they
+            # can still hear the old one
+            self.need_to_hear_from = chosen if chosen != self.identity.name else None
+        if leader == None:
+            print_error(f"Nobody is leading, {chosen} takes over")
+        else:
+            print_error(f"{leader[0]} died, {chosen} takes over")
+        return True
+
+    def stamp_leader(self, game_state: GameState) -> GameState:
+        """
+        The state to send on, naming the leader we know of if it outranks the
+        one the state names (we took over from a dead leader since it was made).
+        Published states are never changed, so this makes a new one if needed
+        """
+        leader = self.leader
+        if leader == None or not outranks(leader, game_state.next_leader):
+            return game_state
+        stamped = copy.copy(game_state)
+        stamped.next_leader = leader
+        return stamped
+
+    def tracker_for(self, name: str) -> HealthTracker:
+        with self.health_lock:
+            if name not in self.health:
+                self.health[name] = HealthTracker()
+            return self.health[name]
+
+    def rtt_to(self, name: str) -> Union[float, None]:
+        """
+        The smoothed round trip time to a peer in seconds, None until we know it
+        """
+        with self.health_lock:
+            tracker = self.health.get(name)
+        return tracker.srtt if tracker != None else None
+
+    def own_rtts(self) -> dict[str, float]:
+        """
+        The round trip times we've measured, to the peers we have one for
+        """
+        with self.health_lock:
+            trackers = list(self.health.items())
+        return {
+            name: tracker.srtt for name, tracker in trackers if tracker.srtt != None
+        }
+
+    def rtt_matrix(self) -> dict[str, dict[str, float]]:
+        """
+        Every round trip time we know of, including the ones our peers measured.
+        matrix[a][b] is the time a measured to b
+        """
+        own = self.own_rtts()
+        with self.health_lock:
+            matrix = {name: dict(rtts) for name, rtts in self.rtt_reports.items()}
+        matrix[self.identity.name] = own
+        return matrix
+
+    def health_stats(self) -> dict[str, dict[str, Union[float, None]]]:
+        """
+        The round trip time, jitter (both in seconds) and loss to each peer
+        """
+        with self.health_lock:
+            trackers = list(self.health.items())
+        return {name: tracker.stats() for name, tracker in trackers}
+
+    def handle_ack(self, name: str, ack: SnapshotAck):
+        """
+        Records the last snapshot a peer has applied, so we can send deltas against it
+        """
+        if ack.seq < 0:
+            # They lost track, so the next thing they get will be a keyframe
+            self.acked_seqs.pop(name, None)
+        else:
+            self.acked_seqs[name] = ack.seq
+
+    def resolve_delta(self, name: str, delta: GameStateDelta) -> Union[GameState, None]:
+        """
+        Rebuilds the full game state from a delta. If we no longer have the snapshot
+        it was computed against we ask the sender for a keyframe instead.
+        """
+        base = self.received_snapshots.get(name, {}).get(delta.base_seq)
+        if base == None:
+            self.send_to(name, "game", self.encode_for(name, SnapshotAck(-1)))
+            return None
+        return delta.apply(base)
+
+    def remember_received(self, name: str, state: GameState):
+        """
+        Keeps a copy of a snapshot from a peer as a base for their future deltas,
+        and lets them know we have it
+        """
+        history = self.received_snapshots.setdefault(name, {})
+        history[state.seq] = state.copy()
+        for seq in [seq for seq in history if seq <= state.seq - SNAPSHOT_HISTORY]:
+            del history[seq]
+        self.send_to(name, "game", self.encode_for(name, SnapshotAck(state.seq)))
+
+    def snapshot_for(self, name: str, game_state: GameState) -> Wireable:
+        """
+        Picks what to send a peer: a delta against the last snapshot they acknowledged,
+        or the full state if they haven't acknowledged one we still remember or it is
+        time for a periodic keyframe
+        """
+        if not self.use_deltas or game_state.seq % KEYFRAME_INTERVAL == 0:
+            return game_state
+        base = self.sent_snapshots.get(self.acked_seqs.get(name, -1))
+        if base == None:
+            return game_state
+        return GameStateDelta.between(base, game_state, name)
+
+    def peer_names(self) -> list[str]:
+        """
+        The names of every peer we have a connection to
+        """
+        return sorted(set(self.peer_sockets) | set(self.input_sockets))
+
+    def peers_on(self, channel: str) -> list[str]:
+        """
+        The names of the peers we can reach on a given channel, leaving out the dead
+        """
+        legacy = {
+            "input": self.input_sockets,
+            "game": self.game_sockets,
+            "health": self.health_sockets,
+        }[channel]
+        return sorted(
+            name
+            for name in set(self.peer_sockets) | set(legacy)
+            if self.health_map.get(name) != DEAD
+        )
+
+    def send_to(
+        self,
+        name: str,
+        channel: str,
+        payload: bytes,
+        reliable: bool = True,
+        coalesce: bool = False,
+    ):
+        """
+        Sends a message to a peer on the given channel. With queued sends this only
+        puts it on the peer's outbound queue, where it replaces any unsent message
+        also sent with coalesce
+        """
+        if not self.queued_sends:
+            self.send_now(name, channel, payload, reliable)
+            return
+        with self.senders_lock:
+            if name not in self.senders:
+                self.senders[name] = PeerSender(
+                    name,
+                    lambda channel, payload, reliable: self.send_now(
+                        name, channel, payload, reliable
+                    ),
+                    on_full=lambda: self.suspect(name),
+                )
+                self.senders[name].start()
+            sender = self.senders[name]
+        sender.put(channel, payload, reliable, coalesce)
+
+    def queue_depths(self) -> dict[str, int]:
+        """
+        How many messages are waiting to go out to each peer
+        """
+        with self.senders_lock:
+            return {name: sender.depth() for name, sender in self.senders.items()}
+
+    def send_now(self, name: str, channel: str, payload: bytes, reliable: bool = True):
+        """
+        Writes a message to a peer on the given channel, using their multiplexed
+        socket if they have one and the dedicated socket for the channel if not.
+        With the udp transport, input and game messages go out as datagrams and
+        only the reliable ones are retransmitted until acked
+        """
+        if self.udp != None and channel != "health" and name in self.reconnect_map:
+            info = self.reconnect_map[name]
+            self.udp.send((info[0], info[1]), channel, payload, reliable)
+            return
+        if name in self.peer_sockets:
+            sock = self.peer_sockets[name]
+            payload = tag_channel(channel, payload)
+        elif channel == "input":
+            sock = self.input_sockets[name]
+        elif channel == "game":
+            sock = self.game_sockets[name]
+        else:
+            sock = self.health_sockets[name]
+        with self.send_locks.setdefault(sock, Lock()):
+            send_frame(sock, payload)
+
+    def start_udp(self, isock: Union[mock_socket.socket, None] = None):
+        """
+        Starts sending and receiving input and game traffic as datagrams on the
+        same port number we listen on
+        NOTE: sock parameter only for unit testing
+        """
+        self.udp = UdpTransport(
+            self.identity.host_ip, self.identity.port, self.on_datagram, isock
+        )
+        self.udp.start()
+
+    def on_datagram(self, addr: tuple, channel: str, payload: bytes):
+        """
+        Hands a datagram to the right handler, based on which peer sent it
+        """
+        name = None
+        for peer, info in list(self.reconnect_map.items()):
+            if (info[0], info[1]) == (addr[0], addr[1]):
+                name = peer
+        if name == None:
+            return
+        try:
+            self.dispatch(name, channel, payload)
+        except errors.InvalidMessage:
+            pass
+        except Exception as e:
+            print_error(f"ERROR: Couldn't handle datagram from {name} {e.args}")
+
     def is_leader(self):
         """
         Helper function that makes leader-dependent actions more readable
@@ -289,45 +1049,80 @@ class ConnectionManager:
         """
         return self.need_to_hear_from != None
 
-    def broadcast_input(self, input_state: InputState):
+    def encode_for(self, name: str, msg: Wireable) -> bytes:
+        """
+        Encodes a message using the codec agreed on with the given peer
+        """
+        return codec.get_codec(self.peer_codecs.get(name, "text")).encode(msg)
+
+    def broadcast_input(self, input_state: InputState, limit: bool = True):
         """
-        Broadcasts this machine's input state to all other machines in the system
+        Broadcasts this machine's input state to all other machines in the system.
+        Callers that already send once a tick can skip the rate limit
         """
         with self.input_map_lock:
             diff = 1.0 / FPS
-            if time.time() - self.last_inp_broadcast < diff:
+            if limit and time.time() - self.last_inp_broadcast < diff:
                 return
             self.last_inp_broadcast = time.time()
             event = Event("input", self.identity.name, "delta")
             self.input_map[self.identity.name] = input_state
-            for name in self.input_sockets:
-                self.input_sockets[name].send(
-                    self.input_map[self.identity.name].encode()
+            for name in self.peers_on("input"):
+                self.send_to(
+                    name,
+                    "input",
+                    self.encode_for(name, self.input_map[self.identity.name]),
                 )
                 event.sink = name
                 self.log_event(event)
 
     def broadcast_game_state(self, game_state: GameState):
         """
-        Assumes that the leader lock is already held
         Called when this identity is the leader OR the are waiting to hear
-        back from the new leader
-        """
-        if self.is_leader() and game_state.next_leader[0] != self.identity.name:
-            # A change is coming
-            self.need_to_hear_from = game_state.next_leader[0]
-        self.leader = game_state.next_leader
-        for name in self.game_sockets:
-            self.game_sockets[name].sendall(game_state.encode())
+        back from the new leader. game_state must not change afterwards
+        """
+        with self.leader_lock:
+            if self.is_leader() and game_state.next_leader[0] != self.identity.name:
+                # A change is coming
+                self.need_to_hear_from = game_state.next_leader[0]
+            # States that hand leadership over must arrive, the rest are
+            # superseded soon
+            handoff = self.leader != game_state.next_leader
+            # A newer claim may have landed since this state was simulated
+            if self.leader == None or not outranks(self.leader, game_state.next_leader):
+                self.leader = game_state.next_leader
+        for name in self.peers_on("game"):
+            msg = self.snapshot_for(name, game_state)
+            self.send_to(
+                name,
+                "game",
+                self.encode_for(name, msg),
+                reliable=handoff,
+                coalesce=True,
+            )
             self.log_event(Event("game", self.identity.name, name))
+        if self.use_deltas:
+            self.sent_snapshots[game_state.seq] = game_state.copy()
+            for seq in [
+                seq
+                for seq in self.sent_snapshots
+                if seq <= game_state.seq - SNAPSHOT_HISTORY
+            ]:
+                del self.sent_snapshots[seq]
 
     def kill(self):
         """
         Kills the connection manager
         """
         self.alive = False
+        if self.udp != None:
+            self.udp.close()
+        with self.senders_lock:
+            for sender in self.senders.values():
+                sender.stop()
         for sock in (
-            list(self.input_sockets.values())
+            list(self.peer_sockets.values())
+            + list(self.input_sockets.values())
             + list(self.game_sockets.values())
             + list(self.health_sockets.values())
             + [self.watcher_sock]
@@ -2,26 +2,142 @@ import sys
 
 sys.path.append("..")
 
+import asyncio
+import math
 import socket
-from schema import ConnectRequest, ConnectResponse, Machine, wire_decode
-from connections.consts import NEGOTIATOR_IP, NEGOTIATOR_PORT
+import time
+import random
+import errors
+from schema import ConnectRequest, ConnectResponse, Machine, Ping, wire_decode
+from connections.consts import (
+    NEGOTIATOR_IP,
+    NEGOTIATOR_PORT,
+    WATCHER_PORT,
+    SERVER_MODE,
+    FIRST_GAME_PORT,
+    GAME_PORT_RANGE,
+    HANDSHAKE_TIMEOUT,
+    PROBE_COUNT,
+    PROBE_TIMEOUT,
+    MATCH_TARGET_RTT,
+    MAX_MATCH_WAIT,
+    MATCH_INTERVAL,
+)
 from game.consts import NUM_PLAYERS
-from utils import print_success
+from utils import print_info, print_success
+from connections.framing import FrameReader, frame, read_frame, send_frame
 from tests.mocks.mock_socket import socket as mock_socket
-from typing import Union
+from typing import Any, Callable, Union
 
 
-class Negotiator:
+class Lobby:
+    """
+    The machines waiting for one game to start. Each one is given a port to listen
+    on and the addresses of everyone who joined before it to connect to, so the
+    lobby ends up fully connected with every pair connecting exactly once
+    """
+
+    def __init__(
+        self,
+        expect_server: bool = SERVER_MODE,
+        size: int = NUM_PLAYERS,
+        next_port: Union[Callable[[], int], None] = None,
+    ):
+        self.machines: list[Machine] = []
+        # Whatever we use to talk to each machine until the game starts, by name
+        self.conns: dict[str, Any] = {}
+        self.size = size
+        self.port_num = FIRST_GAME_PORT
+        self.next_port = next_port if next_port != None else self.take_port
+        # With a dedicated server, the lobby also waits for it and it leads
+        self.expect_server = expect_server
+        self.server: Union[str, None] = None
+
+    def take_port(self) -> int:
+        self.port_num += 1
+        return self.port_num - 1
+
+    def players(self) -> int:
+        return len(self.machines) - (0 if self.server == None else 1)
+
+    def is_full(self) -> bool:
+        return self.players() >= self.size and (
+            not self.expect_server or self.server != None
+        )
+
+    def accepts(self, req: ConnectRequest) -> bool:
+        """
+        Whether there is still a place in the lobby for this request
+        """
+        if any(mach.name == req.name for mach in self.machines):
+            return False
+        if req.role == "server":
+            return self.expect_server and self.server == None
+        return req.role == "player" and self.players() < self.size
+
+    def join(self, req: ConnectRequest, host_ip: str, conn: Any = None) -> Machine:
+        """
+        Gives an accepted request its place in the lobby
+        """
+        new_mach = Machine(
+            name=req.name,
+            host_ip=host_ip,
+            port=self.next_port(),
+            connections=[
+                [exist_mach.host_ip, exist_mach.port] for exist_mach in self.machines
+            ],
+        )
+        self.machines.append(new_mach)
+        self.conns[req.name] = conn
+        if req.role == "server":
+            self.server = req.name
+        return new_mach
+
+    def leave(self, name: str):
+        """
+        Takes someone who gave up waiting out of the lobby. Everyone who joined
+        after them no longer connects to them
+        """
+        self.machines = [mach for mach in self.machines if mach.name != name]
+        self.conns.pop(name, None)
+        if name == self.server:
+            self.server = None
+        for mx, mach in enumerate(self.machines):
+            mach.connections = [
+                [exist_mach.host_ip, exist_mach.port]
+                for exist_mach in self.machines[:mx]
+            ]
+
+    def is_leader(self, name: str) -> bool:
+        """
+        The server leads if there is one, otherwise the first player does
+        """
+        if self.expect_server:
+            return name == self.server
+        return len(self.machines) > 0 and self.machines[0].name == name
+
+    def identities(self) -> list[Machine]:
+        """
+        Everyone's final identity, once the lobby is full
+        """
+        for mach in self.machines:
+            if self.server != None:
+                mach.server = self.server
+        return self.machines
+
+
+class Negotiator(Lobby):
     """
     The negotiator is the driver for a program that exists just to help players
     connect to each other before the game begins. Once the game starts, the central
-    negotiator is not needed since this is a peer-to-peer architecture
+    negotiator is not needed since this is a peer-to-peer architecture. This one
+    handles a single lobby, one client at a time, and exits once it is full (see
+    AsyncNegotiator for the long running service)
     """
 
-    def __init__(self):
-        self.machines: list[Machine] = []
-        self.socket_map: dict[str, Union[socket.socket, mock_socket]] = {}
-        self.port_num = 50000
+    def __init__(self, expect_server: bool = SERVER_MODE, size: int = NUM_PLAYERS):
+        super().__init__(expect_server, size)
+        self.socket_map: dict[str, Union[socket.socket, mock_socket]] = self.conns
 
     def negotiate(self, test_sock: Union[mock_socket, None] = None):
         """
@@ -37,49 +153,349 @@ class Negotiator:
         sock.bind((NEGOTIATOR_IP, NEGOTIATOR_PORT))
         sock.listen()
         try:
-            while len(self.machines) < NUM_PLAYERS:
+            while not self.is_full():
                 conn, addr = sock.accept()
-                data = conn.recv(1024)
-                if not data or len(data) <= 0:
+                try:
+                    data = FrameReader(conn).recv()
+                except errors.CommsDied:
                     continue
                 req = wire_decode(data)
                 if type(req) != ConnectRequest:
                     continue
-                if req.name in self.socket_map:
-                    conn.send(ConnectResponse(False).encode())
+                if not self.accepts(req):
+                    send_frame(conn, ConnectResponse(False).encode())
                     continue
                 print_success(f"{req.name} accepted!")
-                new_mach = Machine(
-                    name=req.name,
-                    host_ip=addr[0],
-                    port=self.port_num,
-                    connections=[
-                        [exist_mach.host_ip, exist_mach.port]
-                        for exist_mach in self.machines
-                    ],
-                )
-                self.port_num += 1
-                self.machines.append(new_mach)
-                self.socket_map[req.name] = conn
+                self.join(req, addr[0], conn)
                 # Let the machine know that it has been connected
-                conn.send(
-                    ConnectResponse(True, is_leader=len(self.machines) == 1).encode()
+                send_frame(
+                    conn, ConnectResponse(True, self.is_leader(req.name)).encode()
                 )
         except Exception as e:
             sock.close()
         # All players have connected, tell them their identity
-        for mach in self.machines:
+        for mach in self.identities():
             conn = self.socket_map[mach.name]
-            conn.send(mach.encode())
+            send_frame(conn, mach.encode())
             conn.close()
 
 
+class Ticket:
+    """
+    Someone waiting in the matchmaking queue, with the negotiator's round trip
+    time to them if they answered its pings
+    """
+
+    def __init__(
+        self,
+        req: ConnectRequest,
+        host_ip: str,
+        writer: Any,
+        ping: Union[float, None],
+        joined: float,
+    ):
+        self.req = req
+        self.host_ip = host_ip
+        self.writer = writer
+        self.ping = ping
+        self.joined = joined
+
+    def rtt_to(self, other: "Ticket") -> float:
+        """
+        The most the round trip time between two clients could be: there and
+        back through the negotiator. Clients that didn't answer could be
+        anywhere, so they count as infinitely far
+        """
+        if self.ping == None or other.ping == None:
+            return math.inf
+        return self.ping + other.ping
+
+
+class AsyncNegotiator:
+    """
+    A long running negotiator that fills any number of lobbies at once. Every
+    client is handled on one asyncio event loop, so a client that is slow to send
+    its request only holds up itself.
+
+    Clients wait in a matchmaking queue rather than filling lobbies in the order
+    they arrive. The negotiator pings each one as it joins, which is all it has
+    to go on: two clients are at most their two pings apart. Whenever a lobby's
+    worth of players are surely within MATCH_TARGET_RTT of each other they are
+    started together. Nobody waits longer than MAX_MATCH_WAIT though: after that, the
+    longest waiting player goes with the closest players there are. A client only
+    hears back once its lobby starts, so someone who gives up waiting can simply
+    be taken out of the queue
+    """
+
+    def __init__(
+        self,
+        expect_server: bool = SERVER_MODE,
+        size: int = NUM_PLAYERS,
+        handshake_timeout: float = HANDSHAKE_TIMEOUT,
+        target_rtt: float = MATCH_TARGET_RTT,
+        max_wait: float = MAX_MATCH_WAIT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.expect_server = expect_server
+        self.size = size
+        self.handshake_timeout = handshake_timeout
+        self.target_rtt = target_rtt
+        self.max_wait = max_wait
+        self.clock = clock
+        # Everyone waiting for a lobby, longest waiting first
+        self.queue: list[Ticket] = []
+        self.lobbies_started = 0
+        self.port_num = FIRST_GAME_PORT
+        self.server: Union[asyncio.AbstractServer, None] = None
+
+    def next_port(self) -> int:
+        """
+        Ports are handed out across every lobby, wrapping around after
+        GAME_PORT_RANGE, since several lobbies may be played on one computer.
+        The ports the negotiator and watcher use are skipped
+        """
+        while True:
+            port = self.port_num
+            self.port_num += 1
+            if self.port_num >= FIRST_GAME_PORT + GAME_PORT_RANGE:
+                self.port_num = FIRST_GAME_PORT
+            if port not in [NEGOTIATOR_PORT, WATCHER_PORT]:
+                return port
+
+    def accepts(self, req: ConnectRequest) -> bool:
+        """
+        Whether the request could ever be put in a lobby
+        """
+        if req.role == "server":
+            return self.expect_server
+        return req.role == "player"
+
+    def group_around(
+        self, seed: Ticket, players: list[Ticket]
+    ) -> Union[tuple[list[Ticket], float], None]:
+        """
+        The seed and the players closest to it, and the worst round trip time
+        between any two of them. Names have to be unique within a lobby
+        """
+        group = [seed]
+        for ticket in sorted(
+            players, key=lambda ticket: (seed.rtt_to(ticket), ticket.joined)
+        ):
+            if len(group) == self.size:
+                break
+            if all(ticket.req.name != member.req.name for member in group):
+                group.append(ticket)
+        if len(group) < self.size:
+            return None
+        worst = max(
+            [a.rtt_to(b) for ax, a in enumerate(group) for b in group[ax + 1 :]],
+            default=0.0,
+        )
+        return (group, worst)
+
+    def next_match(self) -> Union[list[Ticket], None]:
+        """
+        The next lobby to start from the queue, if one should start now
+        """
+        players = [ticket for ticket in self.queue if ticket.req.role == "player"]
+        servers = [ticket for ticket in self.queue if ticket.req.role == "server"]
+        if len(players) == 0 or (self.expect_server and len(servers) == 0):
+            return None
+        overdue = self.clock() - players[0].joined >= self.max_wait
+        # Someone who has waited too long goes with whoever is closest to them
+        seeds = players[:1] if overdue else players
+        groups = [self.group_around(seed, players) for seed in seeds]
+        groups = [group for group in groups if group != None]
+        if len(groups) == 0:
+            return None
+        (group, worst) = min(
+            groups,
+            key=lambda group: (group[1], min(ticket.joined for ticket in group[0])),
+        )
+        if worst > self.target_rtt and not overdue:
+            return None
+        if self.expect_server:
+            server = min(
+                servers,
+                key=lambda server: max(server.rtt_to(player) for player in group),
+            )
+            group = group + [server]
+        return group
+
+    def match(self):
+        """
+        Starts every lobby that should start now
+        """
+        group = self.next_match()
+        while group != None:
+            for ticket in group:
+                self.queue.remove(ticket)
+            lobby = Lobby(self.expect_server, self.size, self.next_port)
+            # The server joins first so it connects to nobody and everyone to it
+            for ticket in sorted(group, key=lambda ticket: ticket.req.role != "server"):
+                lobby.join(ticket.req, ticket.host_ip, ticket.writer)
+            self.start(lobby)
+            group = self.next_match()
+
+    async def keep_matching(self):
+        """
+        Reconsiders the queue every so often, since waiting long enough is
+        reason enough to start a lobby
+        """
+        while True:
+            await asyncio.sleep(MATCH_INTERVAL)
+            self.match()
+
+    async def serve(self, host: str = NEGOTIATOR_IP, port: int = NEGOTIATOR_PORT):
+        """
+        Runs the negotiator until it is cancelled
+        """
+        self.server = await asyncio.start_server(
+            self.on_connection, host, port, reuse_address=True
+        )
+        matching = asyncio.ensure_future(self.keep_matching())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            matching.cancel()
+
+    async def probe(
+        self,
+        stream: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        frames: FrameReader,
+    ) -> Union[float, None]:
+        """
+        Our round trip time to a client, the best of a few pings. None if they
+        don't answer, which older clients won't
+        """
+        best = None
+        for seq in range(PROBE_COUNT):
+            sent = self.clock()
+            writer.write(frame(Ping(seq, sent).encode()))
+            try:
+                pong = wire_decode(
+                    await asyncio.wait_for(read_frame(stream, frames), PROBE_TIMEOUT)
+                )
+            except asyncio.TimeoutError:
+                return best
+            if type(pong) == Ping and pong.pong and pong.seq == seq:
+                rtt = self.clock() - sent
+                best = rtt if best == None else min(best, rtt)
+        return best
+
+    async def on_connection(
+        self, stream: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """
+        Handles one client from their request until their lobby starts
+        """
+        frames = FrameReader()
+        try:
+            data = await asyncio.wait_for(
+                read_frame(stream, frames), self.handshake_timeout
+            )
+            req = wire_decode(data)
+        except (asyncio.TimeoutError, errors.CommsDied, errors.InvalidMessage):
+            writer.close()
+            return
+        if type(req) != ConnectRequest:
+            writer.close()
+            return
+        if not self.accepts(req):
+            writer.write(frame(ConnectResponse(False).encode()))
+            writer.close()
+            return
+        try:
+            rtt = await self.probe(stream, writer, frames)
+        except (errors.CommsDied, errors.InvalidMessage):
+            writer.close()
+            return
+        ticket = Ticket(
+            req, writer.get_extra_info("peername")[0], writer, rtt, self.clock()
+        )
+        self.queue.append(ticket)
+        print_success(f"{req.name} accepted!")
+        self.match()
+        if ticket not in self.queue:
+            return
+        # Nothing else should arrive, so this returns when either side hangs up
+        try:
+            await stream.read()
+        except Exception:
+            pass
+        if ticket in self.queue:
+            print_info(f"{req.name} left before their game started")
+            self.queue.remove(ticket)
+
+    def start(self, lobby: Lobby):
+        """
+        Tells everyone in a full lobby who they are and who to connect to
+        """
+        self.lobbies_started += 1
+        for mach in lobby.identities():
+            writer = lobby.conns[mach.name]
+            writer.write(
+                frame(ConnectResponse(True, lobby.is_leader(mach.name)).encode())
+            )
+            writer.write(frame(mach.encode()))
+            writer.close()
+        print_success(
+            f"Started lobby {self.lobbies_started}: "
+            + ", ".join(mach.name for mach in lobby.machines)
+        )
+
+
+def join_lobby(
+    name: str,
+    role: str = "player",
+    test_sock: Union[socket.socket, mock_socket, None] = None,
+    is_alive: Callable[[], bool] = lambda: True,
+) -> tuple[Machine, bool]:
+    """
+    Connects to the negotiator until it gives us a machine id to play the game,
+    and tells us whether we start as the leader
+    """
+    while is_alive():
+        sock = (
+            test_sock
+            if test_sock != None
+            else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        )
+        try:
+            sock.connect((NEGOTIATOR_IP, NEGOTIATOR_PORT))
+            send_frame(sock, ConnectRequest(name, role).encode())
+            reader = FrameReader(sock)
+            resp = wire_decode(reader.recv())
+            while type(resp) == Ping:
+                # The negotiator is timing how far away we are
+                send_frame(sock, Ping(resp.seq, resp.sent, True).encode())
+                resp = wire_decode(reader.recv())
+            if type(resp) != ConnectResponse:
+                raise Exception("Negotiator did not understand")
+            if not resp.success:
+                raise Exception("Negotiator rejected connection")
+            mach_data = reader.recv()
+            mach = wire_decode(mach_data)
+            if type(mach) != Machine:
+                raise Exception("Negotiator did not send machine data")
+            return (mach, resp.is_leader)
+        except Exception as e:
+            pass
+        time.sleep(random.uniform(0.5, 1.0))
+    raise Exception("Can't negotiate")
+
+
 def create_negotiator():
     """
-    Creates a negotiator and starts it
+    Creates a negotiator and runs it until it is killed
     """
-    negotiator = Negotiator()
-    negotiator.negotiate()
+    negotiator = AsyncNegotiator()
+    try:
+        asyncio.run(negotiator.serve())
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
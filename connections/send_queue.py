@@ -0,0 +1,97 @@
+import sys
+
+sys.path.append("..")
+
+from collections import deque
+from threading import Thread, Condition
+from typing import Callable, Union
+from connections.consts import MAX_QUEUE_DEPTH
+from utils import print_error
+
+
+class PeerSender:
+    """
+    An outbound queue for one peer, drained by its own writer thread, so whoever
+    is broadcasting never waits on a peer's socket. Game states are coalesced: a
+    newer one replaces an older one that hasn't gone out yet, since nobody needs
+    the stale one once the new one exists. Everything else (inputs, pings, acks)
+    is queued in order, up to max_depth messages. Past that the peer isn't
+    keeping up: the oldest message (other than the game state) is dropped and
+    on_full is told.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        write: Callable[[str, bytes, bool], None],
+        max_depth: int = MAX_QUEUE_DEPTH,
+        on_full: Union[Callable[[], None], None] = None,
+    ):
+        self.name = name
+        self.write = write
+        self.max_depth = max_depth
+        self.on_full = on_full
+        # How many messages were dropped because the queue was full
+        self.dropped = 0
+        self.alive = True
+        self.cond = Condition()
+        # Each entry is [channel, payload, reliable, coalesce]
+        self.queue: deque[list] = deque()
+        # How many messages were replaced before they could be sent
+        self.coalesced = 0
+        self.thread = Thread(target=self.drain, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, channel: str, payload: bytes, reliable: bool = True, coalesce=False):
+        """
+        Queues a message. If coalesce is set, an unsent message that was also
+        queued with coalesce is replaced instead of adding a new one
+        """
+        with self.cond:
+            if coalesce:
+                for entry in self.queue:
+                    if entry[3]:
+                        # Keep the stricter delivery so a handoff can't be lost
+                        entry[1] = payload
+                        entry[2] = entry[2] or reliable
+                        self.coalesced += 1
+                        return
+            full = len(self.queue) >= self.max_depth
+            if full:
+                # The one game state waiting is newest by definition, keep it
+                for entry in self.queue:
+                    if not entry[3]:
+                        self.queue.remove(entry)
+                        break
+                self.dropped += 1
+            self.queue.append([channel, payload, reliable, coalesce])
+            self.cond.notify()
+        if full and self.on_full != None:
+            self.on_full()
+
+    def depth(self) -> int:
+        """
+        How many messages are waiting to be written
+        """
+        with self.cond:
+            return len(self.queue)
+
+    def drain(self):
+        while self.alive:
+            with self.cond:
+                while self.alive and len(self.queue) == 0:
+                    self.cond.wait()
+                if not self.alive:
+                    break
+                channel, payload, reliable, _ = self.queue.popleft()
+            try:
+                self.write(channel, payload, reliable)
+            except Exception as e:
+                print_error(f"ERROR: Couldn't send to {self.name} {e.args}")
+
+    def stop(self):
+        with self.cond:
+            self.alive = False
+            self.cond.notify()
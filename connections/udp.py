@@ -0,0 +1,139 @@
+import sys
+
+sys.path.append("..")
+
+import socket
+import struct
+import time
+from threading import Thread, Lock
+from typing import Callable, Union
+from utils import print_error
+from connections.framing import CHANNELS
+import tests.mocks.mock_socket as mock_socket
+
+# Every datagram starts with what kind of packet it is, the channel it is for, and
+# a sequence number used to acknowledge reliable packets
+PACKET = struct.Struct("!BBI")
+UNRELIABLE = 0
+RELIABLE = 1
+ACK = 2
+
+MAX_DATAGRAM = 65507
+# How long to wait for an ack before sending a reliable packet again (seconds)
+RETRANSMIT_INTERVAL = 0.05
+# After this many tries we assume the peer is gone and stop
+MAX_RETRIES = 20
+# How many reliable sequence numbers to remember per peer to drop duplicates
+SEEN_HISTORY = 256
+
+
+class UdpTransport:
+    """
+    Sends and receives datagrams for the ConnectionManager. Game states are sent
+    unreliably since a lost one is superseded 33ms later anyway, so nothing waits
+    on retransmission. Anything that must arrive (inputs, leader handoffs) is sent
+    reliably: it is retransmitted until the receiver acks it, and duplicates are
+    dropped on the receiving side.
+    """
+
+    def __init__(
+        self,
+        host_ip: str,
+        port: int,
+        on_message: Callable[[tuple, str, bytes], None],
+        isock: Union[mock_socket.socket, None] = None,
+    ):
+        self.on_message = on_message
+        self.alive = True
+        if isock == None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.sock = isock
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host_ip, port))
+        self.pending_lock = Lock()
+        # (addr, seq) -> [packet, time last sent, tries]
+        self.pending: dict[tuple, list] = {}
+        self.next_seq: dict[tuple, int] = {}
+        self.seen: dict[tuple, list[int]] = {}
+
+    def start(self):
+        Thread(target=self.receive_loop, daemon=True).start()
+        Thread(target=self.retransmit_loop, daemon=True).start()
+
+    def send(self, addr: tuple, channel: str, payload: bytes, reliable: bool = False):
+        """
+        Sends a message to the given address
+        """
+        if not reliable:
+            packet = PACKET.pack(UNRELIABLE, CHANNELS.index(channel), 0) + payload
+            self.sock.sendto(packet, addr)
+            return
+        with self.pending_lock:
+            seq = self.next_seq.get(addr, 0)
+            self.next_seq[addr] = seq + 1
+            packet = PACKET.pack(RELIABLE, CHANNELS.index(channel), seq) + payload
+            self.pending[(addr, seq)] = [packet, time.time(), 1]
+        self.sock.sendto(packet, addr)
+
+    def handle_packet(self, data: bytes, addr: tuple):
+        """
+        Deals with one datagram we received
+        """
+        if len(data) < PACKET.size:
+            return
+        (kind, channel, seq) = PACKET.unpack_from(data, 0)
+        if kind == ACK:
+            with self.pending_lock:
+                self.pending.pop((addr, seq), None)
+            return
+        if channel >= len(CHANNELS):
+            return
+        if kind == RELIABLE:
+            self.sock.sendto(PACKET.pack(ACK, channel, seq), addr)
+            seen = self.seen.setdefault(addr, [])
+            if seq in seen:
+                # Our ack got lost and they sent it again
+                return
+            seen.append(seq)
+            if len(seen) > SEEN_HISTORY:
+                seen.pop(0)
+        self.on_message(addr, CHANNELS[channel], data[PACKET.size :])
+
+    def resend_pending(self):
+        """
+        Sends every reliable packet that hasn't been acked in time again
+        """
+        now = time.time()
+        with self.pending_lock:
+            for key in list(self.pending.keys()):
+                packet, sent_at, tries = self.pending[key]
+                if now - sent_at < RETRANSMIT_INTERVAL:
+                    continue
+                if tries >= MAX_RETRIES:
+                    del self.pending[key]
+                    continue
+                self.pending[key] = [packet, now, tries + 1]
+                self.sock.sendto(packet, key[0])
+
+    def receive_loop(self):
+        while self.alive:
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM)
+                self.handle_packet(data, addr)
+            except Exception as e:
+                if not self.alive:
+                    break
+                print_error(f"ERROR: UDP receive failed {e.args}")
+
+    def retransmit_loop(self):
+        while self.alive:
+            try:
+                self.resend_pending()
+            except Exception as e:
+                print_error(f"ERROR: UDP retransmit failed {e.args}")
+            time.sleep(RETRANSMIT_INTERVAL / 2)
+
+    def close(self):
+        self.alive = False
+        self.sock.close()
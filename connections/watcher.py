@@ -4,9 +4,12 @@ sys.path.append("..")
 
 import arcade
 import socket
+import errors
 from schema import CommsRequest, CommsResponse, Machine, wire_decode, Event, Vec2
-from connections.consts import WATCHER_IP, WATCHER_PORT
+from connections.consts import WATCHER_IP, WATCHER_PORT, SERVER_MODE
 from utils import print_success
+from connections.framing import FrameReader, send_frame
+from scheduler import FixedTimestep
 from threading import Thread
 from queue import Queue
 from game import consts as gconsts
@@ -18,6 +21,8 @@ class Display(arcade.Window):
         super().__init__(gconsts.SCREEN_WIDTH, gconsts.SCREEN_HEIGHT, "Watcher")
         self.players: dict[str, Vec2] = {}
         self.balls: list[tuple[Vec2, Vec2, str]] = []
+        # Balls move at the same speed however fast arcade manages to draw
+        self.timestep = FixedTimestep()
         arcade.set_background_color((250, 250, 250))
 
     def reset_positions(self):
@@ -39,6 +44,10 @@ class Display(arcade.Window):
         )
 
     def on_update(self, delta_time: float):
+        for _ in range(self.timestep.advance(delta_time)):
+            self.move_balls()
+
+    def move_balls(self):
         new_balls = []
         for ball in self.balls:
             start, end, event_type = ball
@@ -121,11 +130,15 @@ class Watcher:
         sock.bind((WATCHER_IP, WATCHER_PORT))
         sock.listen()
         count = 0
-        while count < gconsts.NUM_PLAYERS:
+        # The lobby's server dials us too
+        expected = gconsts.NUM_PLAYERS + (1 if SERVER_MODE else 0)
+        while count < expected:
             try:
                 conn, addr = sock.accept()
-                data = conn.recv(1024)
-                if not data or len(data) <= 0:
+                reader = FrameReader(conn)
+                try:
+                    data = reader.recv()
+                except errors.CommsDied:
                     continue
                 req = wire_decode(data)
                 if type(req) != CommsRequest:
@@ -133,10 +146,10 @@ class Watcher:
                 print_success(f"{req.name} being watched")
                 self.display.add_player(req.name)
                 self.socket_map[req.name] = conn
-                job_thread = Thread(target=self.watch_job, args=(req.name,))
+                job_thread = Thread(target=self.watch_job, args=(req.name, reader))
                 job_thread.start()
                 # Let the machine know that it has been connected
-                conn.send(CommsResponse("watcher", True).encode())
+                send_frame(conn, CommsResponse("watcher", True).encode())
                 count += 1
             except KeyboardInterrupt:
                 sock.close()
@@ -149,24 +162,22 @@ class Watcher:
                 sock.bind((WATCHER_IP, WATCHER_PORT))
                 sock.listen()
 
-    def watch_job(self, name: str):
+    def watch_job(self, name: str, reader: FrameReader):
         """
         Watches a machine
         """
-        conn = self.socket_map[name]
         while not self.dead:
-            data = conn.recv(1024)
-            if not data or len(data) <= 0:
+            try:
+                job = reader.recv()
+            except Exception:
                 break
-            jobs = data.split(b"#")
-            for job in jobs:
-                try:
-                    req = wire_decode(job)
-                    if type(req) != Event:
-                        continue
-                    self.events.put(req)
-                except:
-                    pass
+            try:
+                req = wire_decode(job)
+                if type(req) != Event:
+                    continue
+                self.events.put(req)
+            except:
+                pass
 
     def process_job(self):
         """
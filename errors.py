@@ -22,6 +22,14 @@ class UnknownComms(Exception):
         super().__init__(self.message)
 
 
+# An exception for a transport a connection manager can't speak
+class UnsupportedTransport(Exception):
+    def __init__(self, s: str):
+        self.s = s
+        self.message = f"Unsupported transport: {s}"
+        super().__init__(self.message)
+
+
 # An exception for when comms go down randomly
 class CommsDied(Exception):
     def __init__(self, s: str):
@@ -0,0 +1,416 @@
+import sys
+
+sys.path.append("..")
+
+import random
+from typing import Callable, Mapping, Union
+import numpy as np
+import game.consts as consts
+from game.lag import PositionHistory
+from schema import GameState, Player, Spell, Vec2, InputState
+
+# Where each caster saw everyone, stacked: rows of x, y, is_alive and whether the
+# player was there at all, each shaped (views, players), then which row each
+# player looks at, -1 for the present
+Rewound = tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+class ArrayState:
+    """
+    The game state laid out as NumPy arrays (one per field) instead of a list of
+    Player and Spell objects, so a tick is a handful of vectorised operations over
+    every entity instead of allocating new objects for each one. It is built from
+    a GameState once and can then be ticked over and over (see
+    engine.Simulation), only turned back into a GameState when one is needed to
+    send or draw, so everything on the wire stays the same.
+    """
+
+    def __init__(self, game_state: GameState):
+        self.next_leader = game_state.next_leader
+        self.spell_count = game_state.spell_count
+        self.seq = game_state.seq
+
+        players = game_state.players
+        self.player_ids = [player.id for player in players]
+        self.player_pos = np.array(
+            [(player.pos.x, player.pos.y) for player in players], dtype=np.float64
+        ).reshape(-1, 2)
+        self.player_vel = np.array(
+            [(player.vel.x, player.vel.y) for player in players], dtype=np.float64
+        ).reshape(-1, 2)
+        self.is_alive = np.array([player.is_alive for player in players], dtype=bool)
+        self.time_till_respawn = np.array(
+            [player.time_till_respawn for player in players], dtype=np.float64
+        )
+        self.facing = np.array([player.facing for player in players], dtype=np.int64)
+        self.is_casting = np.array(
+            [player.is_casting for player in players], dtype=bool
+        )
+        self.is_david = np.array([player.is_david for player in players], dtype=bool)
+        self.score = np.array([player.score for player in players], dtype=np.int64)
+        self.input_seq = np.array(
+            [player.input_seq for player in players], dtype=np.int64
+        )
+
+        self.spell_ids = np.array(
+            [spell.id for spell in game_state.spells], dtype=np.int64
+        )
+        self.spell_pos = np.array(
+            [(spell.pos.x, spell.pos.y) for spell in game_state.spells],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        self.spell_vel = np.array(
+            [(spell.vel.x, spell.vel.y) for spell in game_state.spells],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        self.index = {id: px for px, id in enumerate(self.player_ids)}
+        self.spell_creators = np.array(
+            [spell.creator for spell in game_state.spells], dtype=object
+        )
+        # Which player cast each spell, -1 if they aren't in the game
+        self.spell_casters = np.array(
+            [self.index.get(spell.creator, -1) for spell in game_state.spells],
+            dtype=np.int64,
+        )
+
+    def to_game_state(self) -> GameState:
+        """
+        A new GameState with everything in this one
+        """
+        players = [
+            Player(
+                id,
+                Vec2(x, y),
+                Vec2(vx, vy),
+                is_alive,
+                time_till_respawn,
+                facing,
+                is_casting,
+                is_david,
+                score,
+                input_seq,
+            )
+            for (
+                id,
+                (x, y),
+                (vx, vy),
+                is_alive,
+                time_till_respawn,
+                facing,
+                is_casting,
+                is_david,
+                score,
+                input_seq,
+            ) in zip(
+                self.player_ids,
+                self.player_pos.tolist(),
+                self.player_vel.tolist(),
+                self.is_alive.tolist(),
+                self.time_till_respawn.tolist(),
+                self.facing.tolist(),
+                self.is_casting.tolist(),
+                self.is_david.tolist(),
+                self.score.tolist(),
+                self.input_seq.tolist(),
+            )
+        ]
+        spells = [
+            Spell(id, Vec2(x, y), Vec2(vx, vy), creator)
+            for (id, (x, y), (vx, vy), creator) in zip(
+                self.spell_ids.tolist(),
+                self.spell_pos.tolist(),
+                self.spell_vel.tolist(),
+                self.spell_creators.tolist(),
+            )
+        ]
+        return GameState(self.next_leader, players, spells, self.spell_count, self.seq)
+
+    def write_to(self, game_state: GameState):
+        """
+        Puts this state back into a GameState
+        """
+        out = self.to_game_state()
+        game_state.next_leader = out.next_leader
+        game_state.spell_count = out.spell_count
+        game_state.seq = out.seq
+        game_state.players = out.players
+        game_state.spells = out.spells
+
+    def add_spells(self, spells: list[Spell]):
+        """
+        Adds spells that came from outside the tick
+        """
+        if len(spells) == 0:
+            return
+        self.spell_ids = np.concatenate(
+            [self.spell_ids, np.array([spell.id for spell in spells], dtype=np.int64)]
+        )
+        self.spell_pos = np.concatenate(
+            [self.spell_pos, [(spell.pos.x, spell.pos.y) for spell in spells]]
+        )
+        self.spell_vel = np.concatenate(
+            [self.spell_vel, [(spell.vel.x, spell.vel.y) for spell in spells]]
+        )
+        self.spell_creators = np.concatenate(
+            [
+                self.spell_creators,
+                np.array([spell.creator for spell in spells], dtype=object),
+            ]
+        )
+        self.spell_casters = np.concatenate(
+            [
+                self.spell_casters,
+                np.array(
+                    [self.index.get(spell.creator, -1) for spell in spells],
+                    dtype=np.int64,
+                ),
+            ]
+        )
+        self.spell_count = max(self.spell_count, max(spell.id for spell in spells))
+
+    def apply_inputs(self, input_map: Mapping[str, InputState], david: str):
+        """
+        The array version of running engine.next_player on every player,
+        then spawning the spells of anyone who just let go of the right button
+        """
+        count = len(self.player_ids)
+        inputs = [input_map.get(id) for id in self.player_ids]
+        moving = self.is_alive & np.array([inp != None for inp in inputs], dtype=bool)
+        if not moving.any():
+            return
+        keys = np.zeros((count, 2), dtype=np.float64)
+        casting = np.zeros(count, dtype=bool)
+        aim_x = np.zeros(count, dtype=np.float64)
+        for px in np.flatnonzero(moving):
+            key_input = inputs[px].key_input
+            keys[px, 0] = (key_input.right and not key_input.left) - (
+                key_input.left and not key_input.right
+            )
+            keys[px, 1] = (key_input.up and not key_input.down) - (
+                key_input.down and not key_input.up
+            )
+            casting[px] = inputs[px].mouse_input.right
+            self.input_seq[px] = inputs[px].seq
+            aim_x[px] = inputs[px].mouse_input.pos.x
+
+        # Normalise, then scale by how fast they're allowed to go
+        length = np.sqrt(keys[:, 0] ** 2 + keys[:, 1] ** 2)
+        nonzero = length != 0
+        keys[nonzero] /= length[nonzero, None]
+        keys *= np.where(casting, consts.CAST_SPEED, consts.PLAYER_SPEED)[:, None]
+
+        # Move, keeping everyone in the arena
+        self.player_pos[moving] += keys[moving]
+        self.player_pos[moving, 0] = np.minimum(
+            consts.SCREEN_WIDTH, np.maximum(0, self.player_pos[moving, 0])
+        )
+        self.player_pos[moving, 1] = np.minimum(
+            consts.SCREEN_HEIGHT, np.maximum(0, self.player_pos[moving, 1])
+        )
+        self.player_vel[moving] = keys[moving]
+
+        # Casting players face where they aim, everyone else where they're going
+        aim_facing = np.where(aim_x < self.player_pos[:, 0], consts.LEFT, consts.RIGHT)
+        move_facing = np.where(keys[:, 0] < 0, consts.LEFT, consts.RIGHT)
+        new_facing = np.where(
+            casting, aim_facing, np.where(keys[:, 0] != 0, move_facing, self.facing)
+        )
+        self.facing[moving] = new_facing[moving]
+
+        released = moving & self.is_casting & ~casting
+        self.is_casting[moving] = casting[moving]
+        self.is_david[moving] = False
+        if david in self.index and moving[self.index[david]]:
+            self.is_david[self.index[david]] = True
+
+        # Spawn spells in player order so the ids match the scalar path
+        new_spells = []
+        for px in np.flatnonzero(released):
+            mouse_input = inputs[px].mouse_input
+            speed = (
+                consts.SPELL_SPEED_MIN
+                + mouse_input.rheld_for * consts.SPELL_SPEED_SCALING
+            )
+            speed = min(consts.SPELL_SPEED_MAX, speed)
+            pos = Vec2(float(self.player_pos[px, 0]), float(self.player_pos[px, 1]))
+            vel = mouse_input.pos - pos
+            vel.normalize()
+            vel *= speed
+            self.spell_count += 1
+            new_spells.append(Spell(self.spell_count, pos, vel, self.player_ids[px]))
+        self.add_spells(new_spells)
+
+    def move_spells(self):
+        """
+        Moves every spell and drops the ones that left the arena
+        """
+        self.spell_pos += self.spell_vel
+        keep = (
+            (self.spell_pos[:, 0] >= 0)
+            & (self.spell_pos[:, 0] < consts.SCREEN_WIDTH)
+            & (self.spell_pos[:, 1] >= 0)
+            & (self.spell_pos[:, 1] < consts.SCREEN_HEIGHT)
+        )
+        if keep.all():
+            return
+        self.spell_ids = self.spell_ids[keep]
+        self.spell_pos = self.spell_pos[keep]
+        self.spell_vel = self.spell_vel[keep]
+        self.spell_creators = self.spell_creators[keep]
+        self.spell_casters = self.spell_casters[keep]
+
+    def handle_collisions(self, rewound: Union[Rewound, None] = None):
+        """
+        Tests every player against every spell at once, then resolves the hits in
+        player order, since a spell can only hit one player and a player can only
+        be hit once. rewound is where each caster saw everyone, see rewind
+        """
+        num_players = len(self.player_ids)
+        if len(self.spell_ids) > 0 and num_players > 0:
+            creators = self.spell_casters
+            radius = 16 * np.where(
+                self.is_david, consts.DAVID_SCALING, consts.GOLIATH_SCALING
+            )
+            # Where each player is for each spell, (players, spells)
+            (target_x, target_y, was_alive) = self.seen_by_casters(rewound)
+            dist_sq = (target_x - self.spell_pos[None, :, 0]) ** 2 + (
+                target_y - 4 - self.spell_pos[None, :, 1]
+            ) ** 2
+            hits = (
+                (dist_sq < radius[:, None] ** 2)
+                & was_alive
+                & (creators[None, :] != np.arange(num_players)[:, None])
+            )
+            hits &= self.is_alive[:, None]
+            used = np.zeros(len(self.spell_ids), dtype=bool)
+            for px in np.flatnonzero(hits.any(axis=1)):
+                candidates = np.flatnonzero(hits[px] & ~used)
+                if len(candidates) == 0:
+                    continue
+                sx = candidates[0]
+                used[sx] = True
+                self.time_till_respawn[px] = 40
+                self.is_alive[px] = False
+                self.spell_pos[sx] = (-1000, -1000)
+                if creators[sx] >= 0:
+                    self.score[creators[sx]] += 1
+
+        counting = self.time_till_respawn > 0
+        self.time_till_respawn[counting] -= 1
+        for px in np.flatnonzero(self.time_till_respawn == 1):
+            self.is_alive[px] = True
+            self.player_pos[px, 0] = random.randint(0, consts.SCREEN_WIDTH)
+            self.player_pos[px, 1] = random.randint(0, consts.SCREEN_HEIGHT)
+
+    def seen_by_casters(
+        self, rewound: Union[Rewound, None]
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Every player's position and whether they were alive, as each spell's
+        caster saw them. Each is shaped (players, spells)
+        """
+        current_x = self.player_pos[:, 0, None]
+        current_y = self.player_pos[:, 1, None]
+        if rewound == None or len(rewound[0]) == 0:
+            return (current_x, current_y, np.ones((1, 1), dtype=bool))
+        (xs, ys, alive, present, rows) = rewound
+        casters = self.spell_casters
+        spell_rows = np.where(casters >= 0, rows[casters], -1)
+        rewinds = spell_rows >= 0
+        spell_rows = np.where(rewinds, spell_rows, 0)
+        # (players, spells), True where the caster saw the player somewhere else
+        use = present[spell_rows].T & rewinds[None, :]
+        return (
+            np.where(use, xs[spell_rows].T, current_x),
+            np.where(use, ys[spell_rows].T, current_y),
+            np.where(use, alive[spell_rows].T, True),
+        )
+
+    def rewind(
+        self, history: PositionHistory, get_lag: Callable[[str], float]
+    ) -> Rewound:
+        """
+        Where every player saw everyone at the start of this tick. Players who
+        see the game equally far behind share a row, so there are at most as
+        many rows as ticks the history remembers
+        """
+        row_of: dict[int, int] = {}
+        stack: list[dict[str, tuple[float, float, bool]]] = []
+        rows = np.full(len(self.player_ids), -1, dtype=np.int64)
+        for px, player_id in enumerate(self.player_ids):
+            ticks = history.rewind_ticks(get_lag(player_id))
+            if ticks == 0:
+                continue
+            seq = self.seq - ticks
+            if seq not in row_of:
+                positions = history.positions_at(seq)
+                row_of[seq] = -1
+                if positions != None and len(positions) > 0:
+                    row_of[seq] = len(stack)
+                    stack.append(positions)
+            rows[px] = row_of[seq]
+        return stack_views(stack, self.player_ids, rows)
+
+    def tick(
+        self,
+        input_map: Mapping[str, InputState],
+        david: str,
+        history: Union[PositionHistory, None] = None,
+        get_lag: Union[Callable[[str], float], None] = None,
+    ):
+        """
+        The array version of engine.update_game_state
+        """
+        self.seq += 1
+        rewound = None
+        if history != None and get_lag != None:
+            rewound = self.rewind(history, get_lag)
+        self.step(input_map, david, rewound)
+        if history != None:
+            history.record_positions(
+                self.seq,
+                dict(
+                    zip(
+                        self.player_ids,
+                        zip(
+                            self.player_pos[:, 0].tolist(),
+                            self.player_pos[:, 1].tolist(),
+                            self.is_alive.tolist(),
+                        ),
+                    )
+                ),
+            )
+
+    def step(
+        self,
+        input_map: Mapping[str, InputState],
+        david: str,
+        rewound: Union[Rewound, None] = None,
+    ):
+        """
+        Advances the state one tick, exactly like engine.simulate
+        """
+        self.apply_inputs(input_map, david)
+        self.move_spells()
+        self.handle_collisions(rewound)
+
+
+def stack_views(
+    views: list[Mapping[str, tuple[float, float, bool]]],
+    player_ids: list[str],
+    rows: np.ndarray,
+) -> Rewound:
+    """
+    Lays out views (player id -> (x, y, is_alive)) as a Rewound
+    """
+    count = len(player_ids)
+    xs = np.zeros((len(views), count), dtype=np.float64)
+    ys = np.zeros((len(views), count), dtype=np.float64)
+    alive = np.ones((len(views), count), dtype=bool)
+    present = np.zeros((len(views), count), dtype=bool)
+    for vx, view in enumerate(views):
+        for px, player_id in enumerate(player_ids):
+            if player_id in view:
+                (xs[vx, px], ys[vx, px], alive[vx, px]) = view[player_id]
+                present[vx, px] = True
+    return (xs, ys, alive, present, rows)
@@ -23,13 +23,43 @@ def get_speed(diff):
     return BASE + (diff + OFFSET) ** EXP
 
 
-# Stuff to prevent import circles
+# How far players move each tick
+PLAYER_SPEED = 12
+CAST_SPEED = 6
+
+# How far spells move each tick. Like the player speeds, these are double what
+# they were when the sprites also moved everything on every rendered frame
+SPELL_SPEED_MIN = 14
+SPELL_SPEED_MAX = 40
+SPELL_SPEED_SCALING = 16
 SPELL_LIVE_FOR = 500  # In milliseconds
 
 
 DAVID_SCALING = 1.0
 GOLIATH_SCALING = 2.0
 
+# Side length of the cells used to find collisions, should be at least as big as
+# the largest player's hit radius
+COLLISION_CELL_SIZE = 64
+
 NUM_PLAYERS = 2
 
 FPS = 30
+# How the leader runs a tick: "scalar" works on the Player and Spell objects
+# directly, "numpy" runs it on arrays (see game/arrays.py)
+SIM_BACKEND = "scalar"
+# Whether followers move their own player before the leader confirms it, and how
+# many unconfirmed inputs they keep around to replay
+CLIENT_PREDICTION = True
+PREDICTION_HISTORY = 60
+# How far in the past (seconds) followers draw the game, so there is usually a
+# snapshot on either side to blend between. 0 draws the latest snapshot as is
+INTERPOLATION_DELAY = 0.1
+SNAPSHOT_BUFFER_SIZE = 32
+# Whether the leader tests spells against where their caster saw everyone, rather
+# than where everyone is now, and the furthest back (seconds) it will look
+LAG_COMPENSATION = True
+MAX_REWIND = 0.25
+# The most ticks we'll run back to back to catch up after a slow one, past this
+# we just drop the time
+MAX_CATCHUP_STEPS = 5
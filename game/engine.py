@@ -0,0 +1,325 @@
+import sys
+
+sys.path.append("..")
+
+import math
+import random
+from typing import TYPE_CHECKING, Callable, Mapping, Union
+import game.consts as consts
+from game.lag import PositionHistory
+from game.spatial import SpatialHash
+from schema import GameState, InputState, KeyInput, MouseInput, Player, Spell, Vec2
+
+# The numpy backend is only loaded when it's used, numpy takes longer to import
+# than the whole scalar engine
+if TYPE_CHECKING:
+    from game.arrays import ArrayState
+
+# The simulation itself: everything the leader does to advance the game a tick.
+# Nothing in here may import arcade, so it can run headless (servers, benchmarks,
+# worker processes) while the sprites only ever draw the state it produces.
+
+
+def get_movement(key_input: KeyInput, mouse_input: MouseInput) -> Vec2:
+    """
+    The velocity a player's input asks for
+    """
+    x = 0
+    y = 0
+    if key_input.right and not key_input.left:
+        x = 1
+    if key_input.left and not key_input.right:
+        x = -1
+    if key_input.up and not key_input.down:
+        y = 1
+    if key_input.down and not key_input.up:
+        y = -1
+    result = Vec2(x, y)
+    result.normalize()
+    actual_speed = consts.CAST_SPEED if mouse_input.right else consts.PLAYER_SPEED
+    result *= actual_speed
+    return result
+
+
+def next_player(old_state: Player, p_inp: InputState) -> Player:
+    """
+    Moves a player one tick according to their input
+    """
+    new_vel = get_movement(p_inp.key_input, p_inp.mouse_input)
+    new_pos = old_state.pos + new_vel
+    new_pos.x = min(consts.SCREEN_WIDTH, max(0, new_pos.x))
+    new_pos.y = min(consts.SCREEN_HEIGHT, max(0, new_pos.y))
+    new_casting = p_inp.mouse_input.right
+    new_facing = old_state.facing
+    if new_casting:
+        new_facing = (
+            consts.LEFT if p_inp.mouse_input.pos.x < new_pos.x else consts.RIGHT
+        )
+    elif new_vel.x != 0:
+        new_facing = consts.LEFT if new_vel.x < 0 else consts.RIGHT
+    return Player(
+        old_state.id,
+        new_pos,
+        new_vel,
+        old_state.is_alive,
+        old_state.time_till_respawn,
+        new_facing,
+        new_casting,
+        score=old_state.score,
+        input_seq=p_inp.seq,
+    )
+
+
+def next_spell(old_state: Spell) -> Spell:
+    """
+    Moves a spell one tick
+    """
+    return Spell(
+        old_state.id,
+        old_state.pos + old_state.vel,
+        old_state.vel,
+        old_state.creator,
+    )
+
+
+def in_arena(pos: Vec2) -> bool:
+    return (
+        pos.x >= 0
+        and pos.x < consts.SCREEN_WIDTH
+        and pos.y >= 0
+        and pos.y < consts.SCREEN_HEIGHT
+    )
+
+
+def cast_spell(game_state: GameState, caster: Player, p_inp: InputState):
+    """
+    Adds the spell a player cast by letting go of the right button
+    """
+    speed = (
+        consts.SPELL_SPEED_MIN
+        + p_inp.mouse_input.rheld_for * consts.SPELL_SPEED_SCALING
+    )
+    speed = min(consts.SPELL_SPEED_MAX, speed)
+    vel = p_inp.mouse_input.pos - caster.pos
+    vel.normalize()
+    vel *= speed
+    game_state.spell_count += 1
+    game_state.spells.append(Spell(game_state.spell_count, caster.pos, vel, caster.id))
+
+
+def handle_collisions(
+    game_state: GameState,
+    views: Union[Mapping[str, Mapping[str, tuple[Vec2, bool]]], None] = None,
+):
+    """
+    Kills players hit by someone else's spell, credits the caster, and respawns
+    players whose timer ran out. Only the spells near each player are checked.
+    views maps a caster to where they saw everyone when they were shooting (see
+    lag_views), players missing from it are tested where they are now
+    """
+    grid = SpatialHash()
+    for sx, spell in enumerate(game_state.spells):
+        grid.insert(sx, spell.pos)
+    players_by_id = {player.id: player for player in game_state.players}
+    for player in game_state.players:
+        radius = 16 * (
+            consts.DAVID_SCALING if player.is_david else consts.GOLIATH_SCALING
+        )
+        # A rewound player can be anywhere they've been lately
+        slack = 0.0
+        for view in (views or {}).values():
+            if player.id in view:
+                (pos, _) = view[player.id]
+                slack = max(
+                    slack, math.hypot(pos.x - player.pos.x, pos.y - player.pos.y)
+                )
+        for sx in grid.query(player.pos.x, player.pos.y - 4, radius + slack):
+            spell = game_state.spells[sx]
+            if player.id == spell.creator:
+                continue
+            (pos, was_alive) = (player.pos, True)
+            if views != None and player.id in views.get(spell.creator, {}):
+                (pos, was_alive) = views[spell.creator][player.id]
+            dist_sq = (pos.x - spell.pos.x) ** 2 + (pos.y - 4 - spell.pos.y) ** 2
+            if dist_sq < radius**2 and player.is_alive and was_alive:
+                player.time_till_respawn = 40
+                player.is_alive = False
+                spell.pos.y = -1000
+                spell.pos.x = -1000
+                if spell.creator in players_by_id:
+                    players_by_id[spell.creator].score += 1
+        if player.time_till_respawn > 0:
+            player.time_till_respawn -= 1
+        if player.time_till_respawn == 1:
+            player.is_alive = True
+            player.pos.x = random.randint(0, consts.SCREEN_WIDTH)
+            player.pos.y = random.randint(0, consts.SCREEN_HEIGHT)
+
+
+def lag_views(
+    game_state: GameState,
+    history: Union[PositionHistory, None],
+    get_lag: Union[Callable[[str], float], None],
+) -> Union[dict[str, dict[str, tuple[Vec2, bool]]], None]:
+    """
+    For every player, where they saw everyone else when they were playing this
+    tick. get_lag says how far behind the leader (in seconds) each player sees
+    the game
+    """
+    if history == None or get_lag == None:
+        return None
+    return {
+        player.id: history.seen_by(game_state.seq, get_lag(player.id))
+        for player in game_state.players
+    }
+
+
+def update_game_state(
+    game_state: GameState,
+    input_map: Mapping[str, InputState],
+    david: str,
+    history: Union[PositionHistory, None] = None,
+    get_lag: Union[Callable[[str], float], None] = None,
+):
+    """
+    Does the work of updating all the game state. With a history, spells are
+    tested against players where their caster saw them (get_lag back in time),
+    and the tick is added to the history afterwards
+    NOTE: Modifies game_state directly
+    """
+    if consts.SIM_BACKEND == "numpy":
+        import game.arrays as arrays
+
+        # Building the arrays costs more than the tick saves, anything that
+        # ticks over and over should use a Simulation
+        state = arrays.ArrayState(game_state)
+        state.tick(input_map, david, history, get_lag)
+        state.write_to(game_state)
+        return
+    game_state.seq += 1
+    views = lag_views(game_state, history, get_lag)
+    simulate(game_state, input_map, david, views)
+    if history != None:
+        history.record(game_state)
+
+
+class Simulation:
+    """
+    Runs the authority's tick over and over. With the numpy backend the state
+    stays in arrays from one tick to the next, and a GameState is only built
+    when someone asks for one (to send or draw). The arrays are only rebuilt
+    when a tick starts from a state the simulation didn't hand out, like one
+    that arrived from another leader.
+
+    With shared set, the states handed out are never changed afterwards (they're
+    published to other threads, see game/handoff.py), so the scalar backend
+    simulates a copy. Without it, the scalar backend simulates in place
+    """
+
+    def __init__(
+        self,
+        history: Union[PositionHistory, None] = None,
+        get_lag: Union[Callable[[str], float], None] = None,
+        shared: bool = True,
+    ):
+        self.history = history
+        self.get_lag = get_lag
+        self.shared = shared
+        self.arrays: Union["ArrayState", None] = None
+        self.state: Union[GameState, None] = None
+        # The last state handed out, None if the arrays moved on since
+        self.handed_out: Union[GameState, None] = None
+
+    def reset(self, game_state: GameState):
+        """
+        Starts simulating from game_state
+        """
+        self.handed_out = None
+        if consts.SIM_BACKEND == "numpy":
+            import game.arrays as arrays
+
+            self.arrays = arrays.ArrayState(game_state)
+            self.state = None
+        else:
+            self.arrays = None
+            self.state = game_state.copy() if self.shared else game_state
+
+    def advance(self, input_map: Mapping[str, InputState], david: str):
+        """
+        One tick. Must be reset first
+        """
+        if self.arrays != None:
+            self.arrays.tick(input_map, david, self.history, self.get_lag)
+            self.handed_out = None
+            return
+        if self.shared and self.state is self.handed_out:
+            self.state = self.state.copy()
+        update_game_state(self.state, input_map, david, self.history, self.get_lag)
+
+    def game_state(self) -> GameState:
+        """
+        The current state
+        """
+        if self.arrays != None:
+            if self.handed_out == None:
+                self.handed_out = self.arrays.to_game_state()
+        else:
+            self.handed_out = self.state
+        return self.handed_out
+
+    def add_spells(self, spells: list[Spell]):
+        if self.arrays != None:
+            self.arrays.add_spells(spells)
+            self.handed_out = None
+            return
+        if self.shared and self.state is self.handed_out:
+            self.state = self.state.copy()
+        self.state.spells += spells
+        self.state.spell_count = max(
+            [self.state.spell_count] + [spell.id for spell in spells]
+        )
+
+    def step(
+        self, base: GameState, input_map: Mapping[str, InputState], david: str
+    ) -> GameState:
+        """
+        The state one tick after base. base is left alone when shared
+        """
+        if self.handed_out == None or base is not self.handed_out:
+            self.reset(base)
+        elif self.arrays != None:
+            # The leader can be changed on a state after it was handed out
+            self.arrays.next_leader = base.next_leader
+        self.advance(input_map, david)
+        return self.game_state()
+
+
+def simulate(
+    game_state: GameState,
+    input_map: Mapping[str, InputState],
+    david: str,
+    views: Union[Mapping[str, Mapping[str, tuple[Vec2, bool]]], None] = None,
+):
+    """
+    One tick of the game itself: moves players, casts and moves spells, and
+    resolves hits
+    NOTE: Modifies game_state directly
+    """
+    # First handle player input
+    for px in range(len(game_state.players)):
+        old_player = game_state.players[px]
+        if not old_player.is_alive or not old_player.id in input_map:
+            continue
+        p_inp = input_map[old_player.id]
+        new_player = next_player(old_player, p_inp)
+        new_player.is_david = new_player.id == david
+        game_state.players[px] = new_player
+        # Right button was released between updates
+        if old_player.is_casting and not new_player.is_casting:
+            cast_spell(game_state, new_player, p_inp)
+
+    # Then move all the spells, dropping the ones that left the arena
+    new_spells = [next_spell(spell) for spell in game_state.spells]
+    game_state.spells = [spell for spell in new_spells if in_arena(spell.pos)]
+
+    handle_collisions(game_state, views)
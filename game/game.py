@@ -2,22 +2,18 @@ import sys
 
 sys.path.append("..")
 
-from typing import List, Union
+from typing import Union
 import arcade
 from arcade import key as KEY
 from arcade import MOUSE_BUTTON_LEFT, MOUSE_BUTTON_RIGHT
 import game.consts as consts
 from game.player_sprite import PlayerSprite
 from game.spell_sprite import SpellSprite
-from schema import KeyInput, MouseInput, Vec2, InputState, GameState, Spell
-from typing import Callable, Mapping
+from game.interpolation import SnapshotBuffer
+from schema import KeyInput, MouseInput, Vec2, GameState, Spell
+from typing import Callable
 import time
 from threading import Lock
-import random
-
-SPELL_SPEED_MIN = 7
-SPELL_SPEED_MAX = 20
-SPELL_SPEED_SCALING = 8
 
 
 class Game(arcade.Window):
@@ -63,6 +59,9 @@ class Game(arcade.Window):
         self.spell_kill_lock = Lock()
         self.my_name = my_name
         self.last_game_state: Union[GameState, None] = None
+        # Snapshots come in from the agent's thread and get drawn slightly
+        # in the past, blended between the nearest two
+        self.snapshots = SnapshotBuffer(my_name)
 
     def setup_for_players(self, player_names: list[str]):
         self.player_list.clear()
@@ -126,6 +125,9 @@ class Game(arcade.Window):
         self.on_update_mouse(self.mouse_input)
 
     def on_update(self, delta_time):
+        game_state = self.snapshots.sample()
+        if game_state != None:
+            self.show_game_state(game_state)
         self.scene.on_update(delta_time)
         with self.spell_kill_lock:
             for spell in self.spell_kill_list:
@@ -154,86 +156,14 @@ class Game(arcade.Window):
                     font_name="Kenney Pixel Square",
                 )
 
-    @staticmethod
-    def update_game_state(
-        game_state: GameState, input_map: Mapping[str, InputState], david: str
-    ):
+    def take_game_state(self, game_state: GameState, live: bool = False):
         """
-        Does the work of updating all the game state
-        NOTE: Modifies game_state directly
+        Hands the game a new snapshot to draw. Safe to call from any thread. Live
+        snapshots (the leader's own) are drawn as they are, straight away
         """
-        # First handle player input
-        for px in range(len(game_state.players)):
-            # First update the player's position and such
-            if not game_state.players[px].is_alive:
-                continue
-            old_player = game_state.players[px]
-            if not old_player.id in input_map:
-                continue
-            p_inp = input_map[old_player.id]
-            new_player = PlayerSprite.get_new_state(old_player, p_inp)
-            new_player.is_david = new_player.id == david
-            game_state.players[px] = new_player
-            # Then see what spells we need to spawn
-            if (
-                old_player.is_casting
-                and not new_player.is_casting
-                and new_player.is_alive
-            ):
-                speed = (
-                    SPELL_SPEED_MIN + p_inp.mouse_input.rheld_for * SPELL_SPEED_SCALING
-                )
-                speed = min(SPELL_SPEED_MAX, speed)
-                # Right button was released between updates
-                pos = new_player.pos
-                vel = p_inp.mouse_input.pos - new_player.pos
-                vel.normalize()
-                vel *= speed
-                state = Spell(game_state.spell_count + 1, pos, vel, old_player.id)
-                game_state.spells.append(state)
-                game_state.spell_count += 1
-
-        # Then move all the spells
-        new_spells: list[Spell] = []
-        for sx in range(len(game_state.spells)):
-            old_spell = game_state.spells[sx]
-            new_spell = SpellSprite.get_new_state(old_spell)
-            if (
-                new_spell.pos.x >= 0
-                and new_spell.pos.x < consts.SCREEN_WIDTH
-                and new_spell.pos.y >= 0
-                and new_spell.pos.y < consts.SCREEN_HEIGHT
-            ):
-                new_spells.append(new_spell)
-        game_state.spells = new_spells
-
-        # Then handle collisions
-        for player in game_state.players:
-            for spell in game_state.spells:
-                if player.id == spell.creator:
-                    continue
-                dist_sq = (player.pos.x - spell.pos.x) ** 2 + (
-                    player.pos.y - 4 - spell.pos.y
-                ) ** 2
-                radius = 16 * (
-                    consts.DAVID_SCALING if player.is_david else consts.GOLIATH_SCALING
-                )
-                if dist_sq < radius**2 and player.is_alive:
-                    player.time_till_respawn = 40
-                    player.is_alive = False
-                    spell.pos.y = -1000
-                    spell.pos.x = -1000
-                    for p in game_state.players:
-                        if p.id == spell.creator:
-                            p.score += 1
-            if player.time_till_respawn > 0:
-                player.time_till_respawn -= 1
-            if player.time_till_respawn == 1:
-                player.is_alive = True
-                player.pos.x = random.randint(0, consts.SCREEN_WIDTH)
-                player.pos.y = random.randint(0, consts.SCREEN_HEIGHT)
+        self.snapshots.push(game_state, live)
 
-    def take_game_state(self, game_state: GameState):
+    def show_game_state(self, game_state: GameState):
         """
         This function implements the logic needed by non-leader games to simply update
         everything to match the gamestate that they will receive over the wire
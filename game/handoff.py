@@ -0,0 +1,40 @@
+import sys
+
+sys.path.append("..")
+
+from threading import Lock
+from typing import Union
+from schema import GameState
+
+
+class SnapshotSlot:
+    """
+    Holds the newest game state. A state is never changed once it has been
+    published: the tick simulates a copy and publishes that, and states from the
+    leader are published as they arrive. Whoever wants the game (the tick, the
+    renderer, the AI) takes the current reference and works from it for as long
+    as they like without holding anything. Only swapping the reference is locked,
+    and only for as long as the swap takes, so no one waits on a tick or a socket.
+    """
+
+    def __init__(self, state: Union[GameState, None] = None):
+        self.lock = Lock()
+        self.state = state
+
+    def get(self) -> Union[GameState, None]:
+        return self.state
+
+    def publish(self, state: GameState):
+        with self.lock:
+            self.state = state
+
+    def publish_if(self, base: Union[GameState, None], state: GameState) -> bool:
+        """
+        Publishes state only if base is still the newest, returning whether it
+        did. A tick that started from base loses to anything published meanwhile
+        """
+        with self.lock:
+            if self.state is not base:
+                return False
+            self.state = state
+            return True
@@ -0,0 +1,157 @@
+import sys
+
+sys.path.append("..")
+
+import copy
+import time
+from threading import Lock
+from typing import Callable, Union
+from game.consts import FPS, INTERPOLATION_DELAY, SNAPSHOT_BUFFER_SIZE
+from schema import GameState, Player, Vec2
+
+# Moving further than this between two snapshots is a respawn or a spell hitting
+# someone, not movement
+TELEPORT_DISTANCE = 100
+
+
+def lerp(a: Vec2, b: Vec2, alpha: float) -> Vec2:
+    return Vec2(a.x + (b.x - a.x) * alpha, a.y + (b.y - a.y) * alpha)
+
+
+class SnapshotBuffer:
+    """
+    Holds the last few snapshots and draws the game a little in the past, blending
+    between the two snapshots either side of that moment. Snapshots never arrive
+    exactly one tick apart, but as long as the next one shows up within the delay
+    there is always something to blend towards, so nothing jumps.
+
+    Snapshots are placed in time by their seq (the leader's tick), and the local
+    clock is mapped onto that timeline using the snapshot that arrived quickest.
+    """
+
+    def __init__(
+        self,
+        local_id: Union[str, None] = None,
+        delay: float = INTERPOLATION_DELAY,
+        size: int = SNAPSHOT_BUFFER_SIZE,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        # Our own player is predicted locally, so it is always shown as is
+        self.local_id = local_id
+        self.delay = delay
+        self.size = size
+        self.clock = clock
+        self.lock = Lock()
+        # (seq, snapshot) oldest first
+        self.snapshots: list[tuple[int, GameState]] = []
+        # Leader time minus local time
+        self.offset: Union[float, None] = None
+        # Whether the newest snapshot is our own as the leader, drawn as is
+        self.live = False
+
+    def push(self, game_state: GameState, live: bool = False):
+        """
+        Remembers a snapshot. Pushing the same seq again replaces it. Snapshots
+        are kept as they are, published states are never changed afterwards.
+        A live snapshot is drawn straight away, without any delay
+        """
+        sample = game_state.seq / FPS - self.clock()
+        with self.lock:
+            self.live = live
+            for ix in range(len(self.snapshots) - 1, -1, -1):
+                seq = self.snapshots[ix][0]
+                if seq == game_state.seq:
+                    # Says nothing new about when the leader was at this seq
+                    self.snapshots[ix] = (seq, game_state)
+                    return
+                if seq < game_state.seq:
+                    self.snapshots.insert(ix + 1, (game_state.seq, game_state))
+                    break
+            else:
+                self.snapshots.insert(0, (game_state.seq, game_state))
+            if self.offset == None or sample > self.offset:
+                self.offset = sample
+            else:
+                # Follow slowly if snapshots start arriving later than they used to
+                self.offset += (sample - self.offset) * 0.05
+            if len(self.snapshots) > self.size:
+                self.snapshots.pop(0)
+
+    def sample(self) -> Union[GameState, None]:
+        """
+        The state to draw right now
+        """
+        with self.lock:
+            if len(self.snapshots) == 0:
+                return None
+            newest = self.snapshots[-1][1]
+            if self.live:
+                return newest
+            render_seq = (self.clock() + self.offset - self.delay) * FPS
+            before = self.snapshots[0]
+            after = None
+            for snapshot in self.snapshots:
+                if snapshot[0] <= render_seq:
+                    before = snapshot
+                else:
+                    after = snapshot
+                    break
+        if after == None:
+            # Nothing newer to blend towards yet, hold the latest we have
+            state = blend(before[1], before[1], 1.0)
+        else:
+            alpha = (render_seq - before[0]) / (after[0] - before[0])
+            state = blend(before[1], after[1], min(1.0, max(0.0, alpha)))
+        self.keep_local(state, newest)
+        return state
+
+    def keep_local(self, state: GameState, newest: GameState):
+        """
+        Swaps in the newest version of our own player
+        """
+        if self.local_id == None:
+            return
+        local = [player for player in newest.players if player.id == self.local_id]
+        if len(local) == 0:
+            return
+        state.players = [
+            local[0] if player.id == self.local_id else player
+            for player in state.players
+        ]
+
+
+def blend(before: GameState, after: GameState, alpha: float) -> GameState:
+    """
+    The state part way between two snapshots. Everything except positions comes
+    from the later one. Only what moved is copied, the buffered snapshots
+    themselves are never changed
+    """
+    players = []
+    old_players = {player.id: player for player in before.players}
+    for player in after.players:
+        old = old_players.get(player.id)
+        if old != None and old is not player and blendable(old, player):
+            player = copy.copy(player)
+            player.pos = lerp(old.pos, player.pos, alpha)
+        players.append(player)
+    spells = []
+    old_spells = {spell.id: spell for spell in before.spells}
+    for spell in after.spells:
+        old = old_spells.get(spell.id)
+        if old != None and old is not spell and close(old.pos, spell.pos):
+            spell = copy.copy(spell)
+            spell.pos = lerp(old.pos, spell.pos, alpha)
+        spells.append(spell)
+    return GameState(after.next_leader, players, spells, after.spell_count, after.seq)
+
+
+def blendable(old: Player, new: Player) -> bool:
+    return old.is_alive == new.is_alive and close(old.pos, new.pos)
+
+
+def close(a: Vec2, b: Vec2) -> bool:
+    """
+    Whether something could have moved from a to b, rather than having been
+    respawned or removed
+    """
+    return (b.x - a.x) ** 2 + (b.y - a.y) ** 2 < TELEPORT_DISTANCE**2
@@ -0,0 +1,88 @@
+import sys
+
+sys.path.append("..")
+
+import math
+from collections import deque
+from typing import Union
+from game.consts import FPS, INTERPOLATION_DELAY, MAX_REWIND
+from schema import GameState, Vec2
+
+
+def view_lag(rtt: Union[float, None], local: bool = False) -> float:
+    """
+    How far behind the leader a player with this round trip sees everyone else:
+    the snapshot takes half a round trip to reach them, their input half a round
+    trip to come back, and they draw everyone INTERPOLATION_DELAY in the past.
+    The leader's own player (local) sees the game as it is simulated
+    """
+    if local:
+        return 0.0
+    return INTERPOLATION_DELAY + (rtt if rtt != None else 0.0)
+
+
+class PositionHistory:
+    """
+    Where every player was on each of the last few ticks, so the leader can test
+    a spell against its target where the caster saw them rather than where they
+    are now. A lagging player sees everyone a little in the past, so without this
+    they would have to aim ahead of their targets to hit anything.
+    """
+
+    def __init__(self, max_rewind: float = MAX_REWIND):
+        self.max_ticks = math.ceil(max_rewind * FPS)
+        # (seq, {player id: (x, y, is_alive)}) oldest first
+        self.ticks: deque[tuple[int, dict[str, tuple[float, float, bool]]]] = deque(
+            maxlen=self.max_ticks + 1
+        )
+
+    def record(self, game_state: GameState):
+        """
+        Remembers where everyone is at the end of a tick
+        """
+        self.record_positions(
+            game_state.seq,
+            {
+                player.id: (player.pos.x, player.pos.y, player.is_alive)
+                for player in game_state.players
+            },
+        )
+
+    def record_positions(
+        self, seq: int, positions: dict[str, tuple[float, float, bool]]
+    ):
+        self.ticks.append((seq, positions))
+
+    def rewind_ticks(self, lag: float) -> int:
+        return min(self.max_ticks, max(0, round(lag * FPS)))
+
+    def positions_at(
+        self, seq: int
+    ) -> Union[dict[str, tuple[float, float, bool]], None]:
+        """
+        Everyone's (x, y, is_alive) at the end of tick seq, None if we don't
+        remember it
+        """
+        for tick_seq, positions in reversed(self.ticks):
+            if tick_seq == seq:
+                return positions
+            if tick_seq < seq:
+                break
+        return None
+
+    def seen_by(self, seq: int, lag: float) -> dict[str, tuple[Vec2, bool]]:
+        """
+        Where everyone was, and whether they were alive, lag seconds before tick
+        seq. Empty when there's nothing to rewind or we don't remember that far
+        back, in which case the current positions stand
+        """
+        ticks = self.rewind_ticks(lag)
+        if ticks == 0:
+            return {}
+        positions = self.positions_at(seq - ticks)
+        if positions == None:
+            return {}
+        return {
+            player_id: (Vec2(x, y), is_alive)
+            for player_id, (x, y, is_alive) in positions.items()
+        }
@@ -6,15 +6,11 @@ import arcade
 from game.consts import (
     RIGHT,
     LEFT,
-    SCREEN_WIDTH,
-    SCREEN_HEIGHT,
     DAVID_SCALING,
     GOLIATH_SCALING,
 )
-from schema import Player, Vec2, KeyInput, MouseInput, InputState
+from schema import Player, Vec2
 
-PLAYER_SPEED = 6
-CAST_SPEED = 3
 DASH_SPEED = 18
 DASH_LENGTH = 150  # In milliseconds
 DASH_COOLDOWN = 600  # In milliseconds
@@ -94,55 +90,9 @@ class PlayerSprite(arcade.Sprite):
             self.center_x, self.center_y = -1000, -1000
 
     def on_update(self, delta_time):
-        """ """
+        """
+        Only draws the state, moving players is up to the engine
+        """
         self.center_x, self.center_y = self.state.pos.x, self.state.pos.y
         self.change_x, self.change_y = (0, 0)
-        self.state.pos += self.state.vel
         self.update_animation()
-
-    @staticmethod
-    def get_player_movement_from_inp(
-        key_input: KeyInput, mouse_input: MouseInput
-    ) -> Vec2:
-        x = 0
-        y = 0
-        if key_input.right and not key_input.left:
-            x = 1
-        if key_input.left and not key_input.right:
-            x = -1
-        if key_input.up and not key_input.down:
-            y = 1
-        if key_input.down and not key_input.up:
-            y = -1
-        result = Vec2(x, y)
-        result.normalize()
-        actual_speed = CAST_SPEED if mouse_input.right else PLAYER_SPEED
-        result *= actual_speed
-        return result
-
-    @staticmethod
-    def get_new_state(old_state: Player, p_inp: InputState) -> Player:
-        new_vel = PlayerSprite.get_player_movement_from_inp(
-            p_inp.key_input, p_inp.mouse_input
-        )
-        new_pos = old_state.pos
-        new_pos.x = min(SCREEN_WIDTH, max(0, new_pos.x))
-        new_pos.y = min(SCREEN_HEIGHT, max(0, new_pos.y))
-        new_is_alive = old_state.is_alive
-        new_time_till_respawn = old_state.time_till_respawn
-        new_casting = p_inp.mouse_input.right
-        new_facing = old_state.facing
-        if new_casting:
-            new_facing = LEFT if p_inp.mouse_input.pos.x < new_pos.x else RIGHT
-        elif new_vel.x != 0:
-            new_facing = LEFT if new_vel.x < 0 else RIGHT
-        return Player(
-            old_state.id,
-            new_pos,
-            new_vel,
-            new_is_alive,
-            new_time_till_respawn,
-            new_facing,
-            new_casting,
-            score=old_state.score,
-        )
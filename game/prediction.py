@@ -0,0 +1,73 @@
+import sys
+
+sys.path.append("..")
+
+import copy
+from typing import Union
+import game.engine as engine
+from game.consts import PREDICTION_HISTORY
+from schema import GameState, InputState, Player
+
+
+class Predictor:
+    """
+    Moves our own player as soon as we press something instead of waiting a round
+    trip for the leader to do it. Every input we send is applied locally with the
+    same rules the leader uses, and remembered until the leader says it applied
+    it. When a snapshot arrives we start over from where the leader put us and
+    replay the inputs it hasn't seen yet, so we never drift far from the truth.
+    """
+
+    def __init__(self, player_id: str):
+        self.player_id = player_id
+        # Inputs we applied locally that the leader hasn't confirmed yet, oldest first
+        self.pending: list[InputState] = []
+        self.player: Union[Player, None] = None
+        self.last_seq = -1
+
+    def find_player(self, game_state: GameState) -> Union[int, None]:
+        for px, player in enumerate(game_state.players):
+            if player.id == self.player_id:
+                return px
+        return None
+
+    def reconcile(self, authority: Player) -> Player:
+        """
+        Drops the inputs the leader has applied and replays the rest on top of the
+        leader's version of us
+        """
+        self.pending = [inp for inp in self.pending if inp.seq > authority.input_seq]
+        predicted = copy.deepcopy(authority)
+        for inp in self.pending:
+            predicted = self.apply(predicted, inp)
+        return predicted
+
+    def apply(self, player: Player, inp: InputState) -> Player:
+        if not player.is_alive:
+            return player
+        moved = engine.next_player(player, inp)
+        # Only the leader decides who David is
+        moved.is_david = player.is_david
+        return moved
+
+    def step(self, game_state: GameState, inp: InputState):
+        """
+        Applies an input we just sent, and puts the predicted player in game_state
+        NOTE: Modifies game_state directly
+        """
+        px = self.find_player(game_state)
+        if px == None:
+            return
+        self.pending.append(inp)
+        if len(self.pending) > PREDICTION_HISTORY:
+            self.pending.pop(0)
+        if game_state.seq != self.last_seq or self.player == None:
+            # A new snapshot from the leader
+            self.last_seq = game_state.seq
+            self.player = self.reconcile(game_state.players[px])
+        else:
+            self.player = self.apply(self.player, inp)
+        if not self.player.is_alive:
+            # The leader ignores inputs from the dead, so there's nothing to replay
+            self.pending = []
+        game_state.players[px] = self.player
@@ -0,0 +1,46 @@
+import sys
+
+sys.path.append("..")
+
+import math
+from game.consts import COLLISION_CELL_SIZE
+from schema import Vec2
+
+
+class SpatialHash:
+    """
+    A uniform grid over the arena that remembers which spells are in each cell,
+    so a player only has to be checked against the spells near them instead of
+    every spell in the game. Rebuilt from scratch every tick, which is cheaper than
+    keeping it up to date since every spell moves every tick anyway.
+    """
+
+    def __init__(self, cell_size: float = COLLISION_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list[int]] = {}
+
+    def cell_of(self, x: float, y: float) -> tuple[int, int]:
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def clear(self):
+        self.cells.clear()
+
+    def insert(self, index: int, pos: Vec2):
+        """
+        Adds the thing at the given index of some list, at the given position
+        """
+        self.cells.setdefault(self.cell_of(pos.x, pos.y), []).append(index)
+
+    def query(self, x: float, y: float, radius: float) -> list[int]:
+        """
+        Returns the indices of everything that might be within radius of (x, y),
+        in the order they were inserted
+        """
+        (min_cx, min_cy) = self.cell_of(x - radius, y - radius)
+        (max_cx, max_cy) = self.cell_of(x + radius, y + radius)
+        found = []
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                found += self.cells.get((cx, cy), [])
+        found.sort()
+        return found
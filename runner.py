@@ -3,6 +3,7 @@ from multiprocessing import Process
 from agent import create_agent
 from connections.negotiator import create_negotiator
 from connections.watcher import create_watcher
+from server import create_server
 from game.consts import NUM_PLAYERS
 import time
 
@@ -27,6 +28,8 @@ def run_local_game():
     for name in names[:NUM_PLAYERS]:
         proc = Process(target=create_agent, args=((name, True)))
         player_procs.append(proc)
+    if consts.SERVER_MODE:
+        player_procs.append(Process(target=create_server))
 
     pNeg.start()
     pWat.start()
@@ -36,6 +39,8 @@ def run_local_game():
     time.sleep(60)
     for proc in player_procs:
         proc.terminate()
+    # The negotiator keeps serving lobbies until it is stopped
+    pNeg.terminate()
 
     pNeg.join()
     pWat.join()
@@ -0,0 +1,89 @@
+import time
+from typing import Callable
+from game.consts import FPS, MAX_CATCHUP_STEPS
+
+
+class FixedTimestep:
+    """
+    Runs a tick at a fixed rate no matter how long each tick takes. Elapsed time
+    goes into an accumulator and one tick runs for every step's worth in it, so a
+    slow tick is made up for by running the next ones back to back instead of the
+    whole simulation slowing down. Catching up is capped so that a long stall (a
+    GC pause, a laptop waking up) drops time rather than running hundreds of ticks.
+    """
+
+    def __init__(
+        self,
+        step: float = 1.0 / FPS,
+        max_catchup: int = MAX_CATCHUP_STEPS,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.step = step
+        self.max_catchup = max_catchup
+        self.clock = clock
+        self.sleep = sleep
+        self.accumulator = 0.0
+        self.last = None
+        # Accounting, to tell whether the machine is keeping up
+        self.ticks = 0
+        self.overruns = 0
+        self.worst_overrun = 0.0
+        self.dropped_steps = 0
+
+    def advance(self, elapsed: float) -> int:
+        """
+        Adds elapsed seconds to the accumulator and returns how many ticks are due
+        """
+        self.accumulator += elapsed
+        steps = int(self.accumulator // self.step)
+        if steps > self.max_catchup:
+            self.dropped_steps += steps - self.max_catchup
+            steps = self.max_catchup
+            self.accumulator %= self.step
+        else:
+            self.accumulator -= steps * self.step
+        return steps
+
+    def poll(self) -> int:
+        """
+        Returns how many ticks are due since the last poll, using the clock
+        """
+        now = self.clock()
+        if self.last == None:
+            self.last = now
+            return 1
+        elapsed = now - self.last
+        self.last = now
+        return self.advance(elapsed)
+
+    def run_tick(self, tick: Callable[[], None]):
+        """
+        Runs one tick, noting whether it took longer than a step
+        """
+        start = self.clock()
+        tick()
+        took = self.clock() - start
+        self.ticks += 1
+        if took > self.step:
+            self.overruns += 1
+            self.worst_overrun = max(self.worst_overrun, took - self.step)
+
+    def until_next(self) -> float:
+        """
+        How long until the next tick is due
+        """
+        if self.last == None:
+            return 0.0
+        return max(0.0, self.step - self.accumulator - (self.clock() - self.last))
+
+    def run(self, tick: Callable[[], None], alive: Callable[[], bool]):
+        """
+        Calls tick at the fixed rate for as long as alive() says so
+        """
+        while alive():
+            for _ in range(self.poll()):
+                self.run_tick(tick)
+                if not alive():
+                    return
+            self.sleep(self.until_next())
@@ -2,6 +2,7 @@ from game import consts
 import math
 import errors
 import json
+import copy
 from typing import Union
 from enum import Enum
 
@@ -26,22 +27,75 @@ class Wireable:
 
 class Ping(Wireable):
     """
-    A simple ping message to check if a server is still alive.
+    A health check. The sender numbers each ping and stamps it with its own clock,
+    and the receiver echoes both back as a pong, so the sender can time the round
+    trip without the two clocks having to agree.
     """
 
     @staticmethod
     def unique_char() -> str:
         return "i"
 
+    def __init__(self, seq: int = 0, sent: float = 0.0, pong: bool = False):
+        self.seq = seq
+        self.sent = sent
+        self.pong = pong
+
+    def __str__(self):
+        return f"Ping({self.seq}, {float(self.sent)}, {self.pong})"
+
+    def __eq__(self, other):
+        if type(other) != Ping:
+            return False
+        return str(self) == str(other)
+
+    def encode(self):
+        return f"{Ping.unique_char()}{self.seq}@{float(self.sent)}@{self.pong}{DELIM}".encode()
+
+    @staticmethod
+    def decode(s: bytes) -> "Ping":
+        data = (s.decode())[1:].strip("$")
+        if data == "":
+            # Older peers send a bare ping
+            return Ping()
+        data = data.split("@")
+        return Ping(int(data[0]), float(data[1]), data[2] == "True")
+
+
+class RttReport(Wireable):
+    """
+    The round trip times (seconds) a machine has measured to each of its peers,
+    shared over the health channel so everyone can see the whole RTT matrix, not
+    just their own row.
+    """
+
+    @staticmethod
+    def unique_char() -> str:
+        return "l"
+
+    def __init__(self, rtts: dict[str, float]):
+        self.rtts = rtts
+
     def __str__(self):
-        return "Ping()"
+        return f"RttReport({sorted(self.rtts.items())})"
+
+    def __eq__(self, other):
+        if type(other) != RttReport:
+            return False
+        return str(self) == str(other)
 
     def encode(self):
-        return f"{Ping.unique_char()}{DELIM}".encode()
+        body = "@".join(f"{name}#{float(rtt)}" for name, rtt in self.rtts.items())
+        return f"{RttReport.unique_char()}{body}{DELIM}".encode()
 
     @staticmethod
-    def decode(_) -> "Ping":
-        return Ping()
+    def decode(s: bytes) -> "RttReport":
+        data = (s.decode())[1:].strip("$")
+        rtts = {}
+        for entry in data.split("@") if data != "" else []:
+            (name, rtt) = entry.split("#")
+            rtts[name] = float(rtt)
+        return RttReport(rtts)
 
 
 class CommsRequest(Wireable):
@@ -49,31 +103,46 @@ class CommsRequest(Wireable):
     A message that requests a connection to another player. It must specify the person
     who is connecting's name, as well as what kind of communication they need.
     Valid comms types are:
+    - "peer" for a single socket that multiplexes input, game and health
     - "input" for sending input updates
     - "game" for sending game state updates
     - "watcher" for sending log data to the watcher
     - "health" for sending health checks
+    The requester also picks the codec (see codec.py) that both sides will use
+    to send the hot messages over this connection.
     """
 
     @staticmethod
     def unique_char() -> str:
         return "1"
 
-    def __init__(self, name: str, info: list[str | int], comms_type: str):
+    def __init__(
+        self, name: str, info: list[str | int], comms_type: str, codec: str = "text"
+    ):
         self.name = name
         self.info = info
         self.comms_type = comms_type
+        self.codec = codec
 
     def __str__(self):
-        return f"CommsRequest({self.name}, {self.info}, {self.comms_type})"
+        return (
+            f"CommsRequest({self.name}, {self.info}, {self.comms_type}, {self.codec})"
+        )
+
+    def __eq__(self, other):
+        if type(other) != CommsRequest:
+            return False
+        return str(self) == str(other)
 
     def encode(self):
-        return f"{CommsRequest.unique_char()}{self.name}@{self.info[0]}@{self.info[1]}@{self.comms_type}{DELIM}".encode()
+        return f"{CommsRequest.unique_char()}{self.name}@{self.info[0]}@{self.info[1]}@{self.comms_type}@{self.codec}{DELIM}".encode()
 
     @staticmethod
     def decode(s: bytes) -> "CommsRequest":
-        data = (s.decode())[1:].split("@")
-        return CommsRequest(data[0], [data[1], int(data[2])], data[3])
+        data = (s.decode())[1:].strip("$").split("@")
+        # Older peers don't send a codec, so assume text
+        codec = data[4] if len(data) > 4 else "text"
+        return CommsRequest(data[0], [data[1], int(data[2])], data[3], codec)
 
 
 class CommsResponse(Wireable):
@@ -275,6 +344,7 @@ class Player(Wireable):
         is_casting: bool = False,
         is_david: bool = False,
         score: int = 0,
+        input_seq: int = 0,
     ):
         self.id = id
         self.pos = pos
@@ -285,15 +355,24 @@ class Player(Wireable):
         self.is_casting = is_casting
         self.is_david = is_david
         self.score = score
+        # The last of this player's inputs that the leader has applied
+        self.input_seq = input_seq
 
     def __str__(self):
-        return f"Player({self.id}, {self.pos}, {self.vel}, {self.is_alive}, {float(self.time_till_respawn)}, {int(self.facing)}, {self.is_casting}, {self.is_david}, {self.score})"
+        return f"Player({self.id}, {self.pos}, {self.vel}, {self.is_alive}, {float(self.time_till_respawn)}, {int(self.facing)}, {self.is_casting}, {self.is_david}, {self.score}, {self.input_seq})"
 
     def __eq__(self, other):
         if type(other) != Player:
             return False
         return str(self) == str(other)
 
+    def sim_key(self) -> str:
+        """
+        Everything about the player except input_seq, which changes every tick
+        a prediction client sends input even when nothing else does
+        """
+        return f"Player({self.id}, {self.pos}, {self.vel}, {self.is_alive}, {float(self.time_till_respawn)}, {int(self.facing)}, {self.is_casting}, {self.is_david}, {self.score})"
+
     def encode(self):
         data = (
             self.id,
@@ -307,8 +386,9 @@ class Player(Wireable):
             self.is_casting,
             self.is_david,
             self.score,
+            self.input_seq,
         )
-        return f"{Player.unique_char()}{data[0]}@{data[1]}@{data[2]}@{data[3]}@{data[4]}@{data[5]}@{data[6]}@{data[7]}@{data[8]}@{data[9]}@{data[10]}{DELIM}".encode()
+        return f"{Player.unique_char()}{data[0]}@{data[1]}@{data[2]}@{data[3]}@{data[4]}@{data[5]}@{data[6]}@{data[7]}@{data[8]}@{data[9]}@{data[10]}@{data[11]}{DELIM}".encode()
 
     @staticmethod
     def decode(s: bytes):
@@ -323,6 +403,7 @@ class Player(Wireable):
             data[8] == "True",
             data[9] == "True",
             int(float(data[10])),
+            int(data[11]) if len(data) > 11 else 0,
         )
 
 
@@ -341,14 +422,17 @@ class GameState(Wireable):
         players: list[Player],
         spells: list[Spell],
         spell_count: int = 0,
+        seq: int = 0,
     ):
         self.next_leader = next_leader
         self.players = players
         self.spells = spells
         self.spell_count = spell_count
+        # The simulation tick this state was produced on, used to order snapshots
+        self.seq = seq
 
     def __str__(self):
-        return f"GameState(\n\t{self.next_leader}\n\t{self.players},\n\t{self.spells},\n\t{self.spell_count}\n)"
+        return f"GameState(\n\t{self.next_leader}\n\t{self.players},\n\t{self.spells},\n\t{self.spell_count},\n\t{self.seq}\n)"
 
     def __eq__(self, other):
         if not isinstance(other, GameState):
@@ -370,6 +454,8 @@ class GameState(Wireable):
         result += f"{','.join(spell_encodings)}"
         result += "#"
         result += f"{self.spell_count}"
+        result += "#"
+        result += f"{self.seq}"
         result += DELIM
         return result.encode()
 
@@ -390,7 +476,14 @@ class GameState(Wireable):
                 continue
             spells.append(Spell.decode(spell.encode()))
         spell_count = int(float(data[4]))
-        return GameState(next_leader, players, spells, spell_count)
+        seq = int(data[5]) if len(data) > 5 else 0
+        return GameState(next_leader, players, spells, spell_count, seq)
+
+    def copy(self) -> "GameState":
+        """
+        A deep copy that is safe to keep around while the original is simulated
+        """
+        return copy.deepcopy(self)
 
     def get_worst(self) -> str:
         lowest = (1000, "Z")
@@ -404,6 +497,163 @@ class GameState(Wireable):
         return lowest[1]
 
 
+class GameStateDelta(Wireable):
+    """
+    The changes between two game states produced by the same leader. Only the
+    players and spells that changed since the base snapshot are sent, along with
+    the ids of the spells that disappeared.
+    """
+
+    @staticmethod
+    def unique_char() -> str:
+        return "d"
+
+    def __init__(
+        self,
+        seq: int,
+        base_seq: int,
+        next_leader: tuple[str, int],
+        players: list[Player],
+        spells: list[Spell],
+        removed_spells: list[int],
+        spell_count: int = 0,
+    ):
+        self.seq = seq
+        self.base_seq = base_seq
+        self.next_leader = next_leader
+        self.players = players
+        self.spells = spells
+        self.removed_spells = removed_spells
+        self.spell_count = spell_count
+
+    def __str__(self):
+        return f"GameStateDelta(\n\t{self.seq} <- {self.base_seq}\n\t{self.next_leader}\n\t{self.players},\n\t{self.spells},\n\t{self.removed_spells},\n\t{self.spell_count}\n)"
+
+    def __eq__(self, other):
+        if not isinstance(other, GameStateDelta):
+            return False
+        return str(self) == str(other)
+
+    @staticmethod
+    def between(
+        base: GameState, state: GameState, recipient: Union[str, None] = None
+    ) -> "GameStateDelta":
+        """
+        Computes the delta that turns base into state. Only the recipient needs
+        to know which of their inputs were applied, so a player whose input_seq
+        is all that changed is only sent to themselves
+        """
+        base_players = {player.sim_key(): player for player in base.players}
+
+        def changed(player: Player) -> bool:
+            old = base_players.get(player.sim_key())
+            if old == None:
+                return True
+            return player.id == recipient and player.input_seq != old.input_seq
+
+        base_spells = {str(spell) for spell in base.spells}
+        spell_ids = {spell.id for spell in state.spells}
+        return GameStateDelta(
+            state.seq,
+            base.seq,
+            state.next_leader,
+            [player for player in state.players if changed(player)],
+            [spell for spell in state.spells if str(spell) not in base_spells],
+            [spell.id for spell in base.spells if spell.id not in spell_ids],
+            state.spell_count,
+        )
+
+    def apply(self, base: GameState) -> GameState:
+        """
+        Rebuilds the full game state from the base snapshot it was computed against.
+        NOTE: Does not modify base
+        """
+        changed_players = {player.id: player for player in self.players}
+        players = [
+            changed_players.pop(player.id, None) or copy.deepcopy(player)
+            for player in base.players
+        ]
+        players += list(changed_players.values())
+        changed_spells = {spell.id: spell for spell in self.spells}
+        removed = set(self.removed_spells)
+        spells = [
+            changed_spells.pop(spell.id, None) or copy.deepcopy(spell)
+            for spell in base.spells
+            if spell.id not in removed
+        ]
+        spells += list(changed_spells.values())
+        return GameState(self.next_leader, players, spells, self.spell_count, self.seq)
+
+    def encode(self):
+        player_encodings = []
+        for player in self.players:
+            player_encodings.append(str(player.encode())[2:-2])
+        spell_encodings = []
+        for spell in self.spells:
+            spell_encodings.append(str(spell.encode())[2:-2])
+        result = GameStateDelta.unique_char()
+        result += f"{self.seq}#{self.base_seq}"
+        result += "#"
+        result += f"{self.next_leader[0]}#{self.next_leader[1]}"
+        result += "#"
+        result += f"{','.join(player_encodings)}"
+        result += "#"
+        result += f"{','.join(spell_encodings)}"
+        result += "#"
+        result += f"{','.join(str(id) for id in self.removed_spells)}"
+        result += "#"
+        result += f"{self.spell_count}"
+        result += DELIM
+        return result.encode()
+
+    @staticmethod
+    def decode(s: bytes):
+        data = (s.decode())[1:].strip("$").split("#")
+        players = [
+            Player.decode(player.encode()) for player in data[4].split(",") if player
+        ]
+        spells = [Spell.decode(spell.encode()) for spell in data[5].split(",") if spell]
+        removed = [int(id) for id in data[6].split(",") if id]
+        return GameStateDelta(
+            int(data[0]),
+            int(data[1]),
+            (data[2], int(float(data[3]))),
+            players,
+            spells,
+            removed,
+            int(float(data[7])),
+        )
+
+
+class SnapshotAck(Wireable):
+    """
+    Sent back to the leader to say which snapshot was last applied, so future
+    deltas can be computed against it. A seq of -1 asks for a full keyframe.
+    """
+
+    @staticmethod
+    def unique_char() -> str:
+        return "a"
+
+    def __init__(self, seq: int):
+        self.seq = seq
+
+    def __str__(self):
+        return f"SnapshotAck({self.seq})"
+
+    def __eq__(self, other):
+        if type(other) != SnapshotAck:
+            return False
+        return str(self) == str(other)
+
+    def encode(self):
+        return f"{SnapshotAck.unique_char()}{self.seq}{DELIM}".encode()
+
+    @staticmethod
+    def decode(s: bytes):
+        return SnapshotAck(int((s.decode())[1:].strip("$")))
+
+
 class KeyInput(Wireable):
     """
     The data that defines a key input
@@ -490,12 +740,16 @@ class InputState(Wireable):
         self,
         key_input: KeyInput = KeyInput(False, False, False, False),
         mouse_input: MouseInput = MouseInput(Vec2(0, 0), False, False),
+        seq: int = 0,
     ):
         self.key_input = key_input
         self.mouse_input = mouse_input
+        # Counts up with every input a player sends, so the leader can tell them
+        # which of their inputs it has applied
+        self.seq = seq
 
     def __str__(self):
-        return f"InputState({self.key_input}, {self.mouse_input})"
+        return f"InputState({self.key_input}, {self.mouse_input}, {self.seq})"
 
     def __eq__(self, other):
         if type(other) != InputState:
@@ -503,30 +757,35 @@ class InputState(Wireable):
         return str(self) == str(other)
 
     def encode(self):
-        return f"{InputState.unique_char()}{self.key_input.encode().decode()[:-1]}#{self.mouse_input.encode().decode()[:-1]}{DELIM}".encode()
+        return f"{InputState.unique_char()}{self.key_input.encode().decode()[:-1]}#{self.mouse_input.encode().decode()[:-1]}#{self.seq}{DELIM}".encode()
 
     @staticmethod
     def decode(s: bytes):
-        data = (s.decode())[1:].split("#")
+        data = (s.decode())[1:].strip("$").split("#")
+        seq = int(data[2]) if len(data) > 2 else 0
         return InputState(
-            KeyInput.decode(data[0].encode()), MouseInput.decode(data[1].encode())
+            KeyInput.decode(data[0].encode()),
+            MouseInput.decode(data[1].encode()),
+            seq,
         )
 
 
 class ConnectRequest(Wireable):
     """
-    A request that can be sent to the negotiator to join the game
+    A request that can be sent to the negotiator to join the game, either as a
+    "player" or as the lobby's dedicated "server"
     """
 
     @staticmethod
     def unique_char():
         return "c"
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, role: str = "player"):
         self.name = name
+        self.role = role
 
     def __str__(self):
-        return f"ConnectRequest({self.name})"
+        return f"ConnectRequest({self.name}, {self.role})"
 
     def __eq__(self, other):
         if type(other) != ConnectRequest:
@@ -534,12 +793,13 @@ class ConnectRequest(Wireable):
         return str(self) == str(other)
 
     def encode(self):
-        return f"{ConnectRequest.unique_char()}{self.name}{DELIM}".encode()
+        return f"{ConnectRequest.unique_char()}{self.name}@{self.role}{DELIM}".encode()
 
     @staticmethod
     def decode(s: bytes):
         data = (s.decode())[1:].strip("$").split("@")
-        return ConnectRequest(data[0])
+        role = data[1] if len(data) > 1 else "player"
+        return ConnectRequest(data[0], role)
 
 
 class ConnectResponse(Wireable):
@@ -590,6 +850,7 @@ class Machine(Wireable):
         host_ip: str,
         port: int,
         connections: list[list[Union[str, int]]],
+        server: str = "",
     ) -> None:
         # The name of the machine
         self.name = name
@@ -599,9 +860,11 @@ class Machine(Wireable):
         self.port = port
         # The names of the machines that this machine should connect to
         self.connections = connections
+        # The name of the lobby's dedicated server, if it has one
+        self.server = server
 
     def __str__(self):
-        return f"Machine({self.name}, {self.host_ip}, {self.port}, {self.connections})"
+        return f"Machine({self.name}, {self.host_ip}, {self.port}, {self.connections}, {self.server})"
 
     def __eq__(self, other):
         if type(other) != Machine:
@@ -622,6 +885,7 @@ class Machine(Wireable):
             asJson["host_ip"],
             asJson["port"],
             asJson["connections"],
+            asJson.get("server", ""),
         )
 
 
@@ -658,12 +922,15 @@ class Event(Wireable):
 
 WIREABLE_CLASSES = [
     Ping,
+    RttReport,
     CommsRequest,
     CommsResponse,
     Vec2,
     Spell,
     Player,
     GameState,
+    GameStateDelta,
+    SnapshotAck,
     KeyInput,
     MouseInput,
     InputState,
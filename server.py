@@ -0,0 +1,108 @@
+from connections.consts import CONNECTION_ENGINE
+from connections.manager import ConnectionManager
+from connections.async_manager import AsyncConnectionManager
+from connections.negotiator import join_lobby
+import game.engine as engine
+from game.consts import (
+    SCREEN_WIDTH,
+    SCREEN_HEIGHT,
+    NUM_PLAYERS,
+    LAG_COMPENSATION,
+)
+from game.lag import PositionHistory, view_lag
+from scheduler import FixedTimestep
+from schema import GameState, Player, Vec2, Machine
+from utils import print_success
+from typing import Union
+import random
+import sys
+
+
+class Server:
+    """
+    A dedicated, headless authority for a lobby. It joins the lobby through the
+    negotiator like a player would, but never renders or plays. It runs the
+    authoritative tick on every player's input and broadcasts the results, and
+    never hands leadership to anyone, so every agent is only ever a client
+    """
+
+    def __init__(self, name: str = "server", identity: Union[Machine, None] = None):
+        self.alive = True
+        if identity == None:
+            (self.identity, _) = join_lobby(name, "server", is_alive=lambda: self.alive)
+        else:
+            self.identity = identity
+        manager_class = (
+            AsyncConnectionManager
+            if CONNECTION_ENGINE == "asyncio"
+            else ConnectionManager
+        )
+        # The server ignores game states from anyone else, it is the authority
+        self.conman = manager_class(
+            self.identity, lambda _: None, True, expected_peers=NUM_PLAYERS
+        )
+        self.timestep = FixedTimestep()
+        self.game_state: Union[GameState, None] = None
+        # Where everyone was lately, so hits can be judged from the caster's view
+        self.history = PositionHistory() if LAG_COMPENSATION else None
+        # Nobody else ever writes the server's state, so it is simulated in place
+        self.simulation = engine.Simulation(
+            self.history, lambda name: view_lag(self.conman.rtt_to(name)), shared=False
+        )
+
+    def setup(self):
+        """
+        Connects to every player and places them in the arena
+        """
+        self.conman.initialize()
+        self.game_state = GameState(
+            (self.identity.name, 0),
+            [
+                Player(
+                    name,
+                    Vec2(
+                        random.randint(0, SCREEN_WIDTH),
+                        random.randint(0, SCREEN_HEIGHT),
+                    ),
+                    Vec2(0, 0),
+                )
+                for name in self.conman.peer_names()
+            ],
+            [],
+        )
+        print_success(f"Serving {', '.join(self.conman.peer_names())}")
+
+    def server_tick(self):
+        # Whoever is losing gets to be David, leadership itself never moves
+        self.game_state = self.simulation.step(
+            self.game_state,
+            self.conman.input_map,
+            david=self.game_state.get_worst(),
+        )
+        self.conman.broadcast_game_state(self.game_state)
+
+    def run(self):
+        self.setup()
+        self.timestep.run(self.server_tick, lambda: self.alive)
+
+    def kill(self):
+        self.alive = False
+        self.conman.kill()
+
+
+def create_server(name: str = "server"):
+    """
+    Creates a server and runs it until it is killed
+    """
+    server = False
+    try:
+        server = Server(name)
+        server.run()
+    except:
+        pass
+    if server:
+        server.kill()
+
+
+if __name__ == "__main__":
+    create_server(*sys.argv[1:2])
@@ -1,6 +1,9 @@
 from mocks.mock_socket import socket
 import sys
 
+# asyncio needs the real socket module, so make sure it has it before we swap
+import asyncio
+
 sys.path.append("../..")
 
 
@@ -17,9 +20,11 @@ SOL_SOCKET = 0
 SO_REUSEADDR = 0
 AF_INET = 0
 SOCK_STREAM = 0
+SOCK_DGRAM = 0
 sock_module.SOL_SOCKET = SOL_SOCKET
 sock_module.SO_REUSEADDR = SO_REUSEADDR
 sock_module.AF_INET = AF_INET
 sock_module.SOCK_STREAM = SOCK_STREAM
+sock_module.SOCK_DGRAM = SOCK_DGRAM
 sock_module.socket = socket
 sys.modules["socket"] = sock_module
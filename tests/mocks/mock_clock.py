@@ -0,0 +1,14 @@
+class FakeClock:
+    """
+    A clock that only moves when a test moves it, for anything that takes a
+    time function (and a sleep function)
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
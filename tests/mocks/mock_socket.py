@@ -15,6 +15,7 @@ class socket:
         self.has_listened = False
         self.fake_connects = []
         self.sent: list[bytes] = []
+        self.sent_to: list[tuple[bytes, tuple]] = []
 
     # HELPER FUNCTIONS
 
@@ -63,3 +64,9 @@ class socket:
 
     def sendall(self, bs: bytes):
         self.sent.append(bs)
+
+    def sendto(self, bs: bytes, addr: tuple):
+        self.sent_to.append((bs, addr))
+
+    def recvfrom(self, size) -> tuple[bytes, tuple]:
+        return self.recv(size), ("peer", 1)
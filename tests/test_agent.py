@@ -1,3 +1,4 @@
+import io
 import pytest
 import sys
 from mocks.mock_socket import socket
@@ -6,11 +7,13 @@ from threading import Thread
 
 sys.path.append("..")
 
+import agent as agent_module
 from agent import Agent, create_agent
 from game import consts as gconsts
 from connections import consts as cconsts
 from connections.manager import ConnectionManager
 import schema
+from connections.framing import frame
 
 
 def get_blank_conman() -> ConnectionManager:
@@ -18,11 +21,11 @@ def get_blank_conman() -> ConnectionManager:
         pass
 
     id = schema.Machine("test", "localhost", 8000, [])
-    return ConnectionManager(id, dummy_update_game_state, False)
+    return ConnectionManager(id, dummy_update_game_state, False, queued_sends=False)
 
 
-def get_blank_agent() -> Agent:
-    return Agent("test", None, True)
+def get_blank_agent(predict: bool = False) -> Agent:
+    return Agent("test", None, True, predict)
 
 
 def get_dummy_socket() -> socket:
@@ -43,12 +46,12 @@ def test_negotiate():
 
     agent = get_blank_agent()
     sock = get_dummy_socket()
-    sock.add_fake_send(schema.ConnectResponse(True, True).encode())
-    sock.add_fake_send(schema.Machine("A", "localhost", 2, []).encode())
+    sock.add_fake_send(frame(schema.ConnectResponse(True, True).encode()))
+    sock.add_fake_send(frame(schema.Machine("A", "localhost", 2, []).encode()))
     (mach, leader) = agent.negotiate("A", sock)
 
     assert sock.connected_to == (cconsts.NEGOTIATOR_IP, cconsts.NEGOTIATOR_PORT)
-    assert sock.sent[0] == schema.ConnectRequest("A").encode()
+    assert sock.sent[0] == frame(schema.ConnectRequest("A").encode())
     assert mach.encode() == schema.Machine("A", "localhost", 2, []).encode()
     assert leader
 
@@ -60,7 +63,8 @@ def test_on_update_key():
     agent.conman.broadcast_input = watch.func
     agent.mouse_input = istate.mouse_input
     agent.on_update_key(istate.key_input)
-    assert watch.calls[0][0].encode() == istate.encode()
+    expected = schema.InputState(istate.key_input, istate.mouse_input, 1)
+    assert watch.calls[0][0].encode() == expected.encode()
 
 
 def test_on_update_mouse():
@@ -70,4 +74,111 @@ def test_on_update_mouse():
     agent.conman.broadcast_input = watch.func
     agent.key_input = istate.key_input
     agent.on_update_mouse(istate.mouse_input)
-    assert watch.calls[0][0].encode() == istate.encode()
+    expected = schema.InputState(istate.key_input, istate.mouse_input, 1)
+    assert watch.calls[0][0].encode() == expected.encode()
+
+
+def test_predict_sends_every_tick():
+    agent = get_blank_agent(True)
+    watch = WatchFunc()
+    agent.conman.broadcast_input = watch.func
+    agent.on_update_key(schema.KeyInput(False, True, False, False))
+    # With prediction on, input only goes out on the tick
+    assert watch.calls == []
+    with agent.input_lock:
+        first = agent.next_input()
+        second = agent.next_input()
+    assert (first.seq, second.seq) == (1, 2)
+    assert second.key_input.right
+
+
+def get_ticking_agent() -> Agent:
+    agent = get_blank_agent()
+    agent.fout = io.StringIO()
+    agent.game = WatchFunc()
+    agent.game.take_game_state = agent.game.func
+    agent.was_leader_last_tick = True
+    agent.conman.leader = ("test", 0)
+    agent.conman.broadcast_game_state = WatchFunc().func
+    agent.game_state = schema.GameState(
+        ("test", 0),
+        [schema.Player("test", schema.Vec2(100, 100), schema.Vec2(0, 0))],
+        [],
+    )
+    return agent
+
+
+def test_tick_publishes_new_state():
+    agent = get_ticking_agent()
+    watch = WatchFunc()
+    agent.conman.broadcast_game_state = watch.func
+    agent.conman.input_map["test"] = schema.InputState(
+        schema.KeyInput(False, True, False, False)
+    )
+    before = agent.game_state
+    agent.agent_tick()
+    # The old state is left as it was for anyone still holding it
+    assert before.seq == 0
+    assert before.players[0].pos.x == 100
+    assert agent.game_state is not before
+    assert agent.game_state.seq == 1
+    assert agent.game_state.players[0].pos.x > 100
+    assert watch.calls == [(agent.game_state,)]
+    assert agent.game.calls == [(agent.game_state,)]
+
+
+def test_tick_loses_to_newer_state(monkeypatch):
+    agent = get_ticking_agent()
+    watch = WatchFunc()
+    agent.conman.broadcast_game_state = watch.func
+    remote = schema.GameState(("other", 1), [], [], seq=7)
+
+    def update_game_state(game_state, *args, **kwargs):
+        # A state from a new leader lands while we're simulating
+        agent.snapshot.publish(remote)
+
+    monkeypatch.setattr(agent_module.engine, "update_game_state", update_game_state)
+    agent.agent_tick()
+    assert agent.game_state is remote
+    assert watch.calls == []
+    assert agent.game.calls == [(remote,)]
+
+
+def test_tick_skips_dead_leader():
+    agent = get_ticking_agent()
+    agent.ticks_since_leader_change = cconsts.LEADER_CHANGE_COOLDOWN
+    # The losing player would lead next, but we've given up on them
+    agent.game_state = schema.GameState(
+        ("test", 0),
+        [
+            schema.Player("test", schema.Vec2(100, 100), schema.Vec2(0, 0), score=5),
+            schema.Player("gone", schema.Vec2(200, 100), schema.Vec2(0, 0)),
+        ],
+        [],
+    )
+    agent.conman.health_map["gone"] = cconsts.DEAD
+    agent.agent_tick()
+    assert agent.game_state.next_leader == ("test", 0)
+    agent.conman.health_map["gone"] = cconsts.ALIVE
+    agent.agent_tick()
+    assert agent.game_state.next_leader == ("gone", 1)
+
+
+def test_backup_broadcast_loses_to_newer_state():
+    agent = get_ticking_agent()
+    agent.conman.leader = ("other", 0)
+    watch = WatchFunc()
+    agent.conman.broadcast_game_state = watch.func
+    agent.conman.should_backup_broadcast = lambda: True
+    remote = schema.GameState(("other", 1), [], [], seq=7)
+
+    def stamp_leader(game_state):
+        # The new leader's state lands while we're stamping ours
+        agent.snapshot.publish(remote)
+        return game_state
+
+    agent.conman.stamp_leader = stamp_leader
+    agent.agent_tick()
+    assert agent.game_state is remote
+    assert watch.calls == []
+    assert agent.game.calls == [(remote,)]
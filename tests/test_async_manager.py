@@ -0,0 +1,138 @@
+import pytest
+import sys
+import asyncio
+import time
+
+sys.path.append("..")
+
+from connections.async_manager import AsyncConnectionManager
+import schema
+from connections.framing import frame, FrameReader, tag_channel
+import errors
+
+
+class WatchFunc:
+    def __init__(self):
+        self.calls = []
+
+    def func(self, *args, **kwargs):
+        self.calls.append(args)
+
+
+def get_started_conman(name: str, port: int, watch: WatchFunc):
+    id = schema.Machine(name, "127.0.0.1", port, [])
+    conman = AsyncConnectionManager(id, watch.func, False)
+    conman.log_event = lambda event: None
+    conman.loop_thread.start()
+    asyncio.run_coroutine_threadsafe(conman.serve(), conman.loop).result(5)
+    return conman
+
+
+def test_async_round_trip():
+    awatch = WatchFunc()
+    bwatch = WatchFunc()
+    a = get_started_conman("A", 50911, awatch)
+    b = get_started_conman("B", 50912, bwatch)
+    try:
+        req = schema.CommsRequest("B", ["127.0.0.1", 50912], "peer", "binary")
+        connect = b.open_connection(["127.0.0.1", 50911], req)
+        asyncio.run_coroutine_threadsafe(connect, b.loop).result(5)
+        time.sleep(0.5)
+        assert a.peer_names() == ["B"]
+        assert b.peer_names() == ["A"]
+        assert a.peer_codecs["B"] == "binary"
+
+        # Input goes one way and game state the other, on the same connection
+        b.last_inp_broadcast = 0
+        istate = schema.InputState(schema.KeyInput(True, False, True, False))
+        b.broadcast_input(istate)
+        state = schema.GameState(("A", 0), [], [], seq=5)
+        a.broadcast_game_state(state)
+        time.sleep(0.5)
+
+        assert a.input_map["B"] == istate
+        assert bwatch.calls == [(state,)]
+        assert b.leader == ("A", 0)
+    finally:
+        a.kill()
+        b.kill()
+
+
+def test_async_rejects_unknown_comms():
+    a = get_started_conman("A", 50913, WatchFunc())
+    try:
+
+        async def request_input_socket():
+            stream, writer = await asyncio.open_connection("127.0.0.1", 50913)
+            req = schema.CommsRequest("B", ["127.0.0.1", 1], "input")
+            writer.write(frame(req.encode()))
+            data = await stream.read(1024)
+            writer.close()
+            return data
+
+        data = asyncio.run_coroutine_threadsafe(request_input_socket(), a.loop)
+        resp = schema.wire_decode(FrameReader().feed(data.result(5))[0])
+        assert type(resp) == schema.CommsResponse and not resp.accepted
+        assert a.peer_names() == []
+    finally:
+        a.kill()
+
+
+class FakeTransport:
+    def get_write_buffer_size(self) -> int:
+        return 1 << 20
+
+
+class FakeWriter:
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.written = []
+
+    def is_closing(self) -> bool:
+        return False
+
+    def write(self, data: bytes):
+        self.written.append(data)
+
+
+def test_async_full_buffer():
+    conman = AsyncConnectionManager(
+        schema.Machine("A", "127.0.0.1", 1, []), None, False
+    )
+    writer = FakeWriter()
+    conman.peer_sockets = {"B": writer}
+    # A backed up peer misses plain game states, the next one supersedes them
+    conman.write("B", "game", b"state", reliable=False, coalesce=True)
+    assert writer.written == []
+    # But never handoffs, acks or anything else
+    conman.write("B", "game", b"handoff", reliable=True, coalesce=True)
+    conman.write("B", "game", b"ack")
+    conman.write("B", "input", b"input", reliable=False)
+    assert writer.written == [
+        frame(tag_channel("game", b"handoff")),
+        frame(tag_channel("game", b"ack")),
+        frame(tag_channel("input", b"input")),
+    ]
+
+
+def test_async_rejects_udp():
+    with pytest.raises(errors.UnsupportedTransport):
+        AsyncConnectionManager(
+            schema.Machine("A", "127.0.0.1", 1, []), None, False, transport="udp"
+        )
+
+
+def test_async_initialize_without_watcher():
+    a = get_started_conman("A", 50914, WatchFunc())
+    id = schema.Machine("B", "127.0.0.1", 50915, [["127.0.0.1", 50914]])
+    b = AsyncConnectionManager(id, WatchFunc().func, False, expected_peers=1)
+    b.log_event = lambda event: None
+    try:
+        start = time.monotonic()
+        # Nobody is watching, which doesn't hold up starting the game
+        b.initialize()
+        assert time.monotonic() - start < 2
+        assert b.peer_names() == ["A"]
+    finally:
+        a.kill()
+        b.kill()
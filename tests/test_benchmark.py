@@ -0,0 +1,28 @@
+import pytest
+import sys
+
+sys.path.append("..")
+
+import benchmark
+
+
+def test_make_lobby():
+    (state, bots) = benchmark.make_lobby(4, 10)
+    assert len(state.players) == 4
+    assert len(state.spells) == 10
+    assert [bot.player_id for bot in bots] == [p.id for p in state.players]
+
+
+def test_bench_lobby():
+    result = benchmark.bench_lobby(3, 20, 5, 2)
+    assert result["ticks_per_sec"] > 0
+    assert result["binary_bytes"] < result["text_bytes"]
+    assert result["text_encode_us"] > 0
+
+
+def test_compare():
+    baseline = {"lobby": {"ticks_per_sec": 100, "text_encode_us": 10, "text_bytes": 5}}
+    same = {"lobby": {"ticks_per_sec": 95, "text_encode_us": 10.5, "text_bytes": 50}}
+    worse = {"lobby": {"ticks_per_sec": 50, "text_encode_us": 20, "text_bytes": 5}}
+    assert benchmark.compare(same, baseline) == []
+    assert len(benchmark.compare(worse, baseline)) == 2
@@ -0,0 +1,75 @@
+"""
+This file tests the wire codecs. The binary codec should round trip the same
+messages as the text format, and receivers should be able to decode either.
+"""
+
+import pytest
+import sys
+
+sys.path.append("..")
+from schema import Vec2, Spell, Player, GameState, GameStateDelta, InputState
+import codec
+import errors
+
+SPELL = Spell(1, Vec2(1.5, 2), Vec2(3, -4.25), "creator")
+PLAYER = Player("test", Vec2(1, 2), Vec2(3, 4), False, 40, 2, True, True, 7, 99)
+GAME_STATE = GameState(
+    ("test", 3),
+    [PLAYER, Player("other", Vec2(0.1, 0.2), Vec2(0, 0))],
+    [SPELL, Spell(2, Vec2(5, 6), Vec2(7, 8), "test")],
+    3,
+)
+BINARY = codec.get_codec("binary")
+TEXT = codec.get_codec("text")
+
+
+def test_binary_round_trip():
+    for msg in [SPELL, PLAYER, GAME_STATE]:
+        assert BINARY.decode(BINARY.encode(msg)) == msg
+        assert codec.decode(BINARY.encode(msg)) == msg
+
+
+def test_binary_empty_game_state():
+    state = GameState(("", -1), [], [])
+    assert codec.decode(BINARY.encode(state)) == state
+
+
+def test_binary_smaller_than_text():
+    # Positions mid game are rarely round numbers
+    vel = Vec2(3, 4).normalized() * 6
+    state = GameState(
+        ("player", 12),
+        [Player(f"player{i}", Vec2(i * 31.337, i * 17.123), vel) for i in range(8)],
+        [Spell(i, Vec2(i * 3.14159, 100.0 / 3), vel, "player1") for i in range(20)],
+        20,
+    )
+    assert len(BINARY.encode(state)) < len(TEXT.encode(state))
+
+
+def test_binary_falls_back_to_text():
+    istate = InputState()
+    assert BINARY.encode(istate) == istate.encode()
+    assert codec.decode(BINARY.encode(istate)) == istate
+
+
+def test_decode_text():
+    assert codec.decode(TEXT.encode(GAME_STATE)) == GAME_STATE
+
+
+def test_binary_truncated():
+    with pytest.raises(errors.InvalidMessage):
+        codec.decode(BINARY.encode(GAME_STATE)[:-3])
+
+
+def test_unknown_codec():
+    with pytest.raises(errors.UnknownComms):
+        codec.get_codec("morse")
+
+
+def test_binary_delta_round_trip():
+    state = GAME_STATE.copy()
+    state.players[1].pos = Vec2(50, 60)
+    state.spells = state.spells[1:]
+    state.seq = 4
+    delta = GameStateDelta.between(GAME_STATE, state)
+    assert codec.decode(BINARY.encode(delta)) == delta
@@ -0,0 +1,69 @@
+import pytest
+import sys
+
+sys.path.append("..")
+
+from connections.election import LeaderPolicy, pair_rtt
+from connections.consts import UNKNOWN_RTT
+from schema import GameState, Player, Vec2
+
+
+def get_state(scores: dict[str, int]) -> GameState:
+    return GameState(
+        ("A", 0),
+        [
+            Player(name, Vec2(0, 0), Vec2(0, 0), score=score)
+            for name, score in scores.items()
+        ],
+        [],
+    )
+
+
+def test_pair_rtt():
+    matrix = {"A": {"B": 0.1}, "B": {"A": 0.3}}
+    assert pair_rtt(matrix, "A", "B") == pytest.approx(0.2)
+    assert pair_rtt(matrix, "A", "A") == 0.0
+    assert pair_rtt(matrix, "A", "C") == UNKNOWN_RTT
+
+
+def test_no_measurements_picks_loser():
+    policy = LeaderPolicy(max_rtt=0.15, hysteresis=0.02)
+    state = get_state({"A": 2, "L": 0, "B": 1})
+    assert policy.choose(state, {}) == state.get_worst()
+    assert policy.choose(state, {}, current="A") == "L"
+
+
+def test_avoids_leaving_others_behind():
+    policy = LeaderPolicy(max_rtt=0.15, hysteresis=0.02)
+    state = get_state({"A": 2, "L": 0, "B": 1})
+    # L is far from B, but A is close to both
+    matrix = {"L": {"A": 0.05, "B": 0.2}, "A": {"B": 0.05}}
+    assert policy.choose(state, matrix) == "A"
+    # If everyone is close enough to L, L leads
+    matrix["L"]["B"] = 0.1
+    assert policy.choose(state, matrix) == "L"
+
+
+def test_hysteresis():
+    policy = LeaderPolicy(max_rtt=0.1, hysteresis=0.02)
+    state = get_state({"A": 2, "L": 0, "B": 1, "C": 3})
+    # L is too far from C to lead
+    matrix = {"L": {"A": 0.05, "B": 0.06, "C": 0.3}}
+    assert policy.choose(state, matrix) == "A"
+    # A is a little better for L than B, but not enough to move
+    assert policy.choose(state, matrix, current="B") == "B"
+    matrix["L"]["B"] = 0.08
+    assert policy.choose(state, matrix, current="B") == "A"
+
+
+def test_loser_leads_on_a_fast_network():
+    policy = LeaderPolicy(max_rtt=0.15, hysteresis=0.02)
+    state = get_state({"A": 5, "B": 0, "C": 2})
+    matrix = {
+        "A": {"B": 0.002, "C": 0.002},
+        "B": {"A": 0.002, "C": 0.002},
+        "C": {"A": 0.002, "B": 0.002},
+    }
+    # The current leader is winning, so they hand over even though every
+    # candidate is within the hysteresis of each other
+    assert policy.choose(state, matrix, current="A") == "B"
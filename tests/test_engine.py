@@ -0,0 +1,55 @@
+import pytest
+import sys
+
+sys.path.append("..")
+
+import game.consts as consts
+import game.engine as engine
+from schema import GameState, InputState, KeyInput, MouseInput, Player, Spell, Vec2
+
+
+def get_input(right=False, up=False, casting=False, aim=Vec2(0, 0)) -> InputState:
+    return InputState(
+        KeyInput(False, right, up, False), MouseInput(aim, False, casting, 0.0)
+    )
+
+
+def test_moves_player():
+    player = Player("A", Vec2(100, 100), Vec2(0, 0))
+    state = GameState(("A", 0), [player], [])
+    engine.update_game_state(state, {"A": get_input(right=True)}, "A")
+    assert state.players[0].pos == Vec2(100 + consts.PLAYER_SPEED, 100)
+    assert state.players[0].vel == Vec2(consts.PLAYER_SPEED, 0)
+    assert state.players[0].facing == consts.RIGHT
+    assert state.seq == 1
+
+
+def test_keeps_player_in_arena():
+    player = Player("A", Vec2(consts.SCREEN_WIDTH - 1, 0), Vec2(0, 0))
+    state = GameState(("A", 0), [player], [])
+    engine.update_game_state(state, {"A": get_input(right=True)}, "A")
+    assert state.players[0].pos == Vec2(consts.SCREEN_WIDTH, 0)
+
+
+def test_cast_spell_on_release():
+    player = Player("A", Vec2(100, 100), Vec2(0, 0), is_casting=True)
+    state = GameState(("A", 0), [player], [])
+    engine.update_game_state(state, {"A": get_input(aim=Vec2(200, 100))}, "A")
+    assert state.spell_count == 1
+    assert len(state.spells) == 1
+    assert state.spells[0].creator == "A"
+    # It has already moved once this tick
+    assert state.spells[0].pos == Vec2(100 + consts.SPELL_SPEED_MIN, 100)
+
+
+def test_culls_spells():
+    state = GameState(
+        ("A", 0),
+        [],
+        [
+            Spell(1, Vec2(1, 1), Vec2(-2, 0), "A"),
+            Spell(2, Vec2(1, 1), Vec2(2, 0), "A"),
+        ],
+    )
+    engine.update_game_state(state, {}, "A")
+    assert [spell.id for spell in state.spells] == [2]
@@ -0,0 +1,73 @@
+import pytest
+import sys
+from mocks.mock_socket import socket
+
+sys.path.append("..")
+
+from connections.framing import (
+    FrameReader,
+    frame,
+    send_frame,
+    tag_channel,
+    untag_channel,
+)
+import errors
+import schema
+
+
+def get_dummy_socket() -> socket:
+    return socket(-1, -1)
+
+
+def test_send_frame():
+    sock = get_dummy_socket()
+    send_frame(sock, b"hello")
+    assert sock.sent == [b"\x00\x00\x00\x05hello"]
+
+
+def test_feed_partial():
+    reader = FrameReader()
+    data = frame(b"hello")
+    assert reader.feed(data[:3]) == []
+    assert reader.feed(data[3:6]) == []
+    assert reader.feed(data[6:]) == [b"hello"]
+
+
+def test_feed_multiple():
+    reader = FrameReader()
+    data = frame(b"one") + frame(b"") + frame(b"three")
+    assert reader.feed(data + frame(b"four")[:2]) == [b"one", b"", b"three"]
+    assert reader.feed(frame(b"four")[2:]) == [b"four"]
+
+
+def test_recv_coalesced_and_split():
+    # Two game states arrive in one read and a third is split over two
+    states = [schema.GameState((str(i), i), [], []) for i in range(3)]
+    data = b"".join(frame(state.encode()) for state in states)
+    sock = get_dummy_socket()
+    sock.add_fake_send(data[:-4])
+    sock.add_fake_send(data[-4:])
+    reader = FrameReader(sock)
+    assert [schema.wire_decode(reader.recv()) for _ in range(3)] == states
+
+
+def test_recv_closed():
+    sock = get_dummy_socket()
+    sock.add_fake_send(frame(b"last")[:5])
+    sock.add_fake_send(b"")
+    reader = FrameReader(sock)
+    with pytest.raises(errors.CommsDied):
+        reader.recv()
+
+
+def test_frame_too_large():
+    reader = FrameReader()
+    with pytest.raises(errors.CommsDied):
+        reader.feed(b"\xff\xff\xff\xff")
+
+
+def test_channel_tags():
+    for channel in ["input", "game", "health"]:
+        assert untag_channel(tag_channel(channel, b"msg")) == (channel, b"msg")
+    with pytest.raises(errors.InvalidMessage):
+        untag_channel(b"\x09msg")
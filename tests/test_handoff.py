@@ -0,0 +1,28 @@
+import pytest
+import sys
+
+sys.path.append("..")
+
+from game.handoff import SnapshotSlot
+import schema
+
+
+def test_publish():
+    slot = SnapshotSlot()
+    assert slot.get() == None
+    first = schema.GameState(("A", 0), [], [])
+    slot.publish(first)
+    assert slot.get() is first
+
+
+def test_publish_if():
+    first = schema.GameState(("A", 0), [], [])
+    slot = SnapshotSlot(first)
+    # A tick that started from the newest state gets to publish
+    second = schema.GameState(("A", 0), [], [], seq=1)
+    assert slot.publish_if(first, second)
+    assert slot.get() is second
+    # One that started from an older state loses to whatever came since
+    third = schema.GameState(("A", 0), [], [], seq=2)
+    assert not slot.publish_if(first, third)
+    assert slot.get() is second
@@ -0,0 +1,48 @@
+import pytest
+import sys
+from mocks.mock_clock import FakeClock
+
+sys.path.append("..")
+
+from connections.health import HealthTracker
+from schema import Ping
+
+
+def echo(ping: Ping) -> Ping:
+    return Ping(ping.seq, ping.sent, True)
+
+
+def test_smooths_rtt():
+    clock = FakeClock()
+    tracker = HealthTracker(timeout=2.0, clock=clock.time)
+    assert tracker.stats() == {"rtt": None, "jitter": 0.0, "loss": 0.0}
+    ping = tracker.ping()
+    clock.now += 0.5
+    assert tracker.pong(echo(ping)) == 0.5
+    assert tracker.srtt == 0.5
+    assert tracker.jitter == 0.25
+    # A slower one only pulls it part of the way
+    ping = tracker.ping()
+    clock.now += 1.5
+    assert tracker.pong(echo(ping)) == 1.5
+    assert tracker.srtt == 0.5 + 1.0 / 8
+    assert tracker.jitter == 0.25 + (1.0 - 0.25) / 4
+    assert tracker.last_heard == 2.0
+
+
+def test_counts_loss():
+    clock = FakeClock()
+    tracker = HealthTracker(window=4, timeout=2.0, clock=clock.time)
+    lost = tracker.ping()
+    clock.now += 1.0
+    tracker.pong(echo(tracker.ping()))
+    assert tracker.loss() == 0.0
+    clock.now += 1.5
+    assert tracker.loss() == 0.5
+    # Too late to count now
+    assert tracker.pong(echo(lost)) == None
+    assert tracker.srtt == 0.0
+    # Only the last few pings count
+    for _ in range(4):
+        tracker.pong(echo(tracker.ping()))
+    assert tracker.loss() == 0.0
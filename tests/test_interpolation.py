@@ -0,0 +1,112 @@
+import pytest
+import sys
+from mocks.mock_clock import FakeClock
+
+sys.path.append("..")
+
+from game.interpolation import SnapshotBuffer
+from schema import GameState, Player, Spell, Vec2
+
+
+def get_state(seq: int, x: float, me_x: float = 0, alive=True) -> GameState:
+    return GameState(
+        ("L", 0),
+        [
+            Player("them", Vec2(x, 100), Vec2(0, 0), is_alive=alive),
+            Player("me", Vec2(me_x, 0), Vec2(0, 0)),
+        ],
+        [Spell(1, Vec2(x, 200), Vec2(1, 0), "them")],
+        seq=seq,
+    )
+
+
+def get_buffer(clock: FakeClock) -> SnapshotBuffer:
+    # 30 FPS, so 3 ticks is 0.1 seconds
+    return SnapshotBuffer("me", 0.1, 4, clock.time)
+
+
+def test_empty():
+    assert get_buffer(FakeClock()).sample() == None
+
+
+def test_blends_between_snapshots():
+    clock = FakeClock()
+    snapshots = get_buffer(clock)
+    snapshots.push(get_state(0, 100))
+    clock.now = 0.1
+    snapshots.push(get_state(3, 130, me_x=50))
+    clock.now = 0.15
+    state = snapshots.sample()
+    assert state.players[0].pos.x == pytest.approx(115)
+    assert state.spells[0].pos.x == pytest.approx(115)
+    # Our own player is always the newest
+    assert state.players[1].pos.x == 50
+
+
+def test_holds_latest_when_late():
+    clock = FakeClock()
+    snapshots = get_buffer(clock)
+    snapshots.push(get_state(0, 100))
+    clock.now = 0.1
+    snapshots.push(get_state(3, 130))
+    clock.now = 1.0
+    assert snapshots.sample().players[0].pos.x == 130
+
+
+def test_reordered_snapshots():
+    clock = FakeClock()
+    snapshots = get_buffer(clock)
+    snapshots.push(get_state(0, 100))
+    clock.now = 0.2
+    snapshots.push(get_state(6, 160))
+    # An older snapshot shows up late, it still goes in the right place
+    snapshots.push(get_state(3, 110))
+    assert [seq for seq, _ in snapshots.snapshots] == [0, 3, 6]
+    # The late arrival only nudges the clock back a little
+    assert snapshots.offset == pytest.approx(-0.005)
+    clock.now = 0.25
+    assert snapshots.sample().players[0].pos.x == pytest.approx(132.5)
+
+
+def test_no_blend_across_respawn():
+    clock = FakeClock()
+    snapshots = get_buffer(clock)
+    snapshots.push(get_state(0, 100, alive=False))
+    clock.now = 0.1
+    snapshots.push(get_state(3, 105))
+    clock.now = 0.15
+    assert snapshots.sample().players[0].pos.x == 105
+
+
+def test_buffer_size():
+    clock = FakeClock()
+    snapshots = get_buffer(clock)
+    for seq in range(10):
+        snapshots.push(get_state(seq, seq))
+    assert [seq for seq, _ in snapshots.snapshots] == [6, 7, 8, 9]
+
+
+def test_same_seq_keeps_clock():
+    clock = FakeClock()
+    snapshots = get_buffer(clock)
+    snapshots.push(get_state(0, 100))
+    # Prediction publishes the same seq again every tick
+    clock.now = 0.3
+    state = get_state(0, 100, me_x=50)
+    snapshots.push(state)
+    assert snapshots.offset == 0
+    assert snapshots.snapshots == [(0, state)]
+
+
+def test_live_snapshots_skip_the_delay():
+    clock = FakeClock()
+    snapshots = get_buffer(clock)
+    snapshots.push(get_state(0, 100))
+    clock.now = 0.1
+    # As the leader our own states are drawn the moment they're made
+    state = get_state(3, 130)
+    snapshots.push(state, live=True)
+    assert snapshots.sample() is state
+    clock.now = 0.2
+    snapshots.push(get_state(6, 160))
+    assert snapshots.sample().players[0].pos.x == 130
@@ -0,0 +1,85 @@
+import pytest
+import sys
+
+sys.path.append("..")
+
+import game.consts as consts
+import game.engine as engine
+from game.lag import PositionHistory, view_lag
+from schema import GameState, InputState, KeyInput, MouseInput, Player, Spell, Vec2
+
+RIGHT = InputState(
+    KeyInput(False, True, False, False), MouseInput(Vec2(0, 0), False, False, 0.0)
+)
+
+
+def get_running_state() -> GameState:
+    """
+    A stands still while B runs right
+    """
+    return GameState(
+        ("A", 0),
+        [
+            Player("A", Vec2(100, 300), Vec2(0, 0)),
+            Player("B", Vec2(100, 100), Vec2(0, 0)),
+        ],
+        [],
+    )
+
+
+def run(state: GameState, history: PositionHistory, ticks: int, get_lag=None):
+    for _ in range(ticks):
+        engine.update_game_state(state, {"B": RIGHT}, "A", history, get_lag)
+
+
+def test_seen_by():
+    history = PositionHistory(max_rewind=3 / consts.FPS)
+    state = get_running_state()
+    run(state, history, 5)
+    assert state.seq == 5
+    # Nothing to rewind
+    assert history.seen_by(5, 0) == {}
+    (pos, is_alive) = history.seen_by(5, 2 / consts.FPS)["B"]
+    assert pos == Vec2(100 + 3 * consts.PLAYER_SPEED, 100)
+    assert is_alive
+    # Never further back than max_rewind
+    (pos, _) = history.seen_by(5, 1.0)["B"]
+    assert pos == Vec2(100 + 2 * consts.PLAYER_SPEED, 100)
+    # Or further back than we remember
+    assert history.seen_by(10, 2 / consts.FPS) == {}
+
+
+def test_hits_where_caster_saw_target():
+    # A fires a still spell at where B was 3 ticks ago, B has since run off
+    lags = {"A": 3 / consts.FPS, "B": 0}
+    for get_lag, should_hit in [(None, False), (lags.get, True)]:
+        state = get_running_state()
+        history = PositionHistory()
+        run(state, history, 6)
+        spell_pos = Vec2(100 + 4 * consts.PLAYER_SPEED, 100 - 4)
+        state.spells.append(Spell(1, spell_pos, Vec2(0, 0), "A"))
+        run(state, history, 1, get_lag)
+        assert state.players[1].is_alive != should_hit
+        assert state.players[0].score == (1 if should_hit else 0)
+
+
+def test_no_hit_while_dead_in_the_past():
+    state = get_running_state()
+    history = PositionHistory()
+    run(state, history, 2)
+    state.players[1].is_alive = False
+    state.players[1].time_till_respawn = 3
+    run(state, history, 2)
+    assert state.players[1].is_alive
+    # B is back, but A is still looking at the tick B was dead on
+    state.spells.append(Spell(1, state.players[1].pos - Vec2(0, 4), Vec2(0, 0), "A"))
+    run(state, history, 1, {"A": 2 / consts.FPS, "B": 0}.get)
+    assert state.players[1].is_alive
+
+
+def test_view_lag():
+    assert view_lag(0.05) == pytest.approx(consts.INTERPOLATION_DELAY + 0.05)
+    # No round trip measured yet, only the interpolation delay counts
+    assert view_lag(None) == consts.INTERPOLATION_DELAY
+    # The leader sees its own game as it is
+    assert view_lag(0.05, local=True) == 0
@@ -2,12 +2,18 @@ import pytest
 import sys
 from mocks.mock_socket import socket
 import time
-from threading import Thread
+from threading import Event, Thread
 
 sys.path.append("..")
 
-from connections.manager import ConnectionManager, TICKS_PER_WATCH
+import connections.manager as manager
+from connections.manager import ConnectionManager, TICKS_PER_WATCH, outranks
+import connections.consts as cconsts
+from connections.consts import ALIVE, SUS, DEAD
 import schema
+import errors
+import codec
+from connections.framing import frame, FrameReader, tag_channel
 
 
 def get_blank_conman() -> ConnectionManager:
@@ -15,14 +21,14 @@ def get_blank_conman() -> ConnectionManager:
         pass
 
     id = schema.Machine("test", "localhost", 8000, [])
-    return ConnectionManager(id, dummy_update_game_state, False)
+    return ConnectionManager(id, dummy_update_game_state, False, queued_sends=False)
 
 
 def get_dummy_socket() -> socket:
     return socket(-1, -1)
 
 
-def dummy_func(name):
+def dummy_func(name, reader=None):
     pass
 
 
@@ -54,10 +60,25 @@ def test_register_connection():
     assert conman.watcher_sock == sock
 
 
+def test_register_connection_peer():
+    conman = get_blank_conman()
+    conman.consume_peer = dummy_func
+    sock = get_dummy_socket()
+
+    peer_req = schema.CommsRequest("test", ["localhost", 6], "peer")
+    conman.register_connection(sock, peer_req, "to")
+
+    assert conman.peer_sockets == {"to": sock}
+    assert conman.peer_names() == ["to"]
+    assert conman.peers_on("game") == ["to"]
+
+
 def test_listen():
     conman = get_blank_conman()
     sock = get_dummy_socket()
-    sock.add_fake_send(schema.CommsRequest("name", ["localhost", 6], "input").encode())
+    sock.add_fake_send(
+        frame(schema.CommsRequest("name", ["localhost", 6], "input").encode())
+    )
     listen_thread = Thread(target=conman.listen, args=(sock,))
     listen_thread.start()
     time.sleep(0.5)
@@ -74,8 +95,8 @@ def test_connect():
     sock = get_dummy_socket()
     info = ["localhost", 6]
     req = schema.CommsRequest("name", ["localhost", 6], "input")
-    sock.add_fake_send(schema.CommsResponse("other", True).encode())
-    conman.connect(info, req, sock)
+    sock.add_fake_send(frame(schema.CommsResponse("other", True).encode()))
+    assert conman.connect(info, req, sock) == "other"
     assert "other" in conman.input_sockets
     assert sock.connected_to == (info[0], info[1])
     assert len(sock.sent) == 1
@@ -89,31 +110,124 @@ def test_initialize():
     lwatch = WatchFunc()
     conman.connect = cwatch.func
     conman.listen = lwatch.func
-    # Fill up the input sockets to avoid infinite loop at the end
-    conman.input_sockets = {str(v): get_dummy_socket() for v in range(8)}
+    # Fill up the peer sockets so the mesh is already complete at the end
+    conman.peer_sockets = {str(v): get_dummy_socket() for v in range(8)}
     # Add a peer that this machine should connect to
     conman.identity.connections = [["localhost", 6]]
     conman.initialize()
+    conman.watcher_thread.join(1)
 
-    # Make sure we've connected to the right places
-    assert len(cwatch.calls) == 4
-    assert (
-        type(cwatch.calls[0][1]) == schema.CommsRequest
-        and cwatch.calls[0][1].comms_type == "watcher"
-    )
-    assert (
-        type(cwatch.calls[1][1]) == schema.CommsRequest
-        and cwatch.calls[1][1].comms_type == "input"
-    )
-    assert (
-        type(cwatch.calls[2][1]) == schema.CommsRequest
-        and cwatch.calls[2][1].comms_type == "game"
-    )
-    assert (
-        type(cwatch.calls[3][1]) == schema.CommsRequest
-        and cwatch.calls[3][1].comms_type == "health"
-    )
+    # Make sure we've connected to the right places, they're dialled at once so
+    # in no particular order. A single multiplexed connection per peer
+    assert len(cwatch.calls) == 2
+    assert sorted(call[1].comms_type for call in cwatch.calls) == ["peer", "watcher"]
     assert len(lwatch.calls) == 1
+    # Nobody answered
+    assert conman.links == {"127.0.0.1:50052": None, "localhost:6": None}
+
+
+def test_connect_all(monkeypatch):
+    monkeypatch.setattr(manager, "backoff_delay", lambda attempt: 0.01)
+    conman = get_blank_conman()
+    req = schema.CommsRequest("test", ["localhost", 5], "peer")
+
+    def fake_dial(info, req, isock=None):
+        if info[1] == 3:
+            raise ConnectionRefusedError(111, "Connection refused")
+        time.sleep(0.2)
+        return f"peer{info[1]}"
+
+    conman.dial = fake_dial
+    targets = [(["localhost", port], req) for port in [1, 2, 3]]
+    start = time.monotonic()
+    names = conman.connect_all(targets, timeout=0.5)
+    # Everyone is dialled at once, and the one who never answers is given up on
+    assert names == ["peer1", "peer2", None]
+    assert time.monotonic() - start < 0.55
+    conman.report_links(targets, names)
+    assert conman.links == {
+        "localhost:1": "peer1",
+        "localhost:2": "peer2",
+        "localhost:3": None,
+    }
+
+
+def test_initialize_without_watcher():
+    conman = get_blank_conman()
+    conman.listen = lambda: None
+    conman.peer_sockets = {str(v): get_dummy_socket() for v in range(8)}
+    conman.identity.connections = [["localhost", 6]]
+    hang_up = Event()
+
+    def connect(info, req, isock=None, deadline=None):
+        # Nobody is watching, so dialling the watcher would take until the deadline
+        if req.comms_type == "watcher":
+            hang_up.wait(5)
+            return None
+        return "peer"
+
+    conman.connect = connect
+    start = time.monotonic()
+    conman.initialize()
+    assert time.monotonic() - start < 1
+    assert conman.watcher_thread.is_alive()
+    hang_up.set()
+
+
+def test_connect_all_until():
+    conman = get_blank_conman()
+    req = schema.CommsRequest("test", ["localhost", 5], "peer")
+    hang_up = Event()
+    conman.connect = lambda info, req, deadline=None: hang_up.wait(5)
+    ready = Event()
+    ready.set()
+    start = time.monotonic()
+    # Everyone we're waiting for is already here, so the dials don't matter
+    assert conman.connect_all([(["localhost", 1], req)], until=ready) == [None]
+    assert time.monotonic() - start < 1
+    hang_up.set()
+
+
+def test_mesh_ready():
+    conman = get_blank_conman()
+    conman.expected_peers = 2
+    conman.consume_peer = dummy_func
+    conman.consume_input = dummy_func
+    conman.consume_game_state = dummy_func
+    conman.register_connection(
+        get_dummy_socket(), schema.CommsRequest("a", ["localhost", 1], "peer"), "a"
+    )
+    assert not conman.mesh_ready.is_set()
+    # An older peer counts once all its channels are up
+    for channel in ["input", "game"]:
+        req = schema.CommsRequest("b", ["localhost", 2], channel)
+        conman.register_connection(get_dummy_socket(), req, "b")
+    assert not conman.mesh_ready.is_set()
+    waiter = Thread(target=conman.wait_for_mesh)
+    waiter.start()
+    req = schema.CommsRequest("b", ["localhost", 2], "health")
+    conman.register_connection(get_dummy_socket(), req, "b")
+    waiter.join(1)
+    assert not waiter.is_alive()
+    assert conman.ready_peers() == ["a", "b"]
+
+
+def test_partial_mesh():
+    missing = []
+    conman = get_blank_conman()
+    conman.expected_peers = 2
+    conman.on_partial_mesh = missing.append
+    conman.peer_sockets = {"a": get_dummy_socket()}
+    start = time.monotonic()
+    assert not conman.wait_for_mesh(0.1)
+    assert time.monotonic() - start < 0.5
+    assert missing == [["a"]]
+
+
+def test_no_watcher():
+    conman = get_blank_conman()
+    # Without a watcher events are just dropped
+    conman.send_watcher(schema.Event("input", "source", "sink").encode())
 
 
 def test_log_event():
@@ -128,7 +242,7 @@ def test_log_event():
     conman.log_event(ievent)
     conman.log_event(gevent)
 
-    assert sock.sent == [b"einput@source@sink$", b"egame@source@sink$"]
+    assert sock.sent == [frame(b"einput@source@sink$"), frame(b"egame@source@sink$")]
 
 
 def test_consume_input():
@@ -138,12 +252,28 @@ def test_consume_input():
 
     # Create fake input state and make sure it gets put into the input_map
     fake_input = schema.InputState()
-    sock.add_fake_send(fake_input.encode())
+    sock.add_fake_send(frame(fake_input.encode()))
 
     conman.consume_input("test")
     assert conman.input_map["test"] == fake_input
 
 
+def test_stale_input():
+    conman = get_blank_conman()
+    right = schema.KeyInput(False, True, False, False)
+    newer = schema.InputState(
+        right, schema.MouseInput(schema.Vec2(0, 0), False, False), 5
+    )
+    older = schema.InputState(seq=4)
+    conman.handle_input("peer", newer.encode())
+    # A retransmission of an older input doesn't undo the newer one
+    conman.handle_input("peer", older.encode())
+    conman.handle_input("peer", newer.encode())
+    assert conman.input_map["peer"] == newer
+    conman.handle_input("peer", schema.InputState(seq=6).encode())
+    assert conman.input_map["peer"].seq == 6
+
+
 def test_consume_game_state_normal():
     conman = get_blank_conman()
     sock = get_dummy_socket()
@@ -151,7 +281,7 @@ def test_consume_game_state_normal():
 
     # Create fake game state and make sure it gets called by update game state
     fake_state = schema.GameState(("new", 0), [], [])
-    sock.add_fake_send(fake_state.encode())
+    sock.add_fake_send(frame(fake_state.encode()))
 
     watch = WatchFunc()
     conman.update_game_state = watch.func
@@ -173,7 +303,7 @@ def test_consume_game_state_illogical():
     # Game state with a lower logical value should be ignored
     conman.leader = ("other", 2)
     fake_state = schema.GameState(("new", 0), [], [])
-    sock.add_fake_send(fake_state.encode())
+    sock.add_fake_send(frame(fake_state.encode()))
 
     watch = WatchFunc()
     conman.update_game_state = watch.func
@@ -214,7 +344,7 @@ def test_broadcast_input():
     istate = schema.InputState()
     conman.broadcast_input(istate)
 
-    assert sock.sent == [istate.encode()]
+    assert sock.sent == [frame(istate.encode())]
 
 
 def test_broadcast_gamestate_normal():
@@ -229,7 +359,7 @@ def test_broadcast_gamestate_normal():
     conman.broadcast_game_state(fake_state)
 
     assert conman.leader == ("new", 0)
-    assert sock.sent == [fake_state.encode()]
+    assert sock.sent == [frame(fake_state.encode())]
 
 
 def test_broadcast_gamestate_backup():
@@ -244,5 +374,325 @@ def test_broadcast_gamestate_backup():
     conman.broadcast_game_state(fake_state)
 
     assert conman.leader == ("new", 0)
-    assert sock.sent == [fake_state.encode()]
+    assert sock.sent == [frame(fake_state.encode())]
     assert conman.need_to_hear_from == "new"
+
+
+def test_broadcast_gamestate_keeps_newer_leader():
+    conman = get_blank_conman()
+    sock = get_dummy_socket()
+
+    conman.game_sockets = {"other": sock}
+    conman.log_event = lambda event: None
+    # A newer leader claimed the game while we were simulating
+    conman.leader = ("other", 2)
+
+    fake_state = schema.GameState(("test", 1), [], [])
+    conman.broadcast_game_state(fake_state)
+
+    assert conman.leader == ("other", 2)
+    assert sock.sent == [frame(fake_state.encode())]
+
+
+def test_broadcast_gamestate_binary():
+    conman = get_blank_conman()
+    conman.consume_game_state = dummy_func
+    sock = get_dummy_socket()
+
+    game_req = schema.CommsRequest("other", ["localhost", 6], "game", "binary")
+    conman.register_connection(sock, game_req, "other")
+    conman.log_event = lambda event: None
+
+    fake_state = schema.GameState(("new", 0), [], [])
+    conman.broadcast_game_state(fake_state)
+
+    assert conman.peer_codecs["other"] == "binary"
+    assert sock.sent == [frame(codec.get_codec("binary").encode(fake_state))]
+
+
+def test_broadcast_gamestate_delta():
+    conman = get_blank_conman()
+    conman.use_deltas = True
+    sock = get_dummy_socket()
+
+    conman.game_sockets = {"other": sock}
+    conman.log_event = lambda event: None
+
+    player = schema.Player("test", schema.Vec2(1, 1), schema.Vec2(0, 0))
+    idle = schema.Player("idle", schema.Vec2(2, 2), schema.Vec2(0, 0))
+    state = schema.GameState(("test", 0), [player, idle], [], seq=1)
+    # Nothing acknowledged yet so the whole state goes out
+    conman.broadcast_game_state(state)
+    conman.handle_ack("other", schema.SnapshotAck(1))
+    state.players[0].pos = schema.Vec2(3, 3)
+    state.seq = 2
+    conman.broadcast_game_state(state)
+
+    sent = [schema.wire_decode(FrameReader().feed(bs)[0]) for bs in sock.sent]
+    assert type(sent[0]) == schema.GameState
+    assert type(sent[1]) == schema.GameStateDelta
+    assert [p.id for p in sent[1].players] == ["test"]
+
+    # Losing track of the base means the next one is a keyframe
+    conman.handle_ack("other", schema.SnapshotAck(-1))
+    state.seq = 3
+    conman.broadcast_game_state(state)
+    assert type(schema.wire_decode(FrameReader().feed(sock.sent[2])[0])) == (
+        schema.GameState
+    )
+
+
+def test_consume_game_state_delta():
+    conman = get_blank_conman()
+    conman.use_deltas = True
+    sock = get_dummy_socket()
+    conman.game_sockets["test"] = sock
+
+    base = schema.GameState(("new", 0), [], [], seq=1)
+    spell = schema.Spell(1, schema.Vec2(1, 1), schema.Vec2(1, 1), "new")
+    state = schema.GameState(("new", 0), [], [spell], 1, seq=2)
+    orphan = schema.GameStateDelta(9, 8, ("new", 0), [], [], [])
+    sock.add_fake_send(frame(base.encode()))
+    sock.add_fake_send(frame(schema.GameStateDelta.between(base, state).encode()))
+    sock.add_fake_send(frame(orphan.encode()))
+
+    watch = WatchFunc()
+    conman.update_game_state = watch.func
+    consume = Thread(target=conman.consume_game_state, args=("test",))
+    consume.start()
+
+    time.sleep(0.5)
+    conman.alive = False
+    time.sleep(0.5)
+
+    assert watch.calls == [(base,), (state,)]
+    acks = [schema.wire_decode(FrameReader().feed(bs)[0]) for bs in sock.sent]
+    assert acks == [
+        schema.SnapshotAck(1),
+        schema.SnapshotAck(2),
+        schema.SnapshotAck(-1),
+    ]
+
+
+def test_consume_peer():
+    conman = get_blank_conman()
+    sock = get_dummy_socket()
+    conman.peer_sockets["test"] = sock
+
+    # Input and game state arrive on the same socket and get dispatched
+    fake_input = schema.InputState(schema.KeyInput(True, False, False, False))
+    fake_state = schema.GameState(("new", 0), [], [])
+    sock.add_fake_send(frame(tag_channel("input", fake_input.encode())))
+    sock.add_fake_send(frame(tag_channel("game", fake_state.encode())))
+    sock.add_fake_send(frame(tag_channel("health", schema.Ping().encode())))
+
+    watch = WatchFunc()
+    conman.update_game_state = watch.func
+    conman.consume_peer("test")
+
+    assert conman.input_map["test"] == fake_input
+    assert watch.calls[0] == (fake_state,)
+
+
+def test_health_ping_pong():
+    conman = get_blank_conman()
+    sock = get_dummy_socket()
+    conman.peer_sockets["test"] = sock
+
+    # Their pings are echoed straight back
+    conman.handle_health("test", schema.Ping(4, 1.5).encode())
+    assert sock.sent == [
+        frame(tag_channel("health", schema.Ping(4, 1.5, True).encode()))
+    ]
+
+    # Our pongs time the round trip
+    assert conman.rtt_to("test") == None
+    ping = conman.tracker_for("test").ping()
+    conman.handle_health("test", schema.Ping(ping.seq, ping.sent, True).encode())
+    assert conman.rtt_to("test") != None
+    assert conman.health_stats()["test"]["loss"] == 0.0
+    with pytest.raises(errors.InvalidMessage):
+        conman.handle_health("test", schema.SnapshotAck(1).encode())
+
+    # They share what they measured
+    conman.handle_health("other", schema.RttReport({"test": 0.5}).encode())
+    assert conman.rtt_matrix()["other"] == {"test": 0.5}
+
+
+def test_failure_detector():
+    conman = get_blank_conman()
+    conman.peer_sockets = {"quiet": get_dummy_socket(), "chatty": get_dummy_socket()}
+    conman.input_map["quiet"] = schema.InputState(
+        schema.KeyInput(True, False, False, False)
+    )
+    conman.dispatch("chatty", "health", schema.Ping(1, 0.0, True).encode())
+    conman.update_health()
+    assert conman.health_map == {"quiet": ALIVE, "chatty": ALIVE}
+
+    conman.last_heard["quiet"] -= 0.4
+    conman.update_health()
+    assert conman.health_map["quiet"] == SUS
+
+    conman.last_heard["quiet"] -= 1.0
+    conman.update_health()
+    assert conman.health_map == {"quiet": DEAD, "chatty": ALIVE}
+    # They stop moving, and we stop sending to them
+    assert conman.input_map["quiet"] == schema.InputState()
+    assert conman.peers_on("game") == ["chatty"]
+    # The dead stay dead
+    conman.last_heard["quiet"] += 10
+    conman.update_health()
+    assert conman.health_map["quiet"] == DEAD
+
+
+def test_suspect():
+    conman = get_blank_conman()
+    conman.health_map = {"slow": ALIVE, "gone": DEAD}
+    conman.suspect("slow")
+    conman.suspect("gone")
+    assert conman.health_map == {"slow": SUS, "gone": DEAD}
+
+
+def test_leader_failover():
+    conman = get_blank_conman()
+    conman.peer_sockets = {"L": get_dummy_socket(), "B": get_dummy_socket()}
+    conman.leader = ("L", 3)
+    state = schema.GameState(
+        ("L", 3),
+        [
+            schema.Player("L", schema.Vec2(0, 0), schema.Vec2(0, 0), score=0),
+            schema.Player("B", schema.Vec2(0, 0), schema.Vec2(0, 0), score=1),
+            schema.Player("test", schema.Vec2(0, 0), schema.Vec2(0, 0), score=1),
+        ],
+        [],
+    )
+    # Nothing happens while the leader is alive
+    assert not conman.check_leader(state)
+    assert conman.leader == ("L", 3)
+
+    # The lowest surviving score takes over, with a newer clock
+    conman.mark_dead("L")
+    assert conman.check_leader(state)
+    assert conman.leader == ("B", 4)
+    # The snapshot itself is left alone, the new leader is stamped on a copy
+    assert state.next_leader == ("L", 3)
+    assert conman.stamp_leader(state).next_leader == ("B", 4)
+    assert conman.stamp_leader(state) is not state
+    # We keep telling B until it starts leading
+    assert conman.need_to_hear_from == "B"
+
+    # If B dies too, we lead
+    conman.mark_dead("B")
+    assert conman.check_leader(state)
+    assert conman.leader == ("test", 5)
+    assert conman.is_leader()
+    assert conman.need_to_hear_from == None
+
+
+def test_leaderless_partial_mesh():
+    conman = get_blank_conman()
+    conman.expected_peers = 2
+    conman.peer_sockets = {"B": get_dummy_socket()}
+    # The negotiator's leader never connected
+    assert not conman.wait_for_mesh(0.05)
+    assert conman.leader == None
+    state = schema.GameState(
+        ("", -1),
+        [
+            schema.Player("B", schema.Vec2(0, 0), schema.Vec2(0, 0)),
+            schema.Player("test", schema.Vec2(0, 0), schema.Vec2(0, 0)),
+        ],
+        [],
+    )
+    # Their first state may still be on its way
+    assert not conman.check_leader(state)
+    conman.started_at -= cconsts.DEAD_AFTER + 0.1
+    assert conman.check_leader(state)
+    assert conman.leader == ("B", 1)
+    assert conman.need_to_hear_from == "B"
+
+
+def test_outranks():
+    assert outranks(("B", 4), ("A", 3))
+    assert not outranks(("A", 3), ("B", 4))
+    # Two claims on the same clock go to the lower name
+    assert outranks(("A", 4), ("B", 4))
+    assert not outranks(("B", 4), ("A", 4))
+    assert not outranks(("A", 4), ("A", 4))
+
+
+def test_backoff_delay():
+    for _ in range(20):
+        assert 0.05 <= manager.backoff_delay(0) <= 0.1
+        assert 0.1 <= manager.backoff_delay(1) <= 0.2
+        # Capped
+        assert 1.0 <= manager.backoff_delay(30) <= 2.0
+
+
+def test_reconnected_peer_is_revived():
+    conman = get_blank_conman()
+    conman.consume_peer = dummy_func
+    conman.start_reconnect = lambda name: None
+    old_sock = get_dummy_socket()
+    new_sock = get_dummy_socket()
+    peer_req = schema.CommsRequest("test", ["localhost", 6], "peer")
+    conman.register_connection(old_sock, peer_req, "to")
+    conman.acked_seqs["to"] = 12
+    conman.mark_dead("to")
+    assert conman.peers_on("game") == []
+
+    conman.register_connection(new_sock, peer_req, "to")
+    assert conman.peer_sockets == {"to": new_sock}
+    assert old_sock.has_closed
+    assert conman.health_map["to"] == ALIVE
+    assert conman.peers_on("game") == ["to"]
+    # They get a full game state next
+    assert "to" not in conman.acked_seqs
+
+
+def test_reconnect(monkeypatch):
+    monkeypatch.setattr(manager, "backoff_delay", lambda attempt: 0)
+    conman = get_blank_conman()
+    conman.reconnect_map = {"a": ["localhost", 1], "zed": ["localhost", 2]}
+    conman.health_map = {"a": DEAD, "zed": DEAD}
+    # Only the lower name redials
+    assert not conman.should_redial("a")
+    assert not conman.should_redial("nobody")
+    assert conman.should_redial("zed")
+    assert not conman.should_redial("zed")
+    conman.reconnecting.clear()
+
+    # Give up twice, then get through
+    attempts = []
+
+    def fake_dial(info, req):
+        attempts.append(info)
+        if len(attempts) == 3:
+            conman.revive("zed")
+            return True
+        return False
+
+    conman.dial = fake_dial
+    conman.start_reconnect("zed")
+    time.sleep(0.5)
+    assert attempts == [["localhost", 2]] * 3
+    assert conman.health_map["zed"] == ALIVE
+    assert conman.reconnecting == set()
+
+
+def test_broadcast_multiplexed():
+    conman = get_blank_conman()
+    sock = get_dummy_socket()
+    conman.peer_sockets = {"other": sock}
+    conman.last_inp_broadcast = 0
+    conman.log_event = lambda event: None
+
+    istate = schema.InputState()
+    fake_state = schema.GameState(("new", 0), [], [])
+    conman.broadcast_input(istate)
+    conman.broadcast_game_state(fake_state)
+
+    assert sock.sent == [
+        frame(tag_channel("input", istate.encode())),
+        frame(tag_channel("game", fake_state.encode())),
+    ]
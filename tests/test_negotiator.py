@@ -1,19 +1,25 @@
 import pytest
 import sys
+from mocks.mock_clock import FakeClock
 from mocks.mock_socket import socket
+import math
 import time
+import asyncio
 from threading import Thread
+from typing import Union
 
 sys.path.append("..")
 
-from connections.negotiator import Negotiator
+from connections.negotiator import AsyncNegotiator, Negotiator, Ticket
 from game import consts as gconsts
 from connections import consts as cconsts
 import schema
+from connections.framing import frame, FrameReader, read_frame
+import errors
 
 
 def get_blank_negotiator() -> Negotiator:
-    return Negotiator()
+    return Negotiator(expect_server=False, size=5)
 
 
 def get_dummy_socket() -> socket:
@@ -24,22 +30,22 @@ def test_negotiate():
     neg = get_blank_negotiator()
     sock = get_dummy_socket()
 
-    sock.add_fake_send(schema.ConnectRequest("A").encode())
+    sock.add_fake_send(frame(schema.ConnectRequest("A").encode()))
     # Try to join with a name that already exists
-    sock.add_fake_send(schema.ConnectRequest("A").encode())
-    sock.add_fake_send(schema.ConnectRequest("B").encode())
-    sock.add_fake_send(schema.ConnectRequest("C").encode())
-    sock.add_fake_send(schema.ConnectRequest("D").encode())
-    sock.add_fake_send(schema.ConnectRequest("E").encode())
+    sock.add_fake_send(frame(schema.ConnectRequest("A").encode()))
+    sock.add_fake_send(frame(schema.ConnectRequest("B").encode()))
+    sock.add_fake_send(frame(schema.ConnectRequest("C").encode()))
+    sock.add_fake_send(frame(schema.ConnectRequest("D").encode()))
+    sock.add_fake_send(frame(schema.ConnectRequest("E").encode()))
 
     neg.negotiate(sock)
 
     # Check that the correct number of machines were created
-    assert len(neg.machines) == gconsts.NUM_PLAYERS
-    assert len(neg.socket_map) == gconsts.NUM_PLAYERS
+    assert len(neg.machines) == 5
+    assert len(neg.socket_map) == 5
 
     # Get access to all the things that the negotiator sent
-    decoded = [schema.wire_decode(bs) for bs in sock.sent]
+    decoded = [schema.wire_decode(FrameReader().feed(bs)[0]) for bs in sock.sent]
     # A should be the leader
     assert type(decoded[0]) == schema.ConnectResponse and decoded[0].is_leader
     # The second A should be rejected
@@ -58,3 +64,198 @@ def test_negotiate():
         and decoded[10].name == "E"
         and len(decoded[10].connections) == 4
     )
+
+
+def test_negotiate_server():
+    neg = Negotiator(expect_server=True)
+    sock = get_dummy_socket()
+
+    sock.add_fake_send(frame(schema.ConnectRequest("A").encode()))
+    sock.add_fake_send(frame(schema.ConnectRequest("S", "server").encode()))
+    # Only one server per lobby
+    sock.add_fake_send(frame(schema.ConnectRequest("T", "server").encode()))
+    for name in "BCDEFGHIJKLMNOP"[: gconsts.NUM_PLAYERS - 1]:
+        sock.add_fake_send(frame(schema.ConnectRequest(name).encode()))
+
+    neg.negotiate(sock)
+
+    assert len(neg.machines) == gconsts.NUM_PLAYERS + 1
+    assert neg.server == "S"
+
+    decoded = [schema.wire_decode(FrameReader().feed(bs)[0]) for bs in sock.sent]
+    # The server leads, not the first player
+    assert decoded[0].success and not decoded[0].is_leader
+    assert decoded[1].success and decoded[1].is_leader
+    assert not decoded[2].success
+    machines = [msg for msg in decoded if type(msg) == schema.Machine]
+    assert all(mach.server == "S" for mach in machines)
+
+
+def test_reject_server_without_server_mode():
+    neg = Negotiator(expect_server=False)
+    assert not neg.accepts(schema.ConnectRequest("S", "server"))
+    assert neg.accepts(schema.ConnectRequest("A"))
+
+
+async def handshake(
+    stream: asyncio.StreamReader, writer: asyncio.StreamWriter, frames: FrameReader
+) -> list:
+    """
+    Answers pings like join_lobby does, returning everything else the negotiator
+    sent
+    """
+    msgs = []
+    try:
+        while len(msgs) < 2:
+            msg = schema.wire_decode(await read_frame(stream, frames))
+            if type(msg) == schema.Ping:
+                writer.write(frame(schema.Ping(msg.seq, msg.sent, True).encode()))
+            else:
+                msgs.append(msg)
+    except errors.CommsDied:
+        pass
+    return msgs
+
+
+async def join(port: int, name: str, role: str = "player") -> list:
+    stream, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(frame(schema.ConnectRequest(name, role).encode()))
+    msgs = await handshake(stream, writer, FrameReader())
+    writer.close()
+    return msgs
+
+
+async def run_negotiator(neg: AsyncNegotiator, port: int, clients):
+    serving = asyncio.ensure_future(neg.serve("127.0.0.1", port))
+    await asyncio.sleep(0.1)
+    try:
+        return await asyncio.wait_for(clients(), 5)
+    finally:
+        serving.cancel()
+
+
+def test_async_fills_many_lobbies():
+    # Everyone is on this computer, so they're all close enough to play together
+    neg = AsyncNegotiator(expect_server=False, size=2, handshake_timeout=0.5)
+
+    async def clients():
+        # Someone connects and never says anything, it mustn't hold anyone up
+        silent = await asyncio.open_connection("127.0.0.1", 50931)
+        results = await asyncio.gather(
+            *[join(50931, name) for name in "ABCDEF"],
+            # There's already an A waiting, so this goes to another lobby
+            join(50931, "A"),
+            join(50931, "G"),
+        )
+        silent[1].close()
+        return results
+
+    results = asyncio.run(run_negotiator(neg, 50931, clients))
+    assert neg.lobbies_started == 4
+    assert neg.queue == []
+    for msgs in results:
+        assert msgs[0].success
+        assert type(msgs[1]) == schema.Machine
+    machines = [msgs[1] for msgs in results]
+    # Nobody in any lobby shares a port
+    assert len({mach.port for mach in machines}) == len(machines)
+    # Each lobby has one leader, who connects to nobody
+    leaders = [msgs[1] for msgs in results if msgs[0].is_leader]
+    assert len(leaders) == 4
+    assert all(len(mach.connections) == 0 for mach in leaders)
+    followers = [msgs[1] for msgs in results if not msgs[0].is_leader]
+    assert all(len(mach.connections) == 1 for mach in followers)
+
+
+def test_async_leaving_the_queue():
+    neg = AsyncNegotiator(expect_server=False, size=2)
+
+    async def clients():
+        stream, writer = await asyncio.open_connection("127.0.0.1", 50932)
+        writer.write(frame(schema.ConnectRequest("quitter").encode()))
+        waiting = asyncio.ensure_future(handshake(stream, writer, FrameReader()))
+        await asyncio.sleep(0.3)
+        assert [ticket.req.name for ticket in neg.queue] == ["quitter"]
+        assert neg.queue[0].ping != None
+        writer.close()
+        await waiting
+        await asyncio.sleep(0.2)
+        assert neg.queue == []
+        return await asyncio.gather(join(50932, "A"), join(50932, "B"))
+
+    (a, b) = asyncio.run(run_negotiator(neg, 50932, clients))
+    assert a[0].is_leader and a[1].connections == []
+    assert not b[0].is_leader and b[1].connections == [["127.0.0.1", a[1].port]]
+
+
+def test_async_rejects_server_without_server_mode():
+    neg = AsyncNegotiator(expect_server=False, size=2)
+
+    async def clients():
+        return await join(50933, "S", "server")
+
+    msgs = asyncio.run(run_negotiator(neg, 50933, clients))
+    assert msgs == [schema.ConnectResponse(False)]
+
+
+def queue_up(
+    neg: AsyncNegotiator, rtts: dict[str, Union[float, None]], role: str = "player"
+):
+    for name, rtt in rtts.items():
+        req = schema.ConnectRequest(name, role)
+        neg.queue.append(Ticket(req, "1.2.3.4", None, rtt, 0.0))
+
+
+def names(group) -> list[str]:
+    return [ticket.req.name for ticket in group]
+
+
+def test_ticket_rtt():
+    req = schema.ConnectRequest("A")
+    near = Ticket(req, "1.2.3.4", None, 0.125, 0.0)
+    far = Ticket(req, "1.2.3.4", None, 0.375, 0.0)
+    assert near.rtt_to(far) == 0.5
+    # Didn't answer the pings, so they could be anywhere
+    assert near.rtt_to(Ticket(req, "1.2.3.4", None, None, 0.0)) == math.inf
+
+
+def test_matches_nearby_players():
+    neg = AsyncNegotiator(
+        expect_server=False, size=2, target_rtt=0.08, clock=FakeClock().time
+    )
+    queue_up(neg, {"near1": 0.01, "far1": 0.3, "near2": 0.02, "far2": 0.31})
+    assert names(neg.next_match()) == ["near1", "near2"]
+    neg.queue = [ticket for ticket in neg.queue if "near" not in ticket.req.name]
+    # Similar pings aren't enough, they could be on opposite sides of us
+    assert neg.next_match() == None
+
+
+def test_unanswered_pings_wait():
+    clock = FakeClock()
+    neg = AsyncNegotiator(
+        expect_server=False, size=2, target_rtt=0.08, max_wait=10, clock=clock.time
+    )
+    queue_up(neg, {"silent": None, "near": 0.01})
+    assert neg.next_match() == None
+    clock.now = 10
+    assert names(neg.next_match()) == ["silent", "near"]
+
+
+def test_waits_for_a_better_match():
+    clock = FakeClock()
+    neg = AsyncNegotiator(
+        expect_server=False, size=2, target_rtt=0.08, max_wait=10, clock=clock.time
+    )
+    queue_up(neg, {"near": 0.01, "far": 0.3})
+    assert neg.next_match() == None
+    # Waiting any longer isn't worth it
+    clock.now = 10
+    assert names(neg.next_match()) == ["near", "far"]
+
+
+def test_matches_nearest_server():
+    neg = AsyncNegotiator(expect_server=True, size=2, target_rtt=0.08)
+    queue_up(neg, {"A": 0.01, "B": 0.02})
+    assert neg.next_match() == None
+    queue_up(neg, {"far": 0.5, "close": 0.03}, role="server")
+    assert names(neg.next_match()) == ["A", "B", "close"]
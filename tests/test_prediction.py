@@ -0,0 +1,79 @@
+import pytest
+import sys
+
+sys.path.append("..")
+
+import game.consts as consts
+from game.prediction import Predictor
+from schema import GameState, InputState, KeyInput, MouseInput, Player, Vec2
+
+RIGHT = KeyInput(False, True, False, False)
+
+
+def get_state(x: float, input_seq: int = 0, seq: int = 0, alive=True) -> GameState:
+    return GameState(
+        ("L", 0),
+        [
+            Player("L", Vec2(500, 500), Vec2(0, 0)),
+            Player(
+                "me",
+                Vec2(x, 100),
+                Vec2(0, 0),
+                is_alive=alive,
+                is_david=True,
+                input_seq=input_seq,
+            ),
+        ],
+        [],
+        seq=seq,
+    )
+
+
+def get_input(seq: int) -> InputState:
+    return InputState(RIGHT, MouseInput(Vec2(0, 0), False, False), seq)
+
+
+def test_predicts_immediately():
+    predictor = Predictor("me")
+    state = get_state(100)
+    predictor.step(state, get_input(1))
+    assert state.players[1].pos.x == 100 + consts.PLAYER_SPEED
+    predictor.step(state, get_input(2))
+    assert state.players[1].pos.x == 100 + 2 * consts.PLAYER_SPEED
+    # The leader decides who David is, not us
+    assert state.players[1].is_david
+    # Nobody else moves
+    assert state.players[0].pos == Vec2(500, 500)
+
+
+def test_reconciles_with_snapshot():
+    predictor = Predictor("me")
+    state = get_state(100)
+    for seq in range(1, 5):
+        predictor.step(state, get_input(seq))
+    # The leader applied our first two inputs, but somebody pushed us back
+    snapshot = get_state(50, input_seq=2, seq=7)
+    predictor.step(snapshot, get_input(5))
+    # Inputs 3, 4 and 5 get replayed on top of the leader's position
+    assert snapshot.players[1].pos.x == 50 + 3 * consts.PLAYER_SPEED
+    assert [inp.seq for inp in predictor.pending] == [3, 4, 5]
+
+
+def test_dead_players_dont_move():
+    predictor = Predictor("me")
+    state = get_state(100, alive=False)
+    predictor.step(state, get_input(1))
+    predictor.step(state, get_input(2))
+    assert state.players[1].pos.x == 100
+    snapshot = get_state(300, input_seq=0, seq=3)
+    predictor.step(snapshot, get_input(3))
+    # Inputs sent while dead aren't replayed after respawning
+    assert snapshot.players[1].pos.x == 300 + consts.PLAYER_SPEED
+
+
+def test_engine_acks_input():
+    import game.engine as engine
+
+    state = get_state(100)
+    engine.update_game_state(state, {"me": get_input(9)}, "L")
+    assert state.players[1].input_seq == 9
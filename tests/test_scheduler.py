@@ -0,0 +1,60 @@
+import pytest
+import sys
+from mocks.mock_clock import FakeClock
+
+sys.path.append("..")
+
+from scheduler import FixedTimestep
+
+
+def get_timestep(clock: FakeClock, max_catchup: int = 5) -> FixedTimestep:
+    return FixedTimestep(0.125, max_catchup, clock.time, clock.sleep)
+
+
+def test_advance():
+    timestep = get_timestep(FakeClock())
+    assert timestep.advance(0.0625) == 0
+    assert timestep.advance(0.125) == 1
+    assert timestep.advance(0.25) == 2
+    assert timestep.accumulator == 0.0625
+
+
+def test_advance_caps_catchup():
+    timestep = get_timestep(FakeClock(), 3)
+    assert timestep.advance(1.0625) == 3
+    assert timestep.dropped_steps == 5
+    assert timestep.accumulator == 0.0625
+
+
+def test_run_fixed_rate():
+    clock = FakeClock()
+    timestep = get_timestep(clock)
+    times = []
+
+    def tick():
+        times.append(clock.now)
+        # Work time shouldn't make us fall behind
+        clock.now += 0.0625
+
+    timestep.run(tick, lambda: len(times) < 10)
+    assert times == pytest.approx([0.125 * i for i in range(10)])
+    assert timestep.overruns == 0
+
+
+def test_run_catches_up():
+    clock = FakeClock()
+    timestep = get_timestep(clock)
+    times = []
+
+    def tick():
+        times.append(clock.now)
+        if len(times) == 3:
+            # One slow tick
+            clock.now += 0.375
+
+    timestep.run(tick, lambda: len(times) < 10)
+    assert timestep.overruns == 1
+    assert timestep.worst_overrun == 0.25
+    # After the stall we run back to back until we're on schedule again
+    assert times[3:6] == pytest.approx([0.625, 0.625, 0.625])
+    assert times[-1] == 1.125
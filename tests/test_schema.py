@@ -12,9 +12,14 @@ from schema import (
     Spell,
     Player,
     GameState,
+    GameStateDelta,
+    SnapshotAck,
+    Ping,
+    RttReport,
     KeyInput,
     MouseInput,
     InputState,
+    CommsRequest,
     ConnectRequest,
     ConnectResponse,
     Machine,
@@ -46,6 +51,8 @@ def test_Spell_encode_decode():
 def test_Player_encode_decode():
     assert Player.decode(PLAYER.encode()) == PLAYER
     assert wire_decode(PLAYER.encode()) == PLAYER
+    acked = Player("test", Vec2(1, 2), Vec2(0, 0), input_seq=5)
+    assert Player.decode(acked.encode()).input_seq == 5
 
 
 def test_GameState_encode_decode():
@@ -66,11 +73,17 @@ def test_MouseInput_encode_decode():
 def test_InputState_encode_decode():
     assert InputState.decode(INPUT_STATE.encode()) == INPUT_STATE
     assert wire_decode(INPUT_STATE.encode()) == INPUT_STATE
+    numbered = InputState(INPUT_STATE.key_input, INPUT_STATE.mouse_input, 12)
+    assert InputState.decode(numbered.encode()).seq == 12
 
 
 def test_ConnectRequest_encode_decode():
     assert ConnectRequest.decode(CONNECT_REQUEST.encode()) == CONNECT_REQUEST
     assert wire_decode(CONNECT_REQUEST.encode()) == CONNECT_REQUEST
+    server_req = ConnectRequest("test", "server")
+    assert ConnectRequest.decode(server_req.encode()) == server_req
+    # Requests without a role are from players
+    assert ConnectRequest.decode(b"ctest$").role == "player"
 
 
 def test_ConnectResponse_encode_decode():
@@ -81,3 +94,69 @@ def test_ConnectResponse_encode_decode():
 def test_Machine_encode_decode():
     assert Machine.decode(MACHINE.encode()) == MACHINE
     assert wire_decode(MACHINE.encode()) == MACHINE
+    served = Machine("test", "127.0.0.1", 1, [], "S")
+    assert Machine.decode(served.encode()).server == "S"
+
+
+def test_CommsRequest_encode_decode():
+    req = CommsRequest("test", ["127.0.0.1", 1], "game", "binary")
+    assert CommsRequest.decode(req.encode()) == req
+    assert wire_decode(req.encode()) == req
+    # Requests without a codec are assumed to be text
+    assert CommsRequest.decode(b"1test@127.0.0.1@1@game$").codec == "text"
+
+
+def test_GameStateDelta_encode_decode():
+    base = GameState(("test", 0), [PLAYER], [SPELL], 3, 7)
+    moved = Player("test", Vec2(5, 6), Vec2(3, 4))
+    new_spell = Spell(4, Vec2(1, 1), Vec2(1, 1), "test")
+    state = GameState(("test", 1), [moved], [new_spell], 4, 8)
+    delta = GameStateDelta.between(base, state)
+    assert GameStateDelta.decode(delta.encode()) == delta
+    assert wire_decode(delta.encode()) == delta
+    assert delta.removed_spells == [SPELL.id]
+    assert delta.apply(base) == state
+
+
+def test_GameStateDelta_only_changes():
+    idle = Player("idle", Vec2(1, 1), Vec2(0, 0))
+    base = GameState(("test", 0), [PLAYER, idle], [SPELL], 3, 1)
+    state = base.copy()
+    state.players[0].pos = Vec2(9, 9)
+    state.seq = 2
+    delta = GameStateDelta.between(base, state)
+    assert [player.id for player in delta.players] == ["test"]
+    assert delta.spells == []
+    assert delta.apply(base) == state
+
+
+def test_GameStateDelta_ignores_input_seq():
+    players = [Player(name, Vec2(1, 1), Vec2(0, 0)) for name in ["a", "b", "c"]]
+    base = GameState(("a", 0), players, [], 0, 1)
+    state = base.copy()
+    state.seq = 2
+    # Everyone sent an input that didn't change anything
+    for player in state.players:
+        player.input_seq += 1
+    assert GameStateDelta.between(base, state).players == []
+    # Except that each player needs to hear their own was applied
+    delta = GameStateDelta.between(base, state, "b")
+    assert [player.id for player in delta.players] == ["b"]
+    assert delta.apply(base).players[1].input_seq == 1
+
+
+def test_Ping_encode_decode():
+    ping = Ping(3, 12.25, True)
+    assert wire_decode(ping.encode()) == ping
+    # Older peers send a bare ping
+    assert wire_decode(b"i$") == Ping()
+
+
+def test_RttReport_encode_decode():
+    report = RttReport({"A": 0.05, "B": 1.25})
+    assert wire_decode(report.encode()) == report
+    assert wire_decode(RttReport({}).encode()) == RttReport({})
+
+
+def test_SnapshotAck_encode_decode():
+    assert wire_decode(SnapshotAck(-1).encode()) == SnapshotAck(-1)
@@ -0,0 +1,97 @@
+import pytest
+import sys
+from mocks.mock_socket import socket
+import time
+from threading import Event
+
+sys.path.append("..")
+
+from connections.send_queue import PeerSender
+from connections.manager import ConnectionManager
+from connections.framing import frame
+import schema
+
+
+class WatchFunc:
+    def __init__(self):
+        self.calls = []
+
+    def func(self, *args, **kwargs):
+        self.calls.append(args)
+
+
+def test_put_drains_in_order():
+    watch = WatchFunc()
+    sender = PeerSender("other", watch.func)
+    sender.put("input", b"one")
+    sender.put("game", b"two", False)
+    sender.start()
+    time.sleep(0.5)
+    assert watch.calls == [("input", b"one", True), ("game", b"two", False)]
+    assert sender.depth() == 0
+    sender.stop()
+
+
+def test_coalesce_unsent():
+    watch = WatchFunc()
+    sender = PeerSender("other", watch.func)
+    sender.put("game", b"old", True, coalesce=True)
+    sender.put("input", b"inp")
+    sender.put("game", b"new", False, coalesce=True)
+    assert sender.depth() == 2
+    assert sender.coalesced == 1
+    sender.start()
+    time.sleep(0.5)
+    # The newest state takes the old one's place and keeps its reliability
+    assert watch.calls == [("game", b"new", True), ("input", b"inp", True)]
+    sender.stop()
+
+
+def test_slow_peer_does_not_block():
+    release = Event()
+
+    def slow_write(channel, payload, reliable):
+        release.wait()
+
+    sender = PeerSender("slow", slow_write)
+    sender.start()
+    start = time.time()
+    for i in range(100):
+        sender.put("game", str(i).encode(), False, coalesce=True)
+    assert time.time() - start < 0.5
+    # Only one is stuck in the socket and one is waiting behind it
+    assert sender.depth() <= 1
+    release.set()
+    sender.stop()
+
+
+def test_queue_cap():
+    full = []
+    sender = PeerSender("stalled", WatchFunc().func, 3, lambda: full.append(True))
+    sender.put("game", b"state", True, coalesce=True)
+    for i in range(4):
+        sender.put("input", str(i).encode())
+    # The oldest inputs make way, the game state stays
+    assert sender.depth() == 3
+    assert [entry[1] for entry in sender.queue] == [b"state", b"2", b"3"]
+    assert sender.dropped == 2
+    assert full == [True, True]
+
+
+def test_manager_queued_sends():
+    def dummy_update_game_state(_):
+        pass
+
+    id = schema.Machine("test", "localhost", 8000, [])
+    conman = ConnectionManager(id, dummy_update_game_state, False)
+    conman.log_event = lambda event: None
+    sock = socket(-1, -1)
+    conman.game_sockets = {"other": sock}
+
+    fake_state = schema.GameState(("new", 0), [], [])
+    conman.broadcast_game_state(fake_state)
+    time.sleep(0.5)
+
+    assert sock.sent == [frame(fake_state.encode())]
+    assert conman.queue_depths() == {"other": 0}
+    conman.kill()
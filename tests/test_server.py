@@ -0,0 +1,48 @@
+import pytest
+import sys
+
+sys.path.append("..")
+
+from server import Server
+import schema
+from game import consts as gconsts
+
+
+class WatchFunc:
+    def __init__(self):
+        self.calls = []
+
+    def func(self, *args, **kwargs):
+        self.calls.append(args)
+
+
+def get_blank_server() -> Server:
+    return Server(identity=schema.Machine("S", "localhost", 8000, [], "S"))
+
+
+def test_server_tick():
+    server = get_blank_server()
+    watch = WatchFunc()
+    server.conman.broadcast_game_state = watch.func
+    server.game_state = schema.GameState(
+        ("S", 0),
+        [
+            schema.Player("A", schema.Vec2(100, 100), schema.Vec2(0, 0)),
+            schema.Player("B", schema.Vec2(300, 100), schema.Vec2(0, 0), score=2),
+        ],
+        [],
+    )
+    server.conman.input_map["A"] = schema.InputState(
+        schema.KeyInput(False, True, False, False)
+    )
+    server.server_tick()
+
+    assert server.game_state.seq == 1
+    assert server.game_state.players[0].pos.x > 100
+    # Leadership never moves off the server
+    assert server.game_state.next_leader == ("S", 0)
+    # The losing player is David
+    assert server.game_state.players[0].is_david
+    assert watch.calls == [(server.game_state,)]
+    assert server.conman.is_leader()
+    assert server.conman.expected_peers == gconsts.NUM_PLAYERS
@@ -0,0 +1,56 @@
+import pytest
+import sys
+
+sys.path.append("..")
+
+from game.spatial import SpatialHash
+import game.engine as engine
+from schema import GameState, Player, Spell, Vec2
+
+
+def test_query_nearby():
+    grid = SpatialHash(10)
+    grid.insert(0, Vec2(5, 5))
+    grid.insert(1, Vec2(15, 5))
+    grid.insert(2, Vec2(500, 500))
+    grid.insert(3, Vec2(-3, 4))
+    assert grid.query(5, 5, 4) == [0]
+    assert grid.query(9, 5, 4) == [0, 1]
+    assert grid.query(1, 1, 4) == [0, 3]
+    assert grid.query(300, 300, 4) == []
+
+
+def test_query_keeps_insert_order():
+    grid = SpatialHash(10)
+    grid.insert(2, Vec2(15, 5))
+    grid.insert(0, Vec2(5, 5))
+    grid.insert(1, Vec2(5, 15))
+    assert grid.query(10, 10, 6) == [0, 1, 2]
+
+
+def test_collision_scores_creator():
+    shooter = Player("A", Vec2(100, 100), Vec2(0, 0))
+    target = Player("B", Vec2(500, 300), Vec2(0, 0))
+    state = GameState(
+        ("A", 0),
+        [shooter, target],
+        [
+            Spell(1, Vec2(900, 600), Vec2(0, 0), "A"),
+            Spell(2, Vec2(500, 296), Vec2(0, 0), "A"),
+            Spell(3, Vec2(502, 296), Vec2(0, 0), "A"),
+        ],
+    )
+    engine.update_game_state(state, {}, "A")
+    assert not target.is_alive
+    assert shooter.score == 1
+    # Only the first spell to hit is used up
+    assert state.spells[0].pos == Vec2(900, 600)
+    assert state.spells[1].pos == Vec2(-1000, -1000)
+    assert state.spells[2].pos == Vec2(502, 296)
+
+
+def test_collision_ignores_own_spell():
+    shooter = Player("A", Vec2(100, 100), Vec2(0, 0))
+    state = GameState(("A", 0), [shooter], [Spell(1, Vec2(100, 96), Vec2(0, 0), "A")])
+    engine.update_game_state(state, {}, "A")
+    assert shooter.is_alive
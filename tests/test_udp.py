@@ -0,0 +1,118 @@
+import pytest
+import sys
+from mocks.mock_socket import socket
+import time
+
+sys.path.append("..")
+
+from connections.udp import (
+    UdpTransport,
+    PACKET,
+    UNRELIABLE,
+    RELIABLE,
+    ACK,
+    RETRANSMIT_INTERVAL,
+)
+from connections.manager import ConnectionManager
+import schema
+
+PEER = ("127.0.0.1", 6)
+
+
+class WatchFunc:
+    def __init__(self):
+        self.calls = []
+
+    def func(self, *args, **kwargs):
+        self.calls.append(args)
+
+
+def get_dummy_socket() -> socket:
+    return socket(-1, -1)
+
+
+def get_transport(watch: WatchFunc) -> UdpTransport:
+    return UdpTransport("localhost", 8000, watch.func, get_dummy_socket())
+
+
+def test_unreliable():
+    watch = WatchFunc()
+    udp = get_transport(watch)
+    udp.send(PEER, "game", b"state")
+    assert udp.sock.sent_to == [(PACKET.pack(UNRELIABLE, 1, 0) + b"state", PEER)]
+    assert udp.pending == {}
+
+    udp.handle_packet(PACKET.pack(UNRELIABLE, 1, 0) + b"state", PEER)
+    assert watch.calls == [(PEER, "game", b"state")]
+
+
+def test_reliable_retransmit_until_acked():
+    udp = get_transport(WatchFunc())
+    udp.send(PEER, "input", b"one", reliable=True)
+    udp.send(PEER, "input", b"two", reliable=True)
+    assert len(udp.pending) == 2
+
+    # Nothing is resent until the interval has passed
+    udp.resend_pending()
+    assert len(udp.sock.sent_to) == 2
+    time.sleep(RETRANSMIT_INTERVAL * 2)
+    udp.handle_packet(PACKET.pack(ACK, 0, 0), PEER)
+    udp.resend_pending()
+    assert udp.sock.sent_to[-1] == (PACKET.pack(RELIABLE, 0, 1) + b"two", PEER)
+    assert list(udp.pending.keys()) == [(PEER, 1)]
+
+
+def test_reliable_receive_acks_and_dedupes():
+    watch = WatchFunc()
+    udp = get_transport(watch)
+    packet = PACKET.pack(RELIABLE, 0, 3) + b"input"
+    udp.handle_packet(packet, PEER)
+    udp.handle_packet(packet, PEER)
+    assert watch.calls == [(PEER, "input", b"input")]
+    # Both copies are acked in case the first ack was the one that got lost
+    assert udp.sock.sent_to == [(PACKET.pack(ACK, 0, 3), PEER)] * 2
+
+
+def get_udp_conman() -> ConnectionManager:
+    def dummy_update_game_state(_):
+        pass
+
+    id = schema.Machine("test", "localhost", 8000, [])
+    conman = ConnectionManager(
+        id, dummy_update_game_state, False, transport="udp", queued_sends=False
+    )
+    # Skip start_udp so no background threads spin on the dummy socket
+    conman.udp = UdpTransport("localhost", 8000, conman.on_datagram, get_dummy_socket())
+    conman.reconnect_map["other"] = list(PEER)
+    conman.peer_sockets["other"] = get_dummy_socket()
+    conman.log_event = lambda event: None
+    return conman
+
+
+def test_manager_sends_over_udp():
+    conman = get_udp_conman()
+    conman.leader = ("new", 0)
+    state = schema.GameState(("new", 0), [], [], seq=2)
+    conman.broadcast_game_state(state)
+    # Handing leadership over has to arrive
+    state.next_leader = ("other", 1)
+    conman.broadcast_game_state(state)
+
+    assert conman.peer_sockets["other"].sent == []
+    sent = conman.udp.sock.sent_to
+    assert [addr for _, addr in sent] == [PEER, PEER]
+    assert PACKET.unpack_from(sent[0][0])[0] == UNRELIABLE
+    assert PACKET.unpack_from(sent[1][0])[0] == RELIABLE
+
+
+def test_manager_drops_stale_datagrams():
+    conman = get_udp_conman()
+    watch = WatchFunc()
+    conman.update_game_state = watch.func
+    newer = schema.GameState(("other", 0), [], [], seq=5)
+    older = schema.GameState(("other", 0), [], [], seq=4)
+    conman.on_datagram(PEER, "game", newer.encode())
+    conman.on_datagram(PEER, "game", older.encode())
+    # Datagrams from strangers are ignored
+    conman.on_datagram(("10.0.0.1", 9), "game", newer.encode())
+    assert watch.calls == [(newer,)]